@@ -2,6 +2,16 @@ from trytond.pool import Pool
 
 from .mmc import *
 from .mmc_reports import *
+from .mmc_import import *
+from .mmc_duplicates import *
+from .mmc_tetanus import *
+from .mmc_risk import *
+from .mmc_alerts import *
+from .mmc_worklist import *
+from .mmc_export import *
+from .mmc_stats import *
+from .mmc_barangay import *
+from .mmc_archive import *
 
 def register():
     Pool.register(
@@ -17,10 +27,55 @@ def register():
         MmcPerinatal,
         MmcPerinatalMonitor,
         MmcPuerperiumMonitor,
+        MmcBarangay,
+        Party,
         Address,
         MmcPostpartumContinuedMonitor,
         MmcPostpartumOngoingMonitor,
+        MmcPrenatalReportStart,
+        MmcPrenatalReportFact,
+        MmcPrenatalReportFactRebuildStart,
+        MmcPrenatalReportFactRebuildResult,
+        MmcFhsisStart,
+        MmcFhsisResult,
+        MmcImportStart,
+        MmcImportResult,
+        MmcDuplicatePatientsResult,
+        ProductTemplate,
+        Product,
+        MmcTetanusStatus,
+        MmcTetanusStatusRebuildResult,
+        MmcRiskCode,
+        MmcRiskCodeRebuildResult,
+        MmcAlertPending,
+        MmcAlertState,
+        MmcAlertCheckResult,
+        MmcWorklistVisit,
+        MmcPrenatalExportStart,
+        MmcPrenatalExportResult,
+        MmcStatsResult,
+        MmcBarangayNormalizeStart,
+        MmcBarangayNormalizeResult,
+        MmcCatchmentStart,
+        MmcCatchmentResult,
+        MmcArchiveStart,
+        MmcArchiveResult,
         module='mmc', type_='model')
+    Pool.register(
+        MmcPrenatalReportWizard,
+        MmcPrenatalReportFactRebuild,
+        MmcFhsis,
+        MmcImport,
+        MmcDuplicatePatients,
+        MmcTetanusStatusRebuild,
+        MmcRiskCodeRebuild,
+        MmcAlertCheck,
+        MmcPrenatalExport,
+        MmcStats,
+        MmcBarangayNormalize,
+        MmcCatchment,
+        MmcArchive,
+        module='mmc', type_='wizard')
     Pool.register(
         MmcPrenatalReport,
         module='mmc', type_='report')
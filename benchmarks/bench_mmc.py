@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+# -------------------------------------------------------------------------------
+# bench_mmc.py
+#
+# Benchmarks of the hot paths of the MMC module over synthetic cohorts of
+# patients in a throwaway database.
+#
+# The module has to be installed in trytond as mmc, e.g. by linking this
+# repository to trytond/modules/mmc. By default the database is an in
+# memory SQLite database. To use a local PostgreSQL database pass a
+# trytond configuration file with --config and a name of a database that
+# can be dropped with --database.
+#
+#   python benchmarks/bench_mmc.py --scales 1000,10000 --output bench.json
+#
+# The cohorts grow from one scale to the next: the patients of the
+# smaller scale are kept and the missing ones are added. The results are
+# written as JSON, one entry per benchmark and scale.
+# -------------------------------------------------------------------------------
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import time
+from decimal import Decimal
+
+from trytond.config import CONFIG
+
+# --------------------------------------------------------
+# The shape of the cohort. Every patient has one pregnancy;
+# the rates are the share of pregnancies with a delivery and
+# postpartum monitoring, the counts the number of each kind of
+# record per pregnancy.
+# --------------------------------------------------------
+EVALUATIONS = (3, 9)
+VACCINATIONS = (0, 3)
+APPROXIMATE_RATE = 0.3
+DELIVERY_RATE = 0.6
+LABOR_READINGS = (2, 8)
+PUERPERIUM_READINGS = (2, 4)
+CONTINUED_READINGS = (1, 4)
+ONGOING_READINGS = (0, 2)
+
+BATCH_SIZE = 500
+CREATE_SAMPLE = 500
+TREE_LIMIT = 1000
+
+LASTNAMES = ['Dela Cruz', 'Santos', 'Reyes', 'Garcia', 'Mendoza', 'Bautista',
+    'Villanueva', 'Ramos', 'Aquino', 'Castillo', 'Rivera', 'Fernandez',
+    'Gonzales', 'Lopez', 'Torres', 'Flores', 'Navarro', 'Salazar']
+FIRSTNAMES = ['Maria', 'Ma. Cristina', 'Rosalie', 'Jennifer', 'Mary Grace',
+    'Lourdes', 'Analyn', 'Rowena', 'Jocelyn', 'Marites', 'Kristine',
+    'Divina', 'Evangeline', 'Ligaya', 'Teresita', 'Josephine']
+BARANGAYS = ['Agdao Proper', 'Centro', 'Gov. Paciano Bangoy', 'Leon Garcia',
+    'Lapu-lapu', 'Rafael Castillo', 'San Antonio', 'Tomas Monteverde',
+    'Ubalde', 'Wilfredo Aquino', 'Buhangin', 'Sasa']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=
+        'Benchmark the MMC module over synthetic cohorts.')
+    parser.add_argument('--scales', default='1000,10000,100000',
+        help='Comma separated numbers of patients')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Number of runs of each benchmark')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--config', help='trytond configuration file')
+    parser.add_argument('--database', help='Name of the throwaway database')
+    parser.add_argument('--output', help='JSON file, standard output if none')
+    return parser.parse_args()
+
+
+# --------------------------------------------------------
+# The synthetic records. Every generator returns the values
+# of the records of one patient so that a batch of patients
+# can be created with one create call per model.
+# --------------------------------------------------------
+class Cohort(object):
+
+    def __init__(self, seed, today):
+        self.random = random.Random(seed)
+        self.today = today
+
+    def date_between(self, start, end):
+        days = max((end - start).days, 0)
+        return start + datetime.timedelta(days=self.random.randint(0, days))
+
+    def datetime_on(self, date):
+        return datetime.datetime.combine(date, datetime.time(
+                self.random.randint(7, 17), self.random.randint(0, 59)))
+
+    def party(self):
+        return {
+            'name': self.random.choice(FIRSTNAMES),
+            'lastname': self.random.choice(LASTNAMES),
+            'is_person': True,
+            'is_patient': True,
+            'addresses': [('create', [{
+                            'street': '%d Purok %d' % (
+                                self.random.randint(1, 300),
+                                self.random.randint(1, 20)),
+                            'barangay': self.random.choice(BARANGAYS),
+                            }])],
+            }
+
+    def patient(self):
+        gravida = self.random.randint(1, 7)
+        dob = self.date_between(self.today - datetime.timedelta(days=365 * 42),
+            self.today - datetime.timedelta(days=365 * 15))
+        phil_health = self.random.random() < 0.4
+        return {
+            'dob': dob,
+            'gravida': gravida,
+            'para': gravida - 1,
+            'abortions': self.random.choice([0, 0, 0, 0, 1, 3]),
+            'stillbirths': self.random.choice([0] * 9 + [1]),
+            'living': gravida - 1,
+            'phil_health': phil_health,
+            'phil_health_id': phil_health and '%02d-%09d-%d' % (
+                self.random.randint(1, 99), self.random.randint(0, 10 ** 9 - 1),
+                self.random.randint(0, 9)) or None,
+            }
+
+    def pregnancy(self, gravida):
+        lmp = self.date_between(self.today - datetime.timedelta(days=400),
+            self.today - datetime.timedelta(days=30))
+        delivered = (self.today - lmp).days > 266 \
+            and self.random.random() < DELIVERY_RATE
+        end_date = delivered and self.datetime_on(lmp
+            + datetime.timedelta(days=self.random.randint(252, 290))) or None
+        if end_date and end_date.date() > self.today:
+            end_date = None
+        return {
+            'gravida': gravida,
+            'lmp': lmp,
+            'pregnancy_end_date': end_date,
+            'current_pregnancy': end_date is None,
+            'mb_book': self.random.random() < 0.7,
+            'iodized_salt': self.random.random() < 0.8,
+            }
+
+    def evaluations(self, pregnancy):
+        lmp = pregnancy['lmp']
+        end = pregnancy['pregnancy_end_date']
+        end = end and end.date() or self.today
+        start = lmp + datetime.timedelta(days=42)
+        if start >= end:
+            return []
+        dates = sorted(self.date_between(start, end)
+            for i in range(self.random.randint(*EVALUATIONS)))
+        vlist = []
+        for i, date in enumerate(dates):
+            next_appt = i + 1 < len(dates) and dates[i + 1] or \
+                date + datetime.timedelta(days=28)
+            vlist.append({
+                    'evaluation_date': self.datetime_on(date),
+                    'systolic': self.random.randint(90, 150),
+                    'diastolic': self.random.randint(60, 100),
+                    'weight': Decimal(self.random.randint(450, 800)) / 10,
+                    'fundal_height': self.random.randint(12, 38),
+                    'fetus_heart_rate': self.random.randint(120, 160),
+                    'examiner': 'bench',
+                    'next_appt': next_appt,
+                    })
+        return vlist
+
+    def vaccinations(self, vaccine_id, pregnancy):
+        vlist = []
+        date = pregnancy['lmp'] - datetime.timedelta(
+            days=self.random.randint(0, 365 * 6))
+        for dose in range(1, self.random.randint(*VACCINATIONS) + 1):
+            date = min(date + datetime.timedelta(
+                    days=self.random.randint(28, 400)), self.today)
+            values = {
+                'vaccine': vaccine_id,
+                'dose': dose,
+                'cdate': date,
+                'cdate_month': '',
+                'cdate_year': None,
+                }
+            if self.random.random() < APPROXIMATE_RATE:
+                values.update({
+                        'cdate': None,
+                        'cdate_month': self.random.random() < 0.5
+                            and '%02d' % date.month or '',
+                        'cdate_year': date.year,
+                        })
+            vlist.append(values)
+        return vlist
+
+    def perinatal(self, pregnancy):
+        admission = pregnancy['pregnancy_end_date'] - datetime.timedelta(
+            hours=self.random.randint(2, 14))
+        return {
+            'admission_date': admission,
+            'start_labor_mode': self.random.choice(['nsd'] * 9 + ['o']),
+            'ebl': self.random.randint(100, 600),
+            'examiner_intake': 'bench',
+            }
+
+    def labor_readings(self, perinatal):
+        start = perinatal['admission_date']
+        vlist = []
+        for i in range(self.random.randint(*LABOR_READINGS)):
+            vlist.append({
+                    'date': start + datetime.timedelta(minutes=30 * i),
+                    'dilation': min(4 + i, 10),
+                    'contractionsStr': '%d/10 %d' % (
+                        self.random.randint(2, 5), self.random.randint(30, 60)),
+                    'frequency': self.random.randint(70, 110),
+                    'f_frequency': self.random.randint(110, 170),
+                    })
+        return vlist
+
+    def postpartum_readings(self, pregnancy):
+        birth = pregnancy['pregnancy_end_date']
+        puerperium = [{
+                'date': birth + datetime.timedelta(minutes=15 * (i + 1)),
+                'systolic': self.random.randint(90, 150),
+                'diastolic': self.random.randint(60, 100),
+                'frequency': self.random.randint(60, 120),
+                'temperature': self.random.randint(360, 385) / 10.0,
+                'ebl': self.random.randint(0, 200),
+                'examiner': 'bench',
+                } for i in range(self.random.randint(*PUERPERIUM_READINGS))]
+        continued = [{
+                'date_time': birth + datetime.timedelta(hours=2 * (i + 1)),
+                'initials': 'bn',
+                'systolic': self.random.randint(90, 150),
+                'diastolic': self.random.randint(60, 100),
+                'mother_cr': self.random.randint(60, 120),
+                'mother_temp': self.random.randint(360, 385) / 10.0,
+                'ebl': self.random.randint(0, 150),
+                'baby_temp': self.random.randint(360, 380) / 10.0,
+                'baby_rr': self.random.randint(30, 70),
+                'baby_cr': self.random.randint(100, 170),
+                } for i in range(self.random.randint(*CONTINUED_READINGS))]
+        ongoing = []
+        for i in range(self.random.randint(*ONGOING_READINGS)):
+            date = birth + datetime.timedelta(days=7 * (i + 1))
+            if date.date() > self.today:
+                break
+            ongoing.append({
+                    'date_time': date,
+                    'initials': 'bn',
+                    'm_systolic': self.random.randint(90, 140),
+                    'm_diastolic': self.random.randint(60, 90),
+                    'm_cr': self.random.randint(60, 100),
+                    'm_temp': self.random.randint(360, 380) / 10.0,
+                    'b_temp': self.random.randint(360, 380) / 10.0,
+                    'b_cr': self.random.randint(110, 160),
+                    'b_rr': self.random.randint(30, 60),
+                    'm_next_visit': date.date() + datetime.timedelta(days=7),
+                    })
+        return puerperium, continued, ongoing
+
+
+class Benchmark(object):
+
+    def __init__(self, args):
+        self.args = args
+        if args.config:
+            CONFIG.update_etc(args.config)
+        if args.database:
+            os.environ['DB_NAME'] = args.database
+        # Imported once the configuration is known as importing it
+        # opens the database.
+        from trytond.tests import test_tryton
+        from trytond.transaction import Transaction
+        self.test_tryton = test_tryton
+        self.Transaction = Transaction
+        self.cohort = Cohort(args.seed, datetime.date.today())
+        self.patients = 0
+        self.results = []
+
+    def transaction(self):
+        t = self.test_tryton
+        return self.Transaction().start(t.DB_NAME, t.USER, context=t.CONTEXT)
+
+    def get(self, name, type='model'):
+        return self.test_tryton.POOL.get(name, type=type)
+
+    # --------------------------------------------------------
+    # The reference data the cohort needs: a tetanus toxoid
+    # vaccine product.
+    # --------------------------------------------------------
+    def setup(self):
+        self.test_tryton.install_module('mmc')
+        with self.transaction() as transaction:
+            Template = self.get('product.template')
+            Product = self.get('product.product')
+            Uom = self.get('product.uom')
+            products = Product.search([('is_vaccine', '=', True),
+                    ('name', '=', 'TT')])
+            if not products:
+                unit, = Uom.search([('symbol', '=', 'u')])
+                template, = Template.create([{
+                            'name': 'TT',
+                            'type': 'goods',
+                            'list_price': 0,
+                            'cost_price': 0,
+                            'default_uom': unit.id,
+                            'products': [('create', [{
+                                            'is_vaccine': True,
+                                            }])],
+                            }])
+                products = template.products
+            self.vaccine_id = products[0].id
+            self.patients = self.get('gnuhealth.patient').search_count([])
+            transaction.cursor.commit()
+
+    # --------------------------------------------------------
+    # Add patients, with their pregnancy and its records, until
+    # there are count of them. Each batch is committed.
+    # --------------------------------------------------------
+    def grow(self, count):
+        while self.patients < count:
+            size = min(BATCH_SIZE, count - self.patients)
+            with self.transaction() as transaction:
+                with transaction.set_context(mmc_skip_duplicate_check=True):
+                    self.create_batch(size)
+                transaction.cursor.commit()
+            self.patients += size
+
+    def create_batch(self, size):
+        Party = self.get('party.party')
+        Patient = self.get('gnuhealth.patient')
+        Pregnancy = self.get('gnuhealth.patient.pregnancy')
+        Evaluation = self.get('gnuhealth.patient.prenatal.evaluation')
+        Vaccination = self.get('gnuhealth.vaccination')
+        Perinatal = self.get('gnuhealth.perinatal')
+        LaborMonitor = self.get('gnuhealth.perinatal.monitor')
+        Puerperium = self.get('gnuhealth.puerperium.monitor')
+        Continued = self.get('gnuhealth.postpartum.continued.monitor')
+        Ongoing = self.get('gnuhealth.postpartum.ongoing.monitor')
+        cohort = self.cohort
+
+        parties = Party.create([cohort.party() for i in range(size)])
+        patient_values = [cohort.patient() for i in range(size)]
+        for party, values in zip(parties, patient_values):
+            values['name'] = party.id
+        patients = Patient.create(patient_values)
+
+        pregnancy_values = []
+        for patient, values in zip(patients, patient_values):
+            values = cohort.pregnancy(values['gravida'])
+            values['name'] = patient.id
+            pregnancy_values.append(values)
+        pregnancies = Pregnancy.create(pregnancy_values)
+
+        records = dict((m, []) for m in ('evaluation', 'vaccination',
+                'perinatal', 'puerperium', 'continued', 'ongoing'))
+        delivered = []
+        for pregnancy, values in zip(pregnancies, pregnancy_values):
+            for e in cohort.evaluations(values):
+                e['name'] = pregnancy.id
+                records['evaluation'].append(e)
+            for v in cohort.vaccinations(self.vaccine_id, values):
+                v['name'] = values['name']
+                records['vaccination'].append(v)
+            if values['pregnancy_end_date']:
+                perinatal = cohort.perinatal(values)
+                perinatal['name'] = pregnancy.id
+                records['perinatal'].append(perinatal)
+                delivered.append(perinatal)
+                for key, vlist in zip(('puerperium', 'continued', 'ongoing'),
+                        cohort.postpartum_readings(values)):
+                    for v in vlist:
+                        v['name'] = pregnancy.id
+                    records[key].extend(vlist)
+
+        Evaluation.create(records['evaluation'])
+        Vaccination.create(records['vaccination'])
+        labor = []
+        for perinatal, values in zip(Perinatal.create(records['perinatal']),
+                delivered):
+            for v in cohort.labor_readings(values):
+                v['name'] = perinatal.id
+                labor.append(v)
+        LaborMonitor.create(labor)
+        Puerperium.create(records['puerperium'])
+        Continued.create(records['continued'])
+        Ongoing.create(records['ongoing'])
+
+    # --------------------------------------------------------
+    # Run fn, which returns the number of records it handled,
+    # repeat times in a new transaction each time, rolled back
+    # afterwards, and keep the timings. What prepare returns,
+    # untimed, is passed to fn.
+    # --------------------------------------------------------
+    def measure(self, name, fn, prepare=None):
+        runs = []
+        records = 0
+        for i in range(self.args.repeat):
+            with self.transaction() as transaction:
+                args = prepare and (prepare(),) or ()
+                start = time.time()
+                records = fn(*args)
+                runs.append(time.time() - start)
+                transaction.cursor.rollback()
+        runs.sort()
+        result = {
+            'name': name,
+            'scale': self.patients,
+            'records': records,
+            'runs': runs,
+            'min': runs[0],
+            'median': runs[len(runs) // 2],
+            'per_record_ms': records and runs[0] * 1000.0 / records or None,
+            }
+        self.results.append(result)
+        sys.stderr.write('%-40s %8d patients %8d records %9.3fs\n'
+            % (name, self.patients, records, runs[0]))
+        return result
+
+    # --------------------------------------------------------
+    # The benchmarks. The report covers the last full month,
+    # like the one printed for the DOH every month.
+    # --------------------------------------------------------
+    def report_data(self):
+        end = self.cohort.today.replace(day=1) - datetime.timedelta(days=1)
+        return {'start_date': end.replace(day=1), 'end_date': end}
+
+    def bench_report_records(self):
+        Report = self.get('gnuhealth.patient.doh.prenatal', type='report')
+        return len(Report.get_records(
+                Report.get_pregnancy_ids(self.report_data())))
+
+    def bench_report_parse(self):
+        Report = self.get('gnuhealth.patient.doh.prenatal', type='report')
+        ActionReport = self.get('ir.action.report')
+        action_report, = ActionReport.search([
+                ('report_name', '=', Report.__name__),
+                ])
+        data = self.report_data()
+        data['pregnancy_ids'] = Report.get_pregnancy_ids(data)
+        Report.parse(action_report, None, data, {})
+        return len(data['pregnancy_ids'])
+
+    def bench_evaluation_getters(self):
+        Evaluation = self.get('gnuhealth.patient.prenatal.evaluation')
+        evaluations = Evaluation.search([], limit=TREE_LIMIT * 10)
+        Evaluation.get_patient_evaluation_data(evaluations,
+            ['gestational_age', 'bp'])
+        return len(evaluations)
+
+    def bench_vaccination_getters(self):
+        Vaccination = self.get('gnuhealth.vaccination')
+        vaccinations = Vaccination.search([], limit=TREE_LIMIT * 10)
+        Vaccination.get_display_date(vaccinations, 'display_date')
+        return len(vaccinations)
+
+    # --------------------------------------------------------
+    # Patients are created 50 at a time, with their MMC ID taken
+    # from the DOH sequence and the duplicate check, as from the
+    # registration desk over a day.
+    # --------------------------------------------------------
+    def prepare_patient_create(self):
+        Party = self.get('party.party')
+        parties = Party.create([self.cohort.party()
+                for i in range(CREATE_SAMPLE)])
+        vlist = []
+        for party in parties:
+            values = self.cohort.patient()
+            values['name'] = party.id
+            vlist.append(values)
+        return vlist
+
+    def bench_patient_create(self, vlist):
+        Patient = self.get('gnuhealth.patient')
+        for i in range(0, len(vlist), 50):
+            Patient.create(vlist[i:i + 50])
+        return len(vlist)
+
+    def tree_read(self, model):
+        def bench():
+            Model = self.get(model)
+            view = Model.fields_view_get(view_type='tree')
+            records = Model.search([], limit=TREE_LIMIT)
+            Model.read([r.id for r in records], view['fields'].keys())
+            return len(records)
+        return bench
+
+    tree_models = [
+        'gnuhealth.patient',
+        'gnuhealth.patient.pregnancy',
+        'gnuhealth.patient.prenatal.evaluation',
+        'gnuhealth.vaccination',
+        'gnuhealth.postpartum.ongoing.monitor',
+        'mmc.worklist.visit',
+        ]
+
+    def run(self):
+        self.setup()
+        scales = sorted(int(s) for s in self.args.scales.split(','))
+        for scale in scales:
+            start = time.time()
+            self.grow(scale)
+            sys.stderr.write('Cohort of %d patients ready in %.1fs\n'
+                % (scale, time.time() - start))
+            self.measure('report.get_records', self.bench_report_records)
+            self.measure('report.parse', self.bench_report_parse)
+            self.measure('evaluation.getters', self.bench_evaluation_getters)
+            self.measure('vaccination.getters',
+                self.bench_vaccination_getters)
+            self.measure('patient.create', self.bench_patient_create,
+                self.prepare_patient_create)
+            for model in self.tree_models:
+                self.measure('tree.' + model, self.tree_read(model))
+        return {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'db_type': CONFIG['db_type'],
+            'seed': self.args.seed,
+            'repeat': self.args.repeat,
+            'scales': scales,
+            'results': self.results,
+            }
+
+
+def main():
+    args = parse_args()
+    output = Benchmark(args).run()
+    if args.output:
+        with open(args.output, 'w') as fileobj:
+            json.dump(output, fileobj, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,18 @@
 from trytond.model import ModelView, ModelSingleton, ModelSQL, fields
 from trytond.pyson import Eval, Not, Bool, Or, And
 from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.backend import TableHandler
+from trytond.config import CONFIG
+from trytond.cache import Cache
+
+from .mmc_stats import instrument
+from .mmc_barangay import current_address_query, current_address_ids
 
 import datetime
 import logging
+import re
+import unicodedata
 
 __all__ = [
     'MmcReports',
@@ -23,6 +32,7 @@ __all__ = [
     'MmcPerinatal',
     'MmcPerinatalMonitor',
     'MmcPuerperiumMonitor',
+    'Party',
     'Address',
     'MmcPostpartumContinuedMonitor',
     'MmcPostpartumOngoingMonitor',
@@ -30,26 +40,489 @@ __all__ = [
 
 mmcLog = logging.getLogger('mmc')
 
+# --------------------------------------------------------
+# Gestational age as MMC staff write it, e.g. 33 or 33 2/7,
+# and blood pressure as 120/80.
+# --------------------------------------------------------
+GA_RE = re.compile(r'^(\d+)(?:\s+(\d)/7)?$')
+BP_RE = re.compile(r'^(\d+)(?:\s*/\s*(\d+))?$')
+
+# --------------------------------------------------------
+# Contractions as MMC staff write them on the labor monitor,
+# the number of contractions and optionally the number of
+# minutes they were counted over, e.g. 3, 3/10, 3 in 10 or
+# 2x5. Without minutes, 10 minutes is assumed as on the
+# partograph. The partograph notation adds the duration of
+# the contractions in seconds, e.g. 3/10 45; it is ignored.
+# --------------------------------------------------------
+CONTRACTIONS_RE = re.compile(
+    r'^\s*(\d+(?:\.\d+)?)\s*(?:(?:/|in|x|per)\s*(\d+)\s*(?:m|min|mins)?)?'
+    r'(?:\s+\d+\s*(?:s|sec|secs)?)?\s*$',
+    re.IGNORECASE)
+
+def parse_contractions(value):
+    match = CONTRACTIONS_RE.match(value or '')
+    if not match:
+        return None
+    count = float(match.group(1))
+    minutes = int(match.group(2) or 10)
+    if not minutes:
+        return None
+    return round(count * 10 / minutes, 1)
+
+# --------------------------------------------------------
+# The partograph alert line starts at the first reading of
+# the active phase, 4 cm, and rises 1 cm per hour. The
+# action line is the alert line moved 4 hours to the right.
+# Returns, for each reading of the series, 'action' when the
+# dilation is at or past the action line, 'alert' when it is
+# past the alert line and None otherwise.
+# --------------------------------------------------------
+def partograph_lines(dates, dilations):
+    result = [None] * len(dates)
+    start = None
+    for i, (date, dilation) in enumerate(zip(dates, dilations)):
+        if dilation is None:
+            continue
+        if start is None:
+            if dilation < 4:
+                continue
+            start = (date, dilation)
+        hours = (date - start[0]).total_seconds() / 3600.0
+        expected = start[1] + hours
+        if dilation <= expected - 4:
+            result[i] = 'action'
+        elif dilation < expected:
+            result[i] = 'alert'
+    return result
+
+MONTH_ABBREVS = {
+    '01': 'Jan',
+    '02': 'Feb',
+    '03': 'Mar',
+    '04': 'Apr',
+    '05': 'May',
+    '06': 'Jun',
+    '07': 'Jul',
+    '08': 'Aug',
+    '09': 'Sep',
+    '10': 'Oct',
+    '11': 'Nov',
+    '12': 'Dec',
+    }
+
 def month_num_to_abbrev(num):
-    mon = {}
-    mon['01'] = 'Jan'
-    mon['02'] = 'Feb'
-    mon['03'] = 'Mar'
-    mon['04'] = 'Apr'
-    mon['05'] = 'May'
-    mon['06'] = 'Jun'
-    mon['07'] = 'Jul'
-    mon['08'] = 'Aug'
-    mon['09'] = 'Sep'
-    mon['10'] = 'Oct'
-    mon['11'] = 'Nov'
-    mon['12'] = 'Dec'
-    return mon[num]
+    return MONTH_ABBREVS[num]
+
+# --------------------------------------------------------
+# The date a vaccination is known to have happened on and
+# how precise it is, from the exact date or the approximate
+# month and/or year, with the same priority as the display.
+# Approximate dates fall on the first day of their month or
+# year so that they sort before the exact dates within it.
+# --------------------------------------------------------
+def vaccination_effective_date(cdate, cdate_month, cdate_year):
+    try:
+        if cdate_year is not None and not cdate_month:
+            return datetime.date(cdate_year, 1, 1), 'year'
+        elif cdate_year is not None:
+            return datetime.date(cdate_year, int(cdate_month), 1), 'month'
+    except ValueError:
+        return None, None
+    if cdate:
+        return cdate, 'day'
+    return None, None
+
+# --------------------------------------------------------
+# Format a 6 digit DOH id the customary way, e.g. 13-01-23.
+# --------------------------------------------------------
+def format_doh_id(digits):
+    return "{0}-{1}-{2}".format(digits[:2], digits[2:4], digits[4:6])
+
+# --------------------------------------------------------
+# Format the DOH id and the PHIC# the way the on_change
+# methods do after the user types them in, with hyphens or
+# not. Anything that does not look right is left alone.
+# --------------------------------------------------------
+def normalize_doh_id(value):
+    doh = value.replace('-', '')
+    if ((len(doh) == 6) and (doh.isdigit())):
+        return format_doh_id(doh)
+    return value
+
+def normalize_phil_health_id(value):
+    phic = value.replace('-', '')
+    if ((len(phic) == 12) and (phic.isdigit())):
+        return "{0}-{1}-{2}".format(phic[:2], phic[2:11], phic[-1])
+    return value
+
+# --------------------------------------------------------
+# Return the digits of an id typed with or without hyphens
+# or spaces, or None if it is not an id.
+# --------------------------------------------------------
+def identifier_digits(value):
+    if not value:
+        return None
+    digits = value.strip('% ').replace('-', '').replace(' ', '')
+    if not digits.isdigit():
+        return None
+    return digits
+
+# --------------------------------------------------------
+# A loose key for a first or last name so that the usual
+# spelling variations of the same name compare equal, e.g.
+# Ma. Cristina and Maria Kristina or Villanueva and
+# Vilanueva. Only used to find possible duplicate patients.
+# --------------------------------------------------------
+NAME_KEY_SUBSTITUTIONS = [
+    ('ph', 'f'),
+    ('th', 't'),
+    ('ck', 'k'),
+    ('c', 'k'),
+    ('q', 'k'),
+    ('v', 'b'),
+    ('z', 's'),
+    ('y', 'i'),
+    ]
+NAME_KEY_ABBREVIATIONS = {
+    'ma': 'maria',
+    'sto': 'santo',
+    'sta': 'santa',
+    }
+
+def name_key(value):
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
+    words = re.findall(r'[a-z]+', value.lower())
+    if not words:
+        return None
+    words[0] = NAME_KEY_ABBREVIATIONS.get(words[0], words[0])
+    key = ''.join(words)
+    for old, new in NAME_KEY_SUBSTITUTIONS:
+        key = key.replace(old, new)
+    return re.sub(r'(.)\1+', r'\1', key)
+
+# --------------------------------------------------------
+# How much each matching piece of information counts toward
+# two patients being the same person. A pair scoring at least
+# DUPLICATE_THRESHOLD is reported. The same name alone is not
+# enough, nor is a new last name after marriage unless the
+# first name and the birth date match.
+# --------------------------------------------------------
+DUPLICATE_WEIGHTS = {
+    'phil_health_id_digits': 50,
+    'lastname_key': 20,
+    'firstname_key': 20,
+    'dob': 30,
+    'barangay': 10,
+    }
+DUPLICATE_THRESHOLD = 50
+
+def duplicate_score(a, b):
+    return sum(weight for key, weight in DUPLICATE_WEIGHTS.iteritems()
+        if a[key] and a[key] == b[key])
+
+# --------------------------------------------------------
+# The rules of validate_doh_id and validate_phil_health_id
+# for a single value. The same patterns are used by the SQL
+# CHECK constraints on the digits of the ids.
+# --------------------------------------------------------
+DOH_DIGITS_RE = re.compile(r'^[0-9]{6}$')
+PHIC_DIGITS_RE = re.compile(r'^[0-9]{12}$')
+
+def is_valid_doh_id(value):
+    if value == None or len(value) == 0:
+        return True
+    return DOH_DIGITS_RE.match(value.replace('-', '')) is not None
+
+def is_valid_phil_health_id(phil_health, value):
+    if not phil_health:
+        # if Phil Health does not apply, then we are fine.
+        return True
+    return PHIC_DIGITS_RE.match((value or '').replace('-', '')) is not None
+
+# --------------------------------------------------------
+# Return the number of days between the LMP of the pregnancy
+# and a date for rows read from a model linked to the
+# pregnancy by its name field. Stored gestational days are
+# used when the rows have them, otherwise the LMPs of all the
+# pregnancies are read at once.
+# --------------------------------------------------------
+def get_gestational_days(rows, date_field):
+    result = {}
+    missing = [r for r in rows if r.get('gestational_days') is None]
+    for row in rows:
+        result[row['id']] = row.get('gestational_days')
+    if not missing:
+        return result
+
+    Pregnancy = Pool().get('gnuhealth.patient.pregnancy')
+    lmps = dict((p['id'], p['lmp']) for p in Pregnancy.read(
+        list(set(r['name'] for r in missing if r['name'])), ['lmp']))
+    for row in missing:
+        lmp = lmps.get(row['name'])
+        if lmp and row[date_field]:
+            result[row['id']] = (row[date_field].date() - lmp).days
+    return result
 
 class MmcReports(ModelSingleton, ModelSQL, ModelView):
     'Class for custom reports'
     __name__ = 'mmc.reports'
 
+    # --------------------------------------------------------
+    # Today's clinic census. Computed with one grouped query per
+    # figure. The figures of the day are cached until one of the
+    # models they count is written, see CensusInvalidation; the
+    # postpartum count over the last 24 hours moves with the
+    # clock and is computed on every read.
+    # --------------------------------------------------------
+    census_date = fields.Function(fields.Date('As of'), 'get_census')
+    in_labor = fields.Function(fields.Integer('In labor'), 'get_census')
+    postpartum = fields.Function(fields.Integer('Postpartum monitoring',
+        help="Mothers with a postpartum reading in the last 24 hours"),
+        'get_census')
+    prenatal_today = fields.Function(fields.Integer('Prenatal visits today'),
+        'get_census')
+    deliveries_month = fields.Function(fields.Integer(
+        'Deliveries this month'), 'get_census')
+    trimester_1 = fields.Function(fields.Integer('1st trimester'),
+        'get_census')
+    trimester_2 = fields.Function(fields.Integer('2nd trimester'),
+        'get_census')
+    trimester_3 = fields.Function(fields.Integer('3rd trimester'),
+        'get_census')
+
+    _census_cache = Cache('mmc.reports.census')
+
+    @classmethod
+    def clear_census(cls):
+        cls._census_cache.clear()
+
+    @classmethod
+    @instrument('mmc.reports.get_census')
+    def get_census(cls, reports, names):
+        single = not isinstance(names, list)
+        if single:
+            names = [names]
+        today = Pool().get('ir.date').today()
+        census = cls._census_cache.get(today)
+        if census is None:
+            census = cls.compute_census(today)
+            cls._census_cache.set(today, census)
+        if 'postpartum' in names:
+            census = dict(census, postpartum=cls.compute_postpartum())
+        result = dict((name, dict((r.id, census[name]) for r in reports))
+            for name in names)
+        if single:
+            return result[names[0]]
+        return result
+
+    @staticmethod
+    def compute_census(today):
+        pool = Pool()
+        Pregnancy = pool.get('gnuhealth.patient.pregnancy')
+        Perinatal = pool.get('gnuhealth.perinatal')
+        Evaluation = pool.get('gnuhealth.patient.prenatal.evaluation')
+        cursor = Transaction().cursor
+        census = {'census_date': today}
+
+        # --------------------------------------------------------
+        # Mothers admitted for labor whose pregnancy is not over.
+        # --------------------------------------------------------
+        cursor.execute('SELECT COUNT(DISTINCT p.id) '
+            'FROM "' + Perinatal._table + '" l '
+            'JOIN "' + Pregnancy._table + '" p ON p.id = l.name '
+            'WHERE p.current_pregnancy')
+        census['in_labor'] = cursor.fetchone()[0]
+
+        cursor.execute('SELECT COUNT(*) FROM "' + Evaluation._table + '" '
+            'WHERE eval_date_only = %s', (today,))
+        census['prenatal_today'] = cursor.fetchone()[0]
+
+        month_start = datetime.datetime(today.year, today.month, 1)
+        cursor.execute('SELECT COUNT(*) FROM "' + Pregnancy._table + '" '
+            'WHERE pregnancy_end_date >= %s AND pregnancy_end_date < %s',
+            (month_start, datetime.datetime.combine(
+                    today + datetime.timedelta(days=1), datetime.time())))
+        census['deliveries_month'] = cursor.fetchone()[0]
+
+        # --------------------------------------------------------
+        # Current pregnancies by trimester of the LMP: up to 13
+        # weeks, up to 27 weeks and after.
+        # --------------------------------------------------------
+        for i in (1, 2, 3):
+            census['trimester_%d' % i] = 0
+        cursor.execute('SELECT CASE WHEN lmp > %s THEN 1 '
+                'WHEN lmp > %s THEN 2 ELSE 3 END AS trimester, COUNT(*) '
+            'FROM "' + Pregnancy._table + '" '
+            'WHERE current_pregnancy AND lmp IS NOT NULL '
+            'GROUP BY trimester',
+            (today - datetime.timedelta(weeks=13),
+                today - datetime.timedelta(weeks=27)))
+        for trimester, count in cursor.fetchall():
+            census['trimester_%d' % trimester] = count
+        return census
+
+    # --------------------------------------------------------
+    # Mothers with any postpartum reading in the last day.
+    # --------------------------------------------------------
+    @staticmethod
+    def compute_postpartum():
+        pool = Pool()
+        cursor = Transaction().cursor
+        since = datetime.datetime.now() - datetime.timedelta(days=1)
+        queries = []
+        for model, date_field in (
+                ('gnuhealth.puerperium.monitor', 'date'),
+                ('gnuhealth.postpartum.continued.monitor', 'date_time'),
+                ('gnuhealth.postpartum.ongoing.monitor', 'date_time')):
+            queries.append('SELECT name FROM "' + pool.get(model)._table
+                + '" WHERE "' + date_field + '" >= %s')
+        cursor.execute('SELECT COUNT(DISTINCT name) FROM ('
+            + ' UNION '.join(queries) + ') AS monitored', (since,) * 3)
+        return cursor.fetchone()[0]
+
+
+# --------------------------------------------------------
+# Clear the cached census whenever a model it counts is
+# created, written or deleted.
+# --------------------------------------------------------
+class CensusInvalidation(object):
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(CensusInvalidation, cls).create(vlist)
+        Pool().get('mmc.reports').clear_census()
+        return records
+
+    @classmethod
+    def write(cls, records, values):
+        super(CensusInvalidation, cls).write(records, values)
+        Pool().get('mmc.reports').clear_census()
+
+    @classmethod
+    def delete(cls, records):
+        super(CensusInvalidation, cls).delete(records)
+        Pool().get('mmc.reports').clear_census()
+
+# --------------------------------------------------------
+# Queue the pregnancies of the postpartum monitors that are
+# created, written or deleted for the next alert check. The
+# new readings are queued by id so that the check can add
+# them to the state of the pregnancy, a change of the older
+# ones has the state rebuilt.
+# --------------------------------------------------------
+class AlertQueue(object):
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(AlertQueue, cls).create(vlist)
+        Pool().get('mmc.alert.pending').add_readings(cls.__name__,
+            [r for r in records if r.name])
+        return records
+
+    @classmethod
+    def write(cls, records, values):
+        pregnancy_ids = [r.name.id for r in records if r.name]
+        super(AlertQueue, cls).write(records, values)
+        pregnancy_ids += [r.name.id for r in records if r.name]
+        Pool().get('mmc.alert.pending').add(pregnancy_ids)
+
+    @classmethod
+    def delete(cls, records):
+        pregnancy_ids = [r.name.id for r in records if r.name]
+        super(AlertQueue, cls).delete(records)
+        Pool().get('mmc.alert.pending').add(pregnancy_ids)
+
+# --------------------------------------------------------
+# Pregnancies closed for more than mmc_archive_days days are
+# archived together with their evaluations and monitors. The
+# searches leave the archived records out, as the day-to-day
+# lists do, except:
+#  - the searches on the link to the parent record, name, by
+#    which the patient chart and the history of a pregnancy
+#    read their records;
+#  - the searches on archived itself;
+#  - the searches on id, as the domain validation of Tryton
+#    and the Many2One fields check the ids they already have;
+#  - with mmc_include_archived in the context.
+# Reads by id and the SQL reports see every record.
+# --------------------------------------------------------
+ARCHIVE_DAYS = 730
+
+
+def domain_fields(domain):
+    '''
+    Return the names of the fields a search domain is on.
+    '''
+    names = set()
+    for clause in domain:
+        if not isinstance(clause, (list, tuple)):
+            continue
+        if clause and isinstance(clause[0], basestring) \
+                and clause[0] not in ('AND', 'OR'):
+            names.add(clause[0].split('.', 1)[0])
+        else:
+            names |= domain_fields(clause)
+    return names
+
+
+class ArchiveMixin(object):
+
+    archived = fields.Boolean('Archived', readonly=True, select=True)
+
+    # --------------------------------------------------------
+    # The Many2One to the record whose archived flag the new
+    # records take, None for the pregnancy.
+    # --------------------------------------------------------
+    _archive_parent = 'name'
+
+    @staticmethod
+    def default_archived():
+        return False
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        super(ArchiveMixin, cls).__register__(module_name)
+        cursor.execute('UPDATE "' + cls._table + '" SET archived = %s '
+            'WHERE archived IS NULL', (False,))
+
+        # --------------------------------------------------------
+        # The day-to-day searches only look at the records that
+        # are not archived.
+        # --------------------------------------------------------
+        if CONFIG['db_type'] == 'postgresql':
+            index = cls._table + '_active_name_index'
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                (index,))
+            if not cursor.fetchone():
+                cursor.execute('CREATE INDEX "' + index + '" '
+                    'ON "' + cls._table + '" (name) WHERE NOT archived')
+
+    @classmethod
+    def search(cls, domain, *args, **kwargs):
+        if not (Transaction().context.get('mmc_include_archived')
+                or domain_fields(domain) & set(['archived', 'name', 'id'])):
+            domain = [domain, ('archived', '=', False)]
+        return super(ArchiveMixin, cls).search(domain, *args, **kwargs)
+
+    @classmethod
+    def create(cls, vlist):
+        if cls._archive_parent:
+            Parent = Pool().get(cls._fields[cls._archive_parent].model_name)
+            parent_ids = list(set(v[cls._archive_parent] for v in vlist
+                    if v.get(cls._archive_parent)))
+            archived = set(p['id'] for p in Parent.read(parent_ids,
+                    ['archived']) if p['archived'])
+            if archived:
+                vlist = [dict(v, archived=True)
+                    if v.get(cls._archive_parent) in archived else v
+                    for v in vlist]
+        return super(ArchiveMixin, cls).create(vlist)
 
 class MmcSequences(ModelSingleton, ModelSQL, ModelView):
     "Sequences for MMC"
@@ -60,6 +533,61 @@ class MmcSequences(ModelSingleton, ModelSQL, ModelView):
         'DOH Sequence', domain=[('code', '=', 'mmc.doh')],
         required=True))
 
+    # --------------------------------------------------------
+    # Reserve a block of consecutive DOH ids with a single
+    # update of the sequence instead of one get_id() call per
+    # patient. The sequence row stays locked until the end of
+    # the transaction, as it would with get_id(), and if the
+    # transaction is rolled back the numbers go back to the
+    # sequence. Numbers already taken by a DOH id typed in by
+    # hand, or in exclude, the ids typed in for the patients
+    # created along, are skipped and logged as gaps.
+    # --------------------------------------------------------
+    @classmethod
+    def reserve_doh_ids(cls, count, exclude=None):
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        Patient = pool.get('gnuhealth.patient')
+        cursor = Transaction().cursor
+
+        if count <= 0:
+            return []
+        sequence_id = cls(1).doh_sequence.id
+        if CONFIG['db_type'] == 'postgresql':
+            cursor.execute('SELECT id FROM "' + Sequence._table + '" '
+                'WHERE id = %s FOR UPDATE', (sequence_id,))
+        sequence = Sequence(sequence_id)
+
+        # --------------------------------------------------------
+        # The sequence is prefixed with the current 4 digit year
+        # but we need only a two digit year and we like it formatted
+        # a certain way. The prefix is the same for the whole
+        # block.
+        # --------------------------------------------------------
+        prefix = Sequence._process(sequence.prefix)
+        suffix = Sequence._process(sequence.suffix)
+        padding = '%%0%sd' % (sequence.padding or 0)
+
+        doh_ids = []
+        number = sequence.number_next
+        while len(doh_ids) < count:
+            block = []
+            for i in range(count - len(doh_ids)):
+                seq = prefix + padding % number + suffix
+                block.append(format_doh_id(seq[2:]))
+                number += sequence.number_increment
+            taken = set(p.doh_id for p in
+                Patient.search([('doh_id', 'in', block)]))
+            taken |= set(block) & set(exclude or [])
+            if taken:
+                mmcLog.warning('DOH ids already in use were skipped: %s'
+                    % ', '.join(sorted(taken)))
+            doh_ids.extend(d for d in block if d not in taken)
+
+        with Transaction().set_user(0):
+            Sequence.write([sequence], {'number_next': number})
+        return doh_ids
+
 
 
 class MmcPatientData(ModelSQL, ModelView):
@@ -161,18 +689,53 @@ class MmcPatientData(ModelSQL, ModelView):
         help="Dept of Health id", required=False,
         select=True, on_change=['doh_id'])
 
+    # --------------------------------------------------------
+    # Digits only copies of the MMC ID and the PHIC# so that
+    # the ids can be found however they are typed in. These are
+    # indexed for prefix searches and kept up to date by create
+    # and write.
+    # --------------------------------------------------------
+    doh_id_digits = fields.Char('MMC ID digits', readonly=True, select=True)
+    phil_health_id_digits = fields.Char('PHIC# digits', readonly=True,
+        select=True)
+
+    # --------------------------------------------------------
+    # Tetanus toxoid status, see mmc.tetanus.status.
+    # --------------------------------------------------------
+    tt_status = fields.Function(fields.Char('TT status'), 'get_tt_status')
+
+    @classmethod
+    @instrument('gnuhealth.patient.get_tt_status')
+    def get_tt_status(cls, patients, name):
+        Status = Pool().get('mmc.tetanus.status')
+        statuses = Status.get_statuses([p.id for p in patients])
+        result = {}
+        for patient in patients:
+            status = statuses.get(patient.id)
+            if not status or not status['doses']:
+                result[patient.id] = 'No TT'
+                continue
+            text = 'TT%s' % status['doses']
+            if status['lifetime']:
+                text += ', protected for life'
+            elif status['protected_until']:
+                text += ', protected until %s' % \
+                    status['protected_until'].strftime("%m/%d/%Y")
+            if status['next_due']:
+                text += ', next dose from %s' % \
+                    status['next_due'].strftime("%m/%d/%Y")
+            if status['pdd'] and not status['protected_at_delivery']:
+                text += ', NOT protected at delivery'
+            result[patient.id] = text
+        return result
+
     # --------------------------------------------------------
     # Format DOH ID # in the customary fashion after the user
     # types it in. User can type with hyphens or not. But don't
     # change anything unless the field seems correct.
     # --------------------------------------------------------
     def on_change_doh_id(self):
-        origFld = self.doh_id
-        doh = origFld.replace('-', '')
-        val = origFld
-        if ((len(doh) == 6) and (doh.isdigit())):
-            val = "{0}-{1}-{2}".format(doh[:2], doh[2:4], doh[4:6])
-        return {'doh_id': val}
+        return {'doh_id': normalize_doh_id(self.doh_id)}
 
 
     # --------------------------------------------------------
@@ -181,45 +744,32 @@ class MmcPatientData(ModelSQL, ModelView):
     # change anything unless the field seems correct.
     # --------------------------------------------------------
     def on_change_phil_health_id(self):
-        origFld = self.phil_health_id
-        phic = origFld.replace('-', '')
-        val = origFld
-        if ((len(phic) == 12) and (phic.isdigit())):
-            val = "{0}-{1}-{2}".format(phic[:2], phic[2:11], phic[-1])
-        return {'phil_health_id': val}
+        return {'phil_health_id': normalize_phil_health_id(self.phil_health_id)}
 
     # --------------------------------------------------------
-    # Validate the DOH ID.
+    # Validate the DOH ID of every record of the batch, not
+    # only the first one.
     # --------------------------------------------------------
     @staticmethod
+    @instrument('gnuhealth.patient.validate_doh_id')
     def validate_doh_id(ids):
-        for patientData in ids:
-            if (patientData.doh_id == None or len(patientData.doh_id) == 0):
-                return True
-            doh = patientData.doh_id.replace('-', '')
-            if (len(doh) != 6):
-                return False
-            if (not doh.isdigit()):
-                return False
-            return True
+        invalid = [p for p in ids if not is_valid_doh_id(p.doh_id)]
+        for patientData in invalid:
+            mmcLog.info('MMC ID %s is not 6 numbers' % patientData.doh_id)
+        return not invalid
 
     # --------------------------------------------------------
-    # Validate the PHIC #.
+    # Validate the PHIC # of every record of the batch.
     # --------------------------------------------------------
     @staticmethod
+    @instrument('gnuhealth.patient.validate_phil_health_id')
     def validate_phil_health_id(ids):
-        for patientData in ids:
-            if not patientData.phil_health:
-                # if Phil Health does not apply, then we are fine.
-                return True
-            phic = patientData.phil_health_id.replace('-', '')
-            if (len(phic) != 12):
-                mmcLog.info('Phil Health id is not the correct length')
-                return False
-            if (not phic.isdigit()):
-                mmcLog.info('Phil Health id is not a number')
-                return False
-            return True
+        invalid = [p for p in ids
+            if not is_valid_phil_health_id(p.phil_health, p.phil_health_id)]
+        for patientData in invalid:
+            mmcLog.info('Phil Health id of patient %s is not 12 numbers'
+                % patientData.id)
+        return not invalid
 
     # --------------------------------------------------------
     # Set a reasonable default sex for a maternity clinic.
@@ -249,6 +799,13 @@ class MmcPatientData(ModelSQL, ModelView):
         cls._sql_constraints = [
             ('name_uniq', 'UNIQUE(name)', 'The Patient already exists !'),
             ('doh_uniq', 'UNIQUE(doh_id)', 'The MMC ID already exists !'),
+            ('doh_id_format', "CHECK(doh_id IS NULL OR doh_id = '' OR "
+                "REPLACE(doh_id, '-', '') ~ '" + DOH_DIGITS_RE.pattern + "')",
+                'Department of Health ID must be 6 numbers'),
+            ('phil_health_id_format', "CHECK(phil_health IS NOT TRUE OR "
+                "REPLACE(COALESCE(phil_health_id, ''), '-', '') ~ '"
+                + PHIC_DIGITS_RE.pattern + "')",
+                'PHIC# must be 12 numbers'),
         ]
         cls._constraints += [
             ('validate_phil_health_id', 'phil_health_id_format'),
@@ -256,7 +813,9 @@ class MmcPatientData(ModelSQL, ModelView):
         ]
         cls._error_messages.update({
             'phil_health_id_format': 'PHIC# must be 12 numbers',
-            'validate_doh_id_format': 'Department of Health ID must be 6 numbers'
+            'validate_doh_id_format': 'Department of Health ID must be 6 numbers',
+            'possible_duplicate': 'Patient "%s" may already be registered '
+                'as %s.',
         })
 
     # --------------------------------------------------------
@@ -265,23 +824,267 @@ class MmcPatientData(ModelSQL, ModelView):
     # number or a blank value.
     # --------------------------------------------------------
     @classmethod
+    @instrument('gnuhealth.patient.create')
     def create(cls, vlist):
-        sequence_obj = Pool().get('ir.sequence')
         config_obj = Pool().get('mmc.sequences')
         vlist = [x.copy() for x in vlist]
+        missing = [values for values in vlist if not values.get('doh_id')]
+        given = [values['doh_id'] for values in vlist
+            if values.get('doh_id')]
+        for values, doh_id in zip(missing,
+                config_obj.reserve_doh_ids(len(missing), exclude=given)):
+            values['doh_id'] = doh_id
         for values in vlist:
-            if not values.get('doh_id'):
-                config = config_obj(1)
-                # --------------------------------------------------------
-                # The sequence is prefixed with the current 4 digit year
-                # but we need only a two digit year and we like it formatted
-                # a certain way.
-                # --------------------------------------------------------
-                seq = sequence_obj.get_id(config.doh_sequence.id)[2:]
-                values['doh_id'] = "{0}-{1}-{2}".format(seq[:2], seq[2:4], seq[4:6])
+            cls.set_identifier_digits(values)
+        if not Transaction().context.get('mmc_skip_duplicate_check'):
+            cls.check_duplicates(vlist)
 
         return super(MmcPatientData, cls).create(vlist)
 
+    @classmethod
+    def write(cls, patients, values):
+        values = cls.set_identifier_digits(values.copy())
+        super(MmcPatientData, cls).write(patients, values)
+        if set(values) & set(['dob', 'gravida', 'para', 'abortions',
+                    'stillbirths', 'rh']):
+            Pool().get('mmc.risk.code').update_patients(
+                [p.id for p in patients])
+
+    @staticmethod
+    def set_identifier_digits(values):
+        for field in ('doh_id', 'phil_health_id'):
+            if field in values:
+                values[field + '_digits'] = \
+                    identifier_digits(values[field]) or None
+        return values
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        super(MmcPatientData, cls).__register__(module_name)
+
+        # --------------------------------------------------------
+        # The birth date is a blocking key of the duplicate checks.
+        # --------------------------------------------------------
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['dob'], 'add')
+
+        # --------------------------------------------------------
+        # Fill in the digits of the existing patients the same way
+        # as set_identifier_digits(), NULL when the id is empty or
+        # not made of digits.
+        # --------------------------------------------------------
+        for field in ('doh_id', 'phil_health_id'):
+            cursor.execute('UPDATE "' + cls._table + '" '
+                'SET ' + field + '_digits = NULL '
+                'WHERE ' + field + '_digits = %s', ('',))
+            cursor.execute('SELECT id, ' + field + ' '
+                'FROM "' + cls._table + '" '
+                'WHERE ' + field + ' IS NOT NULL '
+                'AND ' + field + '_digits IS NULL')
+            for patient_id, value in cursor.fetchall():
+                digits = identifier_digits(value)
+                if digits:
+                    cursor.execute('UPDATE "' + cls._table + '" '
+                        'SET ' + field + '_digits = %s WHERE id = %s',
+                        (digits, patient_id))
+
+        # --------------------------------------------------------
+        # The default PostgreSQL index can not be used by LIKE
+        # 'prefix%' unless the database uses the C locale.
+        # --------------------------------------------------------
+        if CONFIG['db_type'] == 'postgresql':
+            for field in ('doh_id_digits', 'phil_health_id_digits'):
+                index = cls._table + '_' + field + '_prefix'
+                cursor.execute('SELECT 1 FROM pg_indexes '
+                    'WHERE indexname = %s', (index,))
+                if not cursor.fetchone():
+                    cursor.execute('CREATE INDEX "' + index + '" ON "'
+                        + cls._table + '" (' + field
+                        + ' varchar_pattern_ops)')
+
+    # --------------------------------------------------------
+    # Let the front desk find a patient by typing the start of
+    # the MMC ID or PHIC#, with or without the hyphens.
+    # --------------------------------------------------------
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        domain = super(MmcPatientData, cls).search_rec_name(name, clause)
+        digits = None
+        if clause[1] in ('=', 'like', 'ilike'):
+            digits = identifier_digits(clause[2])
+        if not digits:
+            return domain
+        return ['OR',
+            domain,
+            ('doh_id_digits', 'like', digits + '%'),
+            ('phil_health_id_digits', 'like', digits + '%'),
+            ]
+
+    # --------------------------------------------------------
+    # Read what is compared to find duplicate patients, the
+    # blocking keys of the name of the party, the birth date,
+    # the PHIC# digits and the barangay of the current address,
+    # for the patients matching the where clause.
+    # --------------------------------------------------------
+    @classmethod
+    def read_duplicate_keys(cls, where='', params=None):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        cursor = Transaction().cursor
+
+        current, current_params = current_address_query(Address._table)
+        cursor.execute('SELECT p.id, pp.id, pp.lastname_key, '
+                'pp.firstname_key, p.dob, p.phil_health_id_digits, '
+                'LOWER(TRIM(a.barangay)), pp.lastname, pp.name, p.doh_id '
+            'FROM "' + cls._table + '" p '
+            'JOIN "' + Party._table + '" pp ON pp.id = p.name '
+            'LEFT JOIN (' + current + ') ca ON ca.party = pp.id '
+            'LEFT JOIN "' + Address._table + '" a ON a.id = ca.id '
+            + (where and 'WHERE ' + where or '')
+            + ' ORDER BY p.id', current_params + list(params or []))
+        return [{
+                'id': row[0],
+                'party': row[1],
+                'lastname_key': row[2],
+                'firstname_key': row[3],
+                'dob': row[4],
+                'phil_health_id_digits': row[5],
+                'barangay': row[6],
+                'rec_name': '%s, %s (%s)' % (row[7] or '', row[8] or '',
+                    row[9] or ''),
+                } for row in cursor.fetchall()]
+
+    # --------------------------------------------------------
+    # Return the existing patients that are likely the same
+    # person as each of the values about to be created, as a
+    # list of (patient, score) sorted best first per values.
+    # Only the rows sharing a blocking key with the new
+    # patients are read, using the indexes on the name keys,
+    # the birth date and the PHIC# digits.
+    # --------------------------------------------------------
+    @classmethod
+    def get_duplicate_candidates(cls, vlist):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        cursor = Transaction().cursor
+
+        party_ids = list(set(v['name'] for v in vlist if v.get('name')))
+        parties = dict((p['id'], p) for p in Party.read(party_ids,
+                ['lastname_key', 'firstname_key']))
+        barangays = dict((a['party'],
+                (a['barangay'] or '').strip().lower() or None)
+            for a in Address.read(current_address_ids(party_ids).values(),
+                ['party', 'barangay']))
+
+        new = []
+        for values in vlist:
+            party = parties.get(values.get('name'), {})
+            new.append({
+                    'party': values.get('name'),
+                    'lastname_key': party.get('lastname_key'),
+                    'firstname_key': party.get('firstname_key'),
+                    'dob': values.get('dob'),
+                    'phil_health_id_digits':
+                        values.get('phil_health_id_digits'),
+                    'barangay': barangays.get(values.get('name')),
+                    })
+
+        def in_clause(column, values):
+            values = list(set(v for v in values if v))
+            if not values:
+                return '1 = 0', []
+            return (column + ' IN (' + ','.join(('%s',) * len(values))
+                + ')'), values
+
+        lastnames = in_clause('pp.lastname_key',
+            [n['lastname_key'] for n in new])
+        firstnames = in_clause('pp.firstname_key',
+            [n['firstname_key'] for n in new])
+        dobs = in_clause('p.dob', [n['dob'] for n in new])
+        phics = in_clause('p.phil_health_id_digits',
+            [n['phil_health_id_digits'] for n in new])
+        where = ('(' + lastnames[0] + ' AND (' + firstnames[0] + ' OR '
+            + dobs[0] + ')) OR (' + firstnames[0] + ' AND ' + dobs[0]
+            + ') OR ' + phics[0])
+        params = (lastnames[1] + firstnames[1] + dobs[1] + firstnames[1]
+            + dobs[1] + phics[1])
+        existing = cls.read_duplicate_keys(where, params)
+
+        result = []
+        for values in new:
+            candidates = [(row, duplicate_score(values, row))
+                for row in existing if row['party'] != values['party']]
+            candidates = [c for c in candidates
+                if c[1] >= DUPLICATE_THRESHOLD]
+            candidates.sort(key=lambda c: -c[1])
+            result.append(candidates)
+        return result
+
+    # --------------------------------------------------------
+    # Warn the user before registering a patient that is likely
+    # already registered. The warning can be accepted by the
+    # user if they are different people after all.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument('gnuhealth.patient.check_duplicates')
+    def check_duplicates(cls, vlist):
+        Party = Pool().get('party.party')
+        candidates = cls.get_duplicate_candidates(vlist)
+        for values, matches in zip(vlist, candidates):
+            if not matches:
+                continue
+            party = Party(values['name'])
+            cls.raise_user_warning('mmc_duplicate_patient_%s_%s'
+                % (values['name'], matches[0][0]['id']),
+                'possible_duplicate', (party.rec_name,
+                    ', '.join(m['rec_name'] for m, _ in matches[:3])))
+
+    # --------------------------------------------------------
+    # Scan all the patients in one pass for clusters of records
+    # that are likely the same person. Pairs are only scored
+    # within a block sharing a key so that the scan does not
+    # compare every patient to every other one. Returns a list
+    # of clusters, each a list of patient rows.
+    # --------------------------------------------------------
+    @classmethod
+    def find_duplicate_clusters(cls):
+        rows = cls.read_duplicate_keys()
+
+        blocks = {}
+        for row in rows:
+            keys = [
+                ('name', row['lastname_key'], row['firstname_key']),
+                ('last_dob', row['lastname_key'], row['dob']),
+                ('first_dob', row['firstname_key'], row['dob']),
+                ('phic', row['phil_health_id_digits']),
+                ]
+            for key in keys:
+                if all(key[1:]):
+                    blocks.setdefault(key, []).append(row)
+
+        # Union-find over the pairs scoring above the threshold.
+        parent = {}
+        def find(i):
+            while parent.get(i, i) != i:
+                parent[i] = parent.get(parent[i], parent[i])
+                i = parent[i]
+            return i
+
+        for block in blocks.itervalues():
+            for i, a in enumerate(block):
+                for b in block[i + 1:]:
+                    if duplicate_score(a, b) >= DUPLICATE_THRESHOLD:
+                        parent[find(a['id'])] = find(b['id'])
+
+        clusters = {}
+        for row in rows:
+            if row['id'] in parent:
+                clusters.setdefault(find(row['id']), []).append(row)
+        return sorted(clusters.values(), key=lambda c: c[0]['id'])
+
 
 
 
@@ -309,6 +1112,34 @@ class MmcPatientDiseaseInfo(ModelSQL, ModelView):
 
     is_active = fields.Boolean('Active condition')
 
+    # --------------------------------------------------------
+    # The active conditions are part of the risk codes of the
+    # pregnancies of the patient.
+    # --------------------------------------------------------
+    @staticmethod
+    def update_risk_codes(patient_ids):
+        Pool().get('mmc.risk.code').update_patients(patient_ids)
+
+    @classmethod
+    @instrument('gnuhealth.patient.disease.create')
+    def create(cls, vlist):
+        diseases = super(MmcPatientDiseaseInfo, cls).create(vlist)
+        cls.update_risk_codes([d.name.id for d in diseases if d.name])
+        return diseases
+
+    @classmethod
+    def write(cls, diseases, values):
+        patient_ids = [d.name.id for d in diseases if d.name]
+        super(MmcPatientDiseaseInfo, cls).write(diseases, values)
+        if set(values) & set(['name', 'pathology', 'is_active']):
+            patient_ids += [d.name.id for d in diseases if d.name]
+            cls.update_risk_codes(patient_ids)
+
+    @classmethod
+    def delete(cls, diseases):
+        patient_ids = [d.name.id for d in diseases if d.name]
+        super(MmcPatientDiseaseInfo, cls).delete(diseases)
+        cls.update_risk_codes(patient_ids)
 
 
 
@@ -374,28 +1205,100 @@ class MmcVaccination(ModelSQL, ModelView):
     display_date = fields.Function(fields.Char('Date'), 'get_display_date')
 
     # --------------------------------------------------------
-    # Choose either cdate or the cdate_month and/or cdate_year
-    # fields to create an appropriate display.
+    # The date of the vaccination whichever way it was entered
+    # and its precision, stored so that vaccinations can be
+    # ordered and searched by date in SQL. Kept up to date by
+    # create and write.
     # --------------------------------------------------------
-    @staticmethod
-    def get_display_date(ids, name):
-        result = {}
-        for vacc in ids:
-            if name == 'display_date':
-                if vacc.cdate_year is not None and (vacc.cdate_month is None or
-                        len(vacc.cdate_month) == 0):
-                    result[vacc.id] = "{0}".format(vacc.cdate_year)
-                elif vacc.cdate_year != None and vacc.cdate_month != None and vacc.cdate_month != '':
-                    result[vacc.id] = "{0} {1}".format(month_num_to_abbrev(vacc.cdate_month), vacc.cdate_year)
-                else:
-                    result[vacc.id] = "{0}".format(vacc.cdate)
+    effective_date = fields.Date('Effective Date', readonly=True, select=True)
+    date_precision = fields.Selection([
+        (None, ''),
+        ('day', 'Day'),
+        ('month', 'Month'),
+        ('year', 'Year'),
+        ], 'Date Precision', readonly=True, sort=False)
 
+    # --------------------------------------------------------
+    # Display the effective date as precisely as it is known.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument('gnuhealth.vaccination.get_display_date')
+    def get_display_date(cls, vaccinations, name):
+        result = {}
+        for vacc in cls.read([v.id for v in vaccinations],
+                ['effective_date', 'date_precision']):
+            edate = vacc['effective_date']
+            precision = vacc['date_precision']
+            if precision == 'year':
+                result[vacc['id']] = "{0}".format(edate.year)
+            elif precision == 'month':
+                result[vacc['id']] = "{0} {1}".format(
+                    MONTH_ABBREVS['%02d' % edate.month], edate.year)
+            else:
+                result[vacc['id']] = "{0}".format(edate)
         return result
 
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        super(MmcVaccination, cls).__register__(module_name)
+
+        # --------------------------------------------------------
+        # The vaccination history of a patient in date order.
+        # --------------------------------------------------------
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['name', 'effective_date'], 'add')
+
+        cls.update_effective_dates(where='date_precision IS NULL')
+
+    # --------------------------------------------------------
+    # Set the effective date of the vaccinations in the values
+    # to create, or recompute it for the given ids or the rows
+    # matching a where clause, grouping the rows sharing a date
+    # into one UPDATE.
+    # --------------------------------------------------------
+    @staticmethod
+    def set_effective_date(values):
+        values['effective_date'], values['date_precision'] = \
+            vaccination_effective_date(values.get('cdate'),
+                values.get('cdate_month'), values.get('cdate_year'))
+        return values
+
+    @classmethod
+    def update_effective_dates(cls, ids=None, where=None):
+        cursor = Transaction().cursor
+        sql = ('SELECT id, cdate, cdate_month, cdate_year '
+            'FROM "' + cls._table + '"')
+        rows = []
+        if ids is not None:
+            for i in range(0, len(ids), cursor.IN_MAX):
+                sub_ids = ids[i:i + cursor.IN_MAX]
+                cursor.execute(sql + ' WHERE id IN ('
+                    + ','.join(('%s',) * len(sub_ids)) + ')', sub_ids)
+                rows += cursor.fetchall()
+        else:
+            cursor.execute(sql + (where and ' WHERE ' + where or ''))
+            rows = cursor.fetchall()
+
+        groups = {}
+        for vacc_id, cdate, cdate_month, cdate_year in rows:
+            if isinstance(cdate, basestring):
+                cdate = datetime.datetime.strptime(cdate, '%Y-%m-%d').date()
+            groups.setdefault(vaccination_effective_date(cdate, cdate_month,
+                    cdate_year), []).append(vacc_id)
+        for (edate, precision), group_ids in groups.iteritems():
+            for i in range(0, len(group_ids), cursor.IN_MAX):
+                sub_ids = group_ids[i:i + cursor.IN_MAX]
+                cursor.execute('UPDATE "' + cls._table + '" '
+                    'SET effective_date = %s, date_precision = %s '
+                    'WHERE id IN (' + ','.join(('%s',) * len(sub_ids)) + ')',
+                    [edate, precision] + sub_ids)
+
     # --------------------------------------------------------
     # Revise validation to not require the next_dose_date field.
     # --------------------------------------------------------
     @staticmethod
+    @instrument('gnuhealth.vaccination.validate_next_dose_date')
     def validate_next_dose_date (ids):
         for vaccine_data in ids:
             if vaccine_data.next_dose_date is None:
@@ -409,6 +1312,54 @@ class MmcVaccination(ModelSQL, ModelView):
     def default_cdate():
         return datetime.datetime.now()
 
+    # --------------------------------------------------------
+    # Keep the prenatal report facts of the patients'
+    # pregnancies up to date.
+    # --------------------------------------------------------
+    @staticmethod
+    def update_report_facts(patient_ids):
+        pool = Pool()
+        Pregnancy = pool.get('gnuhealth.patient.pregnancy')
+        Fact = pool.get('mmc.prenatal.report.fact')
+        patient_ids = list(set(i for i in patient_ids if i))
+        if patient_ids:
+            Fact.update_pregnancies([p.id for p in
+                Pregnancy.search([('name', 'in', patient_ids)])])
+
+    # --------------------------------------------------------
+    # Keep the tetanus status of the patients up to date.
+    # --------------------------------------------------------
+    @staticmethod
+    def update_tetanus_status(patient_ids):
+        Pool().get('mmc.tetanus.status').update_patients(patient_ids)
+
+    @classmethod
+    @instrument('gnuhealth.vaccination.create')
+    def create(cls, vlist):
+        vlist = [cls.set_effective_date(x.copy()) for x in vlist]
+        vaccinations = super(MmcVaccination, cls).create(vlist)
+        patient_ids = [v.name.id for v in vaccinations if v.name]
+        cls.update_report_facts(patient_ids)
+        cls.update_tetanus_status(patient_ids)
+        return vaccinations
+
+    @classmethod
+    def write(cls, vaccinations, values):
+        patient_ids = [v.name.id for v in vaccinations if v.name]
+        super(MmcVaccination, cls).write(vaccinations, values)
+        if set(values) & set(['cdate', 'cdate_month', 'cdate_year']):
+            cls.update_effective_dates(ids=[v.id for v in vaccinations])
+        patient_ids += [v.name.id for v in vaccinations if v.name]
+        cls.update_report_facts(patient_ids)
+        cls.update_tetanus_status(patient_ids)
+
+    @classmethod
+    def delete(cls, vaccinations):
+        patient_ids = [v.name.id for v in vaccinations if v.name]
+        super(MmcVaccination, cls).delete(vaccinations)
+        cls.update_report_facts(patient_ids)
+        cls.update_tetanus_status(patient_ids)
+
     @staticmethod
     def default_cdate_month():
         return ''
@@ -443,7 +1394,8 @@ class MmcMedicationTemplate(ModelSQL, ModelView):
 
 
 
-class MmcPatientPregnancy(ModelSQL, ModelView):
+class MmcPatientPregnancy(CensusInvalidation, ArchiveMixin, ModelSQL,
+        ModelView):
     'Patient Pregnancy'
     __name__ = 'gnuhealth.patient.pregnancy'
 
@@ -529,45 +1481,172 @@ class MmcPatientPregnancy(ModelSQL, ModelView):
     def default_fetuses():
         return 1
 
+    # --------------------------------------------------------
+    # The LMP, consult dates, etc. are part of the prenatal
+    # report facts.
+    # --------------------------------------------------------
+    @classmethod
+    def write(cls, pregnancies, values):
+        patient_ids = [p.name.id for p in pregnancies if p.name]
+        archived = []
+        if set(values) - cls._archive_keep:
+            archived = [p.id for p in pregnancies if p.archived]
+        super(MmcPatientPregnancy, cls).write(pregnancies, values)
+        # An archived pregnancy that is edited is back in use.
+        if archived:
+            cls.set_archived(archived, False)
+        if 'lmp' in values:
+            Pool().get('gnuhealth.patient.prenatal.evaluation'
+                ).update_gestational_data(
+                    pregnancy_ids=[p.id for p in pregnancies])
+        Fact = Pool().get('mmc.prenatal.report.fact')
+        if set(values) & set(Fact._pregnancy_fields):
+            Fact.update_pregnancies([p.id for p in pregnancies])
+        if set(values) & set(['name', 'lmp', 'apdd', 'current_pregnancy']):
+            patient_ids += [p.name.id for p in pregnancies if p.name]
+            Pool().get('mmc.tetanus.status').update_patients(patient_ids)
+        if set(values) & set(['name', 'lmp', 'current_pregnancy']):
+            Pool().get('mmc.risk.code').update_pregnancies(
+                [p.id for p in pregnancies])
+
+    # --------------------------------------------------------
+    # The due date of the current pregnancy is part of the
+    # tetanus status of the patient and every pregnancy has its
+    # risk codes.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument('gnuhealth.patient.pregnancy.create')
+    def create(cls, vlist):
+        pregnancies = super(MmcPatientPregnancy, cls).create(vlist)
+        Pool().get('mmc.tetanus.status').update_patients(
+            [p.name.id for p in pregnancies if p.name])
+        Pool().get('mmc.risk.code').update_pregnancies(
+            [p.id for p in pregnancies])
+        return pregnancies
 
+    @classmethod
+    def delete(cls, pregnancies):
+        patient_ids = [p.name.id for p in pregnancies if p.name]
+        super(MmcPatientPregnancy, cls).delete(pregnancies)
+        Pool().get('mmc.tetanus.status').update_patients(patient_ids)
 
-class MmcPrenatalEvaluation(ModelSQL, ModelView):
-    'Prenatal and Antenatal Evaluations'
-    __name__ = 'gnuhealth.patient.prenatal.evaluation'
-
-    @staticmethod
-    def get_patient_evaluation_data(ids, name):
-        result = {}
-
-        for evaluation_data in ids:
-
-            if name == 'gestational_weeks':
-                gestational_age = datetime.datetime.date(evaluation_data.evaluation_date) - evaluation_data.name.lmp
-
-                result[evaluation_data.id] = (gestational_age.days)/7
-
-            if name == 'gestational_days':
-                gestational_age = datetime.datetime.date(evaluation_data.evaluation_date) - evaluation_data.name.lmp
+    _archive_parent = None
 
-                result[evaluation_data.id] = gestational_age.days
+    # --------------------------------------------------------
+    # The fields whose change does not bring an archived
+    # pregnancy back in use: the archived flag itself and the
+    # bookkeeping fields that are written for the patient and
+    # not as an edit of the pregnancy.
+    # --------------------------------------------------------
+    _archive_keep = set(['archived', 'current_pregnancy', 'write_uid',
+            'write_date'])
 
-            if name == 'gestational_age':
-                gestational_age = datetime.datetime.date(evaluation_data.evaluation_date) - evaluation_data.name.lmp
+    # --------------------------------------------------------
+    # The models holding the records of a pregnancy, with the
+    # model in between for the labor monitor.
+    # --------------------------------------------------------
+    _archive_children = [
+        ('gnuhealth.patient.prenatal.evaluation', None),
+        ('gnuhealth.perinatal', None),
+        ('gnuhealth.perinatal.monitor', 'gnuhealth.perinatal'),
+        ('gnuhealth.puerperium.monitor', None),
+        ('gnuhealth.postpartum.continued.monitor', None),
+        ('gnuhealth.postpartum.ongoing.monitor', None),
+        ]
 
-                result[evaluation_data.id] = "{0} {1}/7".format((gestational_age.days)/7, (gestational_age.days)%7)
+    # --------------------------------------------------------
+    # Set the archived flag of the pregnancies and of all their
+    # records, one update per table.
+    # --------------------------------------------------------
+    @classmethod
+    def set_archived(cls, pregnancy_ids, archived):
+        pool = Pool()
+        cursor = Transaction().cursor
+        for i in range(0, len(pregnancy_ids), cursor.IN_MAX):
+            sub_ids = pregnancy_ids[i:i + cursor.IN_MAX]
+            in_clause = 'IN (' + ','.join(('%s',) * len(sub_ids)) + ')'
+            cursor.execute('UPDATE "' + cls._table + '" SET archived = %s '
+                'WHERE id ' + in_clause, [archived] + sub_ids)
+            for model, parent in cls._archive_children:
+                where = 'name ' + in_clause
+                if parent:
+                    where = ('name IN (SELECT id FROM "'
+                        + pool.get(parent)._table + '" WHERE ' + where + ')')
+                cursor.execute('UPDATE "' + pool.get(model)._table + '" '
+                    'SET archived = %s WHERE ' + where,
+                    [archived] + sub_ids)
+
+    # --------------------------------------------------------
+    # Archive the pregnancies that ended more than days ago, by
+    # default mmc_archive_days from the configuration. Run every
+    # week by cron. Returns the number of pregnancies archived.
+    # --------------------------------------------------------
+    @classmethod
+    def archive_closed(cls, days=None):
+        cursor = Transaction().cursor
+        if days is None:
+            days = int(CONFIG.get('mmc_archive_days') or ARCHIVE_DAYS)
+        before = datetime.datetime.now() - datetime.timedelta(days=days)
+        cursor.execute('SELECT id FROM "' + cls._table + '" '
+            'WHERE (current_pregnancy = %s OR current_pregnancy IS NULL) '
+            'AND pregnancy_end_date < %s AND archived = %s',
+            (False, before, False))
+        pregnancy_ids = [row[0] for row in cursor.fetchall()]
+        cls.set_archived(pregnancy_ids, True)
+        if pregnancy_ids:
+            mmcLog.info('Archived %d pregnancies closed before %s'
+                % (len(pregnancy_ids), before.date()))
+        return len(pregnancy_ids)
+
+
+
+class MmcPrenatalEvaluation(CensusInvalidation, ArchiveMixin, ModelSQL,
+        ModelView):
+    'Prenatal and Antenatal Evaluations'
+    __name__ = 'gnuhealth.patient.prenatal.evaluation'
 
-            if name == 'bp':
-                result[evaluation_data.id] = "{0}/{1}".format(evaluation_data.systolic, evaluation_data.diastolic)
+    # --------------------------------------------------------
+    # Compute all the requested fields for all the evaluations
+    # in one pass. The evaluation columns are read at once and
+    # the LMPs are only loaded, all together, for the evaluations
+    # whose gestational days have not been stored yet.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument(
+        'gnuhealth.patient.prenatal.evaluation.get_patient_evaluation_data')
+    def get_patient_evaluation_data(cls, evaluations, names):
+        single = not isinstance(names, list)
+        if single:
+            names = [names]
+        result = dict((name, {}) for name in names)
+
+        rows = cls.read([e.id for e in evaluations], ['name',
+                'evaluation_date', 'gestational_days', 'systolic',
+                'diastolic'])
+
+        if 'gestational_age' in names:
+            days = get_gestational_days(rows, 'evaluation_date')
+            for row in rows:
+                ga = days[row['id']]
+                if ga is None:
+                    result['gestational_age'][row['id']] = ''
+                else:
+                    result['gestational_age'][row['id']] = \
+                        "{0} {1}/7".format(ga // 7, ga % 7)
 
-            if name == 'eval_date_only':
-                result[evaluation_data.id] = datetime.datetime.date(evaluation_data.evaluation_date)
+        if 'bp' in names:
+            for row in rows:
+                result['bp'][row['id']] = "{0}/{1}".format(row['systolic'],
+                    row['diastolic'])
 
+        if single:
+            return result[names[0]]
         return result
 
     # --------------------------------------------------------
     # Change the field labels.
     # --------------------------------------------------------
-    evaluation_date = fields.DateTime('Admission', required=True)
+    evaluation_date = fields.DateTime('Admission', required=True, select=True)
     fetus_heart_rate = fields.Integer('FHT', help="Fetus heart rate")
     fundal_height = fields.Integer('FH',
         help="Distance between the symphysis pubis and the uterine fundus " \
@@ -585,7 +1664,8 @@ class MmcPrenatalEvaluation(ModelSQL, ModelView):
     temperature = fields.Float('Temp (C)', help='Temperature in celcius of the mother')
     position = fields.Char("Position", help="Baby's position")
     examiner = fields.Char('Examiner', help="Who did the examination?")
-    next_appt = fields.Date('Next Scheduled Date', help="Date of next prenatal exam")
+    next_appt = fields.Date('Next Scheduled Date', help="Date of next prenatal exam",
+        select=True)
 
     # --------------------------------------------------------
     # Add a gestational_age field. Health_gyneco has two similar
@@ -597,36 +1677,224 @@ class MmcPrenatalEvaluation(ModelSQL, ModelView):
     # to that.
     # --------------------------------------------------------
     gestational_age = fields.Function(fields.Char('GA'),
-        'get_patient_evaluation_data')
+        'get_patient_evaluation_data', searcher='search_gestational_age')
+
+    # --------------------------------------------------------
+    # Store the health_gyneco gestational fields so that the
+    # evaluations can be searched and sorted by them in the
+    # database. They are maintained by update_gestational_data().
+    # --------------------------------------------------------
+    gestational_weeks = fields.Integer('Gestational Weeks', readonly=True,
+        select=True)
+    gestational_days = fields.Integer('Gestational days', readonly=True,
+        select=True)
 
     # --------------------------------------------------------
     # Add a convenience function that displays the blood pressure
     # as one field instead of two. Useful for the tree view.
     # --------------------------------------------------------
-    bp = fields.Function(fields.Char('B/P'), 'get_patient_evaluation_data')
+    bp = fields.Function(fields.Char('B/P'), 'get_patient_evaluation_data',
+        searcher='search_bp')
 
     # --------------------------------------------------------
     # Add a display field for the tree view that only shows the
-    # admission date and not the time.
+    # admission date and not the time. Stored so that it can be
+    # searched and sorted upon.
     # --------------------------------------------------------
-    eval_date_only = fields.Function(fields.Date('Date'), 'get_patient_evaluation_data')
+    eval_date_only = fields.Date('Date', readonly=True, select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        super(MmcPrenatalEvaluation, cls).__register__(module_name)
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['name', 'eval_date_only'], 'add')
+
+        # --------------------------------------------------------
+        # Fill in the stored fields of the existing evaluations.
+        # --------------------------------------------------------
+        cls.update_gestational_data(where='eval_date_only IS NULL')
+
+    # --------------------------------------------------------
+    # Compute the stored date and gestational fields from the
+    # evaluation date and the LMP of the pregnancy. This is done
+    # with one UPDATE in PostgreSQL, as evaluation_date::date - lmp.
+    # The other databases do not have the same date arithmetic so
+    # the values are computed in Python.
+    # --------------------------------------------------------
+    @classmethod
+    def update_gestational_data(cls, ids=None, pregnancy_ids=None,
+            where=None):
+        Pregnancy = Pool().get('gnuhealth.patient.pregnancy')
+        cursor = Transaction().cursor
+
+        clauses = []
+        if where:
+            clauses.append(([where], []))
+        for column, values in (('id', ids), ('name', pregnancy_ids)):
+            if values is None:
+                continue
+            values = list(set(values))
+            for i in range(0, len(values), cursor.IN_MAX):
+                sub_values = values[i:i + cursor.IN_MAX]
+                clauses.append((['"' + column + '" IN (' +
+                    ','.join(('%s',) * len(sub_values)) + ')'], sub_values))
+        if not clauses:
+            return
+
+        if CONFIG['db_type'] == 'postgresql':
+            lmp = ('(SELECT p.lmp FROM "' + Pregnancy._table + '" p '
+                'WHERE p.id = "' + cls._table + '".name)')
+            for conditions, params in clauses:
+                cursor.execute('UPDATE "' + cls._table + '" SET '
+                    'eval_date_only = CAST(evaluation_date AS DATE), '
+                    'gestational_days = CAST(evaluation_date AS DATE) - '
+                        + lmp + ', '
+                    'gestational_weeks = FLOOR((CAST(evaluation_date AS DATE) - '
+                        + lmp + ') / 7.0) '
+                    'WHERE ' + ' AND '.join(conditions), params)
+            return
+
+        for conditions, params in clauses:
+            cursor.execute('SELECT e.id, e.evaluation_date, p.lmp '
+                'FROM "' + cls._table + '" e '
+                'LEFT JOIN "' + Pregnancy._table + '" p ON p.id = e.name '
+                'WHERE ' + ' AND '.join('e.' + c for c in conditions),
+                params)
+            for evaluation_id, evaluation_date, lmp in cursor.fetchall():
+                if isinstance(evaluation_date, basestring):
+                    evaluation_date = datetime.datetime.strptime(
+                        evaluation_date[:19], '%Y-%m-%d %H:%M:%S')
+                if isinstance(lmp, basestring):
+                    lmp = datetime.datetime.strptime(lmp, '%Y-%m-%d').date()
+                date = evaluation_date and evaluation_date.date()
+                days = None
+                if date and lmp:
+                    days = (date - lmp).days
+                cursor.execute('UPDATE "' + cls._table + '" SET '
+                    'eval_date_only = %s, gestational_days = %s, '
+                    'gestational_weeks = %s WHERE id = %s',
+                    (date, days, (days // 7) if days is not None else None,
+                        evaluation_id))
+
+    # --------------------------------------------------------
+    # Search the gestational age the way MMC staff write it,
+    # e.g. 33 or 33 2/7. A number of weeks alone matches every
+    # day of that week.
+    # --------------------------------------------------------
+    @classmethod
+    def search_gestational_age(cls, name, clause):
+        _, operator, value = clause
+        value = (value or '').strip('% ')
+        match = GA_RE.match(value)
+        if not match:
+            return [('id', '=', -1)]
+        weeks = int(match.group(1))
+        days = match.group(2)
+        if operator in ('=', 'like', 'ilike'):
+            if days is None:
+                return [('gestational_days', '>=', weeks * 7),
+                    ('gestational_days', '<', (weeks + 1) * 7)]
+            operator = '='
+        elif operator not in ('!=', '<', '<=', '>', '>='):
+            return [('id', '=', -1)]
+        if days is None:
+            days = 6 if operator in ('<=', '>') else 0
+        return [('gestational_days', operator, weeks * 7 + int(days))]
+
+    # --------------------------------------------------------
+    # Search the blood pressure as systolic/diastolic, e.g.
+    # 140/90, or the systolic alone.
+    # --------------------------------------------------------
+    @classmethod
+    def search_bp(cls, name, clause):
+        _, operator, value = clause
+        value = (value or '').strip('% ')
+        match = BP_RE.match(value)
+        if not match:
+            return [('id', '=', -1)]
+        if operator in ('like', 'ilike'):
+            operator = '='
+        elif operator not in ('=', '!=', '<', '<=', '>', '>='):
+            return [('id', '=', -1)]
+        domain = [('systolic', operator, int(match.group(1)))]
+        if match.group(2):
+            domain.append(('diastolic', operator, int(match.group(2))))
+        return domain
+
+    # --------------------------------------------------------
+    # Keep the prenatal report facts of the pregnancies up to
+    # date.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument('gnuhealth.patient.prenatal.evaluation.create')
+    def create(cls, vlist):
+        evaluations = super(MmcPrenatalEvaluation, cls).create(vlist)
+        cls.update_gestational_data(ids=[e.id for e in evaluations])
+        pregnancy_ids = [e.name.id for e in evaluations if e.name]
+        Pool().get('mmc.prenatal.report.fact').update_pregnancies(
+            pregnancy_ids)
+        Pool().get('mmc.risk.code').update_pregnancies(pregnancy_ids)
+        Pool().get('mmc.worklist.visit').update_pregnancies(pregnancy_ids)
+        return evaluations
 
+    @classmethod
+    def write(cls, evaluations, values):
+        pregnancy_ids = [e.name.id for e in evaluations if e.name]
+        super(MmcPrenatalEvaluation, cls).write(evaluations, values)
+        if 'evaluation_date' in values or 'name' in values:
+            cls.update_gestational_data(ids=[e.id for e in evaluations])
+        pregnancy_ids += [e.name.id for e in evaluations if e.name]
+        Pool().get('mmc.prenatal.report.fact').update_pregnancies(
+            pregnancy_ids)
+        if set(values) & set(['name', 'systolic', 'diastolic']):
+            Pool().get('mmc.risk.code').update_pregnancies(pregnancy_ids)
+        if set(values) & set(['name', 'evaluation_date', 'next_appt']):
+            Pool().get('mmc.worklist.visit').update_pregnancies(
+                pregnancy_ids)
 
+    @classmethod
+    def delete(cls, evaluations):
+        pregnancy_ids = [e.name.id for e in evaluations if e.name]
+        super(MmcPrenatalEvaluation, cls).delete(evaluations)
+        Pool().get('mmc.prenatal.report.fact').update_pregnancies(
+            pregnancy_ids)
+        Pool().get('mmc.risk.code').update_pregnancies(pregnancy_ids)
+        Pool().get('mmc.worklist.visit').update_pregnancies(pregnancy_ids)
 
 
-class MmcPerinatal(ModelSQL, ModelView):
-    'Perinatal Information'
-    __name__ = 'gnuhealth.perinatal'
 
-    @staticmethod
-    def get_perinatal_information(ids, name):
-        result = {}
 
-        for perinatal_data in ids:
-            if name == 'gestational_weeks':
-                gestational_age = datetime.datetime.date(perinatal_data.admission_date) - perinatal_data.name.lmp
-                result[perinatal_data.id] = (gestational_age.days)/7
+class MmcPerinatal(CensusInvalidation, ArchiveMixin, ModelSQL,
+        ModelView):
+    'Perinatal Information'
+    __name__ = 'gnuhealth.perinatal'
 
+    # --------------------------------------------------------
+    # Compute all the requested fields for all the records in
+    # one pass with the LMPs of the pregnancies loaded at once.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument('gnuhealth.perinatal.get_perinatal_information')
+    def get_perinatal_information(cls, perinatals, names):
+        single = not isinstance(names, list)
+        if single:
+            names = [names]
+        result = dict((name, {}) for name in names)
+
+        rows = cls.read([p.id for p in perinatals],
+            ['name', 'admission_date'])
+        days = get_gestational_days(rows, 'admission_date')
+        for row in rows:
+            ga = days[row['id']]
+            if 'gestational_weeks' in names:
+                result['gestational_weeks'][row['id']] = \
+                    (ga // 7) if ga is not None else None
+            if 'gestational_days' in names:
+                result['gestational_days'][row['id']] = ga
+
+        if single:
+            return result[names[0]]
         return result
 
     # --------------------------------------------------------
@@ -672,7 +1940,7 @@ class MmcPerinatal(ModelSQL, ModelView):
 
 
 
-class MmcPerinatalMonitor(ModelSQL, ModelView):
+class MmcPerinatalMonitor(ArchiveMixin, ModelSQL, ModelView):
     'Perinatal Monitor'
     __name__ = 'gnuhealth.perinatal.monitor'
 
@@ -704,6 +1972,14 @@ class MmcPerinatalMonitor(ModelSQL, ModelView):
     # --------------------------------------------------------
     contractionsStr = fields.Char('Contractions', size=12)
 
+    # --------------------------------------------------------
+    # Contractions per 10 minutes parsed from contractionsStr,
+    # stored for the partograph. Kept up to date by create and
+    # write.
+    # --------------------------------------------------------
+    contractions_per_10 = fields.Float('Contractions per 10 min',
+        digits=(3, 1), readonly=True)
+
     # --------------------------------------------------------
     # Default field values.
     # --------------------------------------------------------
@@ -711,9 +1987,128 @@ class MmcPerinatalMonitor(ModelSQL, ModelView):
     def default_fetus_position():
         return 'c'
 
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        super(MmcPerinatalMonitor, cls).__register__(module_name)
+
+        # --------------------------------------------------------
+        # The readings of a labor in time order.
+        # --------------------------------------------------------
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['name', 'date'], 'add')
+
+        # --------------------------------------------------------
+        # Parse the contractions of the existing readings, one
+        # UPDATE per distinct value.
+        # --------------------------------------------------------
+        cursor.execute('SELECT DISTINCT "contractionsStr" FROM "'
+            + cls._table + '" WHERE "contractionsStr" IS NOT NULL '
+            'AND contractions_per_10 IS NULL')
+        for value, in cursor.fetchall():
+            parsed = parse_contractions(value)
+            if parsed is not None:
+                cursor.execute('UPDATE "' + cls._table + '" '
+                    'SET contractions_per_10 = %s '
+                    'WHERE "contractionsStr" = %s', (parsed, value))
+
+    @staticmethod
+    def set_contractions(values):
+        if 'contractionsStr' in values:
+            values['contractions_per_10'] = \
+                parse_contractions(values['contractionsStr'])
+        return values
+
+    @classmethod
+    @instrument('gnuhealth.perinatal.monitor.create')
+    def create(cls, vlist):
+        vlist = [cls.set_contractions(x.copy()) for x in vlist]
+        return super(MmcPerinatalMonitor, cls).create(vlist)
+
+    @classmethod
+    def write(cls, monitors, values):
+        values = cls.set_contractions(values.copy())
+        super(MmcPerinatalMonitor, cls).write(monitors, values)
+
+    # --------------------------------------------------------
+    # The columns of the time series of a labor and the field
+    # they come from.
+    # --------------------------------------------------------
+    _series_columns = [
+        ('fht', 'f_frequency'),
+        ('cr', 'frequency'),
+        ('dilation', 'dilation'),
+        ('contractions', 'contractions_per_10'),
+        ('systolic', 'systolic'),
+        ('diastolic', 'diastolic'),
+        ]
+
+    # --------------------------------------------------------
+    # Return the readings of a perinatal record as aligned lists,
+    # {'date': [...], 'fht': [...], 'cr': [...], ...}, in time
+    # order with one query and no record instances. With
+    # max_points, long labors are downsampled into at most that
+    # many equal time buckets: the dilation is the highest of the
+    # bucket, the others the average, and the date the first one
+    # of the bucket. The partograph key holds partograph_lines()
+    # of the returned series.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument('gnuhealth.perinatal.monitor.get_series')
+    def get_series(cls, perinatal_id, max_points=None):
+        cursor = Transaction().cursor
+        names = [name for name, _ in cls._series_columns]
+        cursor.execute('SELECT "date", '
+            + ', '.join(column for _, column in cls._series_columns)
+            + ' FROM "' + cls._table + '" '
+            'WHERE name = %s AND "date" IS NOT NULL ORDER BY "date", id',
+            (perinatal_id,))
+        rows = cursor.fetchall()
+        if max_points and len(rows) > max_points:
+            rows = cls.downsample(rows, max_points)
+
+        series = {'date': [row[0] for row in rows]}
+        for i, name in enumerate(names):
+            series[name] = [row[i + 1] for row in rows]
+        series['partograph'] = partograph_lines(series['date'],
+            series['dilation'])
+        return series
+
+    @classmethod
+    def downsample(cls, rows, max_points):
+        first, last = rows[0][0], rows[-1][0]
+        width = ((last - first).total_seconds() / max_points) or 1
+        dilation = [name for name, _ in cls._series_columns].index(
+            'dilation') + 1
+
+        buckets = []
+        current = None
+        for row in rows:
+            bucket = min(int((row[0] - first).total_seconds() / width),
+                max_points - 1)
+            if bucket != current:
+                buckets.append([])
+                current = bucket
+            buckets[-1].append(row)
+
+        result = []
+        for bucket in buckets:
+            values = [bucket[0][0]]
+            for i in range(1, len(bucket[0])):
+                column = [row[i] for row in bucket if row[i] is not None]
+                if not column:
+                    values.append(None)
+                elif i == dilation:
+                    values.append(max(column))
+                else:
+                    values.append(sum(column) / float(len(column)))
+            result.append(tuple(values))
+        return result
+
 
 
-class MmcPuerperiumMonitor(ModelSQL, ModelView):
+class MmcPuerperiumMonitor(CensusInvalidation, AlertQueue, ArchiveMixin,
+        ModelSQL, ModelView):
     'Puerperium Monitor'
     __name__ = 'gnuhealth.puerperium.monitor'
 
@@ -741,19 +2136,81 @@ class MmcPuerperiumMonitor(ModelSQL, ModelView):
     # --------------------------------------------------------
     eval_date_only = fields.Function(fields.Date('Date'), 'get_patient_evaluation_data')
 
-    @staticmethod
-    def get_patient_evaluation_data(ids, name):
-        result = {}
+    # --------------------------------------------------------
+    # Compute all the requested fields in one pass.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument('gnuhealth.puerperium.monitor.get_patient_evaluation_data')
+    def get_patient_evaluation_data(cls, monitors, names):
+        single = not isinstance(names, list)
+        if single:
+            names = [names]
+        result = dict((name, {}) for name in names)
+
+        for row in cls.read([m.id for m in monitors],
+                ['date', 'systolic', 'diastolic']):
+            if 'bp' in names:
+                result['bp'][row['id']] = "{0}/{1}".format(row['systolic'],
+                    row['diastolic'])
+            if 'eval_date_only' in names:
+                result['eval_date_only'][row['id']] = \
+                    row['date'] and row['date'].date()
+
+        if single:
+            return result[names[0]]
+        return result
 
-        for evaluation_data in ids:
-            if name == 'bp':
-                result[evaluation_data.id] = "{0}/{1}".format(evaluation_data.systolic, evaluation_data.diastolic)
 
-            if name == 'eval_date_only':
-                result[evaluation_data.id] = datetime.datetime.date(evaluation_data.date)
 
-        return result
+class Party(ModelSQL, ModelView):
+    'Party'
+    __name__ = 'party.party'
+
+    # --------------------------------------------------------
+    # Name keys of the first and last names, see name_key(),
+    # used as indexed blocking keys to find duplicate patients.
+    # --------------------------------------------------------
+    lastname_key = fields.Char('Last name key', readonly=True, select=True)
+    firstname_key = fields.Char('First name key', readonly=True, select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().cursor
+        super(Party, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['lastname_key', 'firstname_key'], 'add')
+
+        cursor.execute('SELECT id, lastname, name FROM "' + cls._table + '" '
+            'WHERE lastname_key IS NULL AND firstname_key IS NULL')
+        for party_id, lastname, name in cursor.fetchall():
+            cursor.execute('UPDATE "' + cls._table + '" '
+                'SET lastname_key = %s, firstname_key = %s WHERE id = %s',
+                (name_key(lastname), name_key(name), party_id))
 
+    @classmethod
+    @instrument('party.party.create')
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        for values in vlist:
+            values['lastname_key'] = name_key(values.get('lastname'))
+            values['firstname_key'] = name_key(values.get('name'))
+        return super(Party, cls).create(vlist)
+
+    @classmethod
+    def write(cls, parties, values):
+        super(Party, cls).write(parties, values)
+        if 'name' in values or 'lastname' in values:
+            keys = {}
+            for party in cls.read([p.id for p in parties],
+                    ['lastname', 'name']):
+                keys.setdefault((name_key(party['lastname']),
+                        name_key(party['name'])), []).append(party['id'])
+            for (lastname_key, firstname_key), ids in keys.iteritems():
+                super(Party, cls).write(cls.browse(ids), {
+                        'lastname_key': lastname_key,
+                        'firstname_key': firstname_key,
+                        })
 
 
 class Address(ModelSQL, ModelView):
@@ -772,6 +2229,10 @@ class Address(ModelSQL, ModelView):
     # Add new fields.
     # --------------------------------------------------------
     barangay = fields.Char('Barangay', help="The patient's barangay")
+    barangay_ref = fields.Many2One('mmc.barangay', 'Barangay from list',
+        select=True, ondelete='RESTRICT', on_change=['barangay_ref'],
+        help="The barangay of the list, matched from the barangay when "
+        "left empty")
     is_agdao = fields.Boolean('Is from Agdao?',
         help="Check if the patient is from Agdao")
 
@@ -780,9 +2241,34 @@ class Address(ModelSQL, ModelView):
         # TODO: do this right.
         return 'Davao City'
 
+    def on_change_barangay_ref(self):
+        if self.barangay_ref:
+            return {'barangay': self.barangay_ref.name}
+        return {}
+
+    # --------------------------------------------------------
+    # Link the address to the barangay of the list its free
+    # text barangay matches, if any. Changing or clearing the
+    # text unlinks it from a barangay it no longer matches.
+    # --------------------------------------------------------
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        Pool().get('mmc.barangay').match_addresses(vlist)
+        return super(Address, cls).create(vlist)
+
+    @classmethod
+    def write(cls, addresses, values):
+        if 'barangay' in values and 'barangay_ref' not in values:
+            values = values.copy()
+            values['barangay_ref'] = None
+            Pool().get('mmc.barangay').match_addresses([values])
+        super(Address, cls).write(addresses, values)
+
 
 
-class MmcPostpartumContinuedMonitor(ModelSQL, ModelView):
+class MmcPostpartumContinuedMonitor(CensusInvalidation, AlertQueue,
+        ArchiveMixin, ModelSQL, ModelView):
     'Postpartum Continued Monitor'
     __name__ = 'gnuhealth.postpartum.continued.monitor'
 
@@ -816,6 +2302,8 @@ class MmcPostpartumContinuedMonitor(ModelSQL, ModelView):
     bp = fields.Function(fields.Char('B/P'), 'get_patient_evaluation_data')
 
     @staticmethod
+    @instrument(
+        'gnuhealth.postpartum.continued.monitor.get_patient_evaluation_data')
     def get_patient_evaluation_data(ids, name):
         result = {}
         for evaluation_data in ids:
@@ -828,7 +2316,8 @@ class MmcPostpartumContinuedMonitor(ModelSQL, ModelView):
 
 
 
-class MmcPostpartumOngoingMonitor(ModelSQL, ModelView):
+class MmcPostpartumOngoingMonitor(CensusInvalidation, AlertQueue, ArchiveMixin,
+        ModelSQL, ModelView):
     'Postpartum Ongoing Monitor'
     __name__ = 'gnuhealth.postpartum.ongoing.monitor'
 
@@ -874,7 +2363,33 @@ class MmcPostpartumOngoingMonitor(ModelSQL, ModelView):
     m_stool = fields.Char('Stool', size=70)
     m_ss_infection = fields.Char('SS Infection', size=70)
     m_other = fields.Char('Other', size=70)
-    m_next_visit = fields.DateTime('Next Scheduled Visit')
+    m_next_visit = fields.DateTime('Next Scheduled Visit', select=True)
+
+    # --------------------------------------------------------
+    # Keep the visit worklist of the pregnancy up to date.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument('gnuhealth.postpartum.ongoing.monitor.create')
+    def create(cls, vlist):
+        monitors = super(MmcPostpartumOngoingMonitor, cls).create(vlist)
+        Pool().get('mmc.worklist.visit').update_pregnancies(
+            [m.name.id for m in monitors if m.name])
+        return monitors
+
+    @classmethod
+    def write(cls, monitors, values):
+        pregnancy_ids = [m.name.id for m in monitors if m.name]
+        super(MmcPostpartumOngoingMonitor, cls).write(monitors, values)
+        if set(values) & set(['name', 'date_time', 'm_next_visit']):
+            pregnancy_ids += [m.name.id for m in monitors if m.name]
+            Pool().get('mmc.worklist.visit').update_pregnancies(
+                pregnancy_ids)
+
+    @classmethod
+    def delete(cls, monitors):
+        pregnancy_ids = [m.name.id for m in monitors if m.name]
+        super(MmcPostpartumOngoingMonitor, cls).delete(monitors)
+        Pool().get('mmc.worklist.visit').update_pregnancies(pregnancy_ids)
 
 
 
@@ -0,0 +1,443 @@
+# -------------------------------------------------------------------------------
+# mmc_alerts.py
+#
+# Vital sign alerts over the postpartum monitoring of the mothers and
+# their babies.
+# -------------------------------------------------------------------------------
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.backend import TableHandler
+from trytond.wizard import Wizard, StateView, Button
+from trytond.config import CONFIG
+
+import datetime
+import logging
+import operator
+
+__all__ = [
+    'MmcAlertPending',
+    'MmcAlertState',
+    'MmcAlertCheckResult',
+    'MmcAlertCheck',
+    ]
+
+mmcLog = logging.getLogger('mmcAlerts')
+
+# --------------------------------------------------------
+# The postpartum monitors, the field holding the date of the
+# reading and the field of each vital sign column.
+# --------------------------------------------------------
+ALERT_SOURCES = [
+    ('gnuhealth.puerperium.monitor', 'date', {
+        'systolic': 'systolic',
+        'diastolic': 'diastolic',
+        'mother_cr': 'frequency',
+        'mother_temp': 'temperature',
+        'ebl': 'ebl',
+        }),
+    ('gnuhealth.postpartum.continued.monitor', 'date_time', {
+        'systolic': 'systolic',
+        'diastolic': 'diastolic',
+        'mother_cr': 'mother_cr',
+        'mother_temp': 'mother_temp',
+        'ebl': 'ebl',
+        'baby_temp': 'baby_temp',
+        'baby_rr': 'baby_rr',
+        'baby_cr': 'baby_cr',
+        }),
+    ('gnuhealth.postpartum.ongoing.monitor', 'date_time', {
+        'systolic': 'm_systolic',
+        'diastolic': 'm_diastolic',
+        'mother_cr': 'm_cr',
+        'mother_temp': 'm_temp',
+        'baby_temp': 'b_temp',
+        'baby_rr': 'b_rr',
+        'baby_cr': 'b_cr',
+        }),
+    ]
+
+# --------------------------------------------------------
+# The threshold rules: (code, column, operator, value). A
+# code is raised by a reading on which one of its rules
+# fires and cleared by a reading that has a value for one
+# of its columns and on which none of them fires.
+# --------------------------------------------------------
+ALERT_RULES = [
+    ('BP-HIGH', 'systolic', '>=', 140),
+    ('BP-HIGH', 'diastolic', '>=', 90),
+    ('BP-LOW', 'systolic', '<', 90),
+    ('M-TACHY', 'mother_cr', '>', 100),
+    ('M-FEVER', 'mother_temp', '>=', 38.0),
+    ('EBL-HIGH', 'ebl', '>=', 500),
+    ('B-FEVER', 'baby_temp', '>=', 37.5),
+    ('B-COLD', 'baby_temp', '<', 36.5),
+    ('B-TACHYPNEA', 'baby_rr', '>', 60),
+    ('B-BRADY', 'baby_cr', '<', 100),
+    ('B-TACHY', 'baby_cr', '>', 160),
+    ]
+
+ALERT_OPERATORS = {
+    '<': operator.lt,
+    '>': operator.gt,
+    '>=': operator.ge,
+    }
+
+# --------------------------------------------------------
+# Trend rules: EBL-RISING after the EBL went up on
+# EBL_RISES consecutive readings, PPH while the EBL of the
+# readings of the last PPH_HOURS hours reaches PPH_EBL ml.
+# --------------------------------------------------------
+EBL_RISES = 2
+PPH_EBL = 500
+PPH_HOURS = 24
+
+
+def new_state():
+    return {
+        'alerts': set(),
+        'last_ebl': None,
+        'ebl_rises': 0,
+        'ebl_total': 0,
+        'ebl_window': [],
+        'last_reading': None,
+        }
+
+
+def apply_reading(state, reading):
+    '''
+    Update the running state of a pregnancy, a dict as returned by
+    new_state(), with one reading, a dict of column values. The readings
+    must be applied in the order of their dates.
+    '''
+    alerts = state['alerts']
+    checked = set()
+    fired = set()
+    for code, column, op, threshold in ALERT_RULES:
+        value = reading.get(column)
+        if value is None:
+            continue
+        checked.add(code)
+        if ALERT_OPERATORS[op](value, threshold):
+            fired.add(code)
+    alerts -= checked - fired
+    alerts |= fired
+
+    ebl = reading.get('ebl')
+    if ebl is not None:
+        if state['last_ebl'] is not None and ebl > state['last_ebl']:
+            state['ebl_rises'] += 1
+        else:
+            state['ebl_rises'] = 0
+        state['last_ebl'] = ebl
+        state['ebl_total'] += ebl
+        if state['ebl_rises'] >= EBL_RISES:
+            alerts.add('EBL-RISING')
+        else:
+            alerts.discard('EBL-RISING')
+
+    date = reading.get('date')
+    if date:
+        window = state['ebl_window']
+        if ebl is not None:
+            window.append((date, ebl))
+        since = date - datetime.timedelta(hours=PPH_HOURS)
+        window[:] = [(d, e) for d, e in window if d > since]
+        if sum(e for d, e in window) >= PPH_EBL:
+            alerts.add('PPH')
+        else:
+            alerts.discard('PPH')
+        if state['last_reading'] is None or date > state['last_reading']:
+            state['last_reading'] = date
+    return state
+
+
+class MmcAlertPending(ModelSQL):
+    '''
+    The pregnancies whose monitor rows were created, written or deleted
+    since the last check. The row is inserted in the same transaction as
+    the change of the monitor, so the check sees it exactly when it sees
+    the change. A created monitor row is queued with its model and id,
+    the other changes without.
+    '''
+    __name__ = 'mmc.alert.pending'
+
+    pregnancy = fields.Many2One('gnuhealth.patient.pregnancy', 'Pregnancy',
+        required=True, select=True, ondelete='CASCADE')
+    model = fields.Char('Model')
+    record = fields.Integer('Record')
+
+    # --------------------------------------------------------
+    # When the table is created, queue every pregnancy with
+    # monitor rows so that the first check builds their state.
+    # --------------------------------------------------------
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        cursor = Transaction().cursor
+        created = not TableHandler.table_exist(cursor, cls._table)
+        super(MmcAlertPending, cls).__register__(module_name)
+        if created:
+            for model, _, _ in ALERT_SOURCES:
+                cursor.execute('INSERT INTO "' + cls._table + '" '
+                    '(pregnancy) SELECT DISTINCT name '
+                    'FROM "' + pool.get(model)._table + '" '
+                    'WHERE name IS NOT NULL')
+
+    @classmethod
+    def add(cls, pregnancy_ids):
+        pregnancy_ids = set(i for i in pregnancy_ids if i)
+        if pregnancy_ids:
+            cls.create([{'pregnancy': i} for i in pregnancy_ids])
+
+    @classmethod
+    def add_readings(cls, model, records):
+        if records:
+            cls.create([{
+                        'pregnancy': r.name.id,
+                        'model': model,
+                        'record': r.id,
+                        } for r in records])
+
+
+class MmcAlertState(ModelSQL, ModelView):
+    '''
+    The alert state of each pregnancy under postpartum monitoring. check()
+    adds the readings created since the previous check to the stored state
+    when they are all later than its last reading. Otherwise, when readings
+    were back-dated, corrected or deleted, it rebuilds the state from all
+    the readings of the pregnancy in date order. The cost of a check grows
+    with the number of new readings, not with the monitoring history of
+    the clinic.
+    '''
+    __name__ = 'mmc.alert.state'
+
+    pregnancy = fields.Many2One('gnuhealth.patient.pregnancy', 'Pregnancy',
+        required=True, readonly=True, select=True, ondelete='CASCADE')
+    alerts = fields.Char('Alerts', readonly=True)
+    needs_attention = fields.Boolean('Needs attention', readonly=True,
+        select=True)
+    acknowledged = fields.Boolean('Acknowledged',
+        help="Check once the alerts have been seen to. New alerts uncheck it.")
+    last_reading = fields.DateTime('Last reading', readonly=True)
+    last_ebl = fields.Integer('Last EBL (ml)', readonly=True)
+    ebl_rises = fields.Integer('EBL rises', readonly=True)
+    ebl_total = fields.Integer('Total EBL (ml)', readonly=True)
+    ebl_window = fields.Text('EBL window', readonly=True,
+        help="The EBL of the readings of the last hours, for the PPH alert")
+
+    @classmethod
+    def __setup__(cls):
+        super(MmcAlertState, cls).__setup__()
+        cls._sql_constraints += [
+            ('pregnancy_uniq', 'UNIQUE(pregnancy)',
+                'The pregnancy already has an alert state !'),
+        ]
+        cls._order.insert(0, ('last_reading', 'DESC'))
+
+    # --------------------------------------------------------
+    # The states stored before the EBL window was kept are rebuilt
+    # by the next check.
+    # --------------------------------------------------------
+    @classmethod
+    def __register__(cls, module_name):
+        Pending = Pool().get('mmc.alert.pending')
+        cursor = Transaction().cursor
+        window = True
+        if TableHandler.table_exist(cursor, cls._table):
+            window = TableHandler(cursor, cls, module_name).column_exist(
+                'ebl_window')
+        super(MmcAlertState, cls).__register__(module_name)
+        if not window:
+            cursor.execute('INSERT INTO "' + Pending._table + '" '
+                '(pregnancy) SELECT pregnancy FROM "' + cls._table + '"')
+
+    @staticmethod
+    def default_acknowledged():
+        return False
+
+    # --------------------------------------------------------
+    # The running state of apply_reading() kept in a state
+    # record and back, the EBL window as lines of date and EBL.
+    # --------------------------------------------------------
+    @staticmethod
+    def get_values(running):
+        return {
+            'alerts': " ".join(sorted(running['alerts'])),
+            'needs_attention': bool(running['alerts']),
+            'last_reading': running['last_reading'],
+            'last_ebl': running['last_ebl'],
+            'ebl_rises': running['ebl_rises'],
+            'ebl_total': running['ebl_total'],
+            'ebl_window': "\n".join('%s %s' % (d.isoformat(), e)
+                for d, e in running['ebl_window']),
+            }
+
+    @staticmethod
+    def get_running(values):
+        running = new_state()
+        running['alerts'] = set((values['alerts'] or '').split())
+        running['last_reading'] = values['last_reading']
+        running['last_ebl'] = values['last_ebl']
+        running['ebl_rises'] = values['ebl_rises'] or 0
+        running['ebl_total'] = values['ebl_total'] or 0
+        for line in (values['ebl_window'] or '').splitlines():
+            date, ebl = line.split()
+            running['ebl_window'].append((datetime.datetime.strptime(date,
+                        '%Y-%m-%dT%H:%M:%S.%f' if '.' in date
+                        else '%Y-%m-%dT%H:%M:%S'), int(ebl)))
+        return running
+
+    # --------------------------------------------------------
+    # Return the monitor rows of the pregnancies, keyed by
+    # pregnancy, as dicts of column values in date order: all
+    # of them or, with records, only the rows of these ids by
+    # model.
+    # --------------------------------------------------------
+    @staticmethod
+    def get_readings(pregnancy_ids, records=None):
+        pool = Pool()
+        cursor = Transaction().cursor
+        readings = dict((i, []) for i in pregnancy_ids)
+        if not pregnancy_ids:
+            return readings
+        for source, (model, date_field, columns) in enumerate(ALERT_SOURCES):
+            Monitor = pool.get(model)
+            names = sorted(columns)
+            if records is None:
+                where, ids = 'name', pregnancy_ids
+            else:
+                where, ids = 'id', records.get(model, [])
+            for i in range(0, len(ids), cursor.IN_MAX):
+                sub_ids = ids[i:i + cursor.IN_MAX]
+                cursor.execute('SELECT id, name, "' + date_field + '", '
+                    + ', '.join('"' + columns[n] + '"' for n in names)
+                    + ' FROM "' + Monitor._table + '" '
+                    'WHERE ' + where + ' IN ('
+                    + ','.join(('%s',) * len(sub_ids)) + ')', sub_ids)
+                for row in cursor.fetchall():
+                    if row[1] not in readings:
+                        continue
+                    reading = dict(zip(names, row[3:]))
+                    reading['date'] = row[2]
+                    reading['order'] = (row[2], source, row[0])
+                    readings[row[1]].append(reading)
+        for rows in readings.itervalues():
+            rows.sort(key=lambda r: r['order'])
+        return readings
+
+    # --------------------------------------------------------
+    # Update the state of the pregnancies queued since the last
+    # check. Run by a cron job and from the Check Postpartum
+    # Alerts wizard. Returns the number of pregnancies checked.
+    # --------------------------------------------------------
+    @classmethod
+    def check(cls):
+        Pending = Pool().get('mmc.alert.pending')
+        cursor = Transaction().cursor
+
+        # --------------------------------------------------------
+        # Serialize the checks so that two of them do not create
+        # the state of the same pregnancy.
+        # --------------------------------------------------------
+        if CONFIG['db_type'] == 'postgresql':
+            cursor.execute('LOCK TABLE "' + cls._table + '" '
+                'IN EXCLUSIVE MODE')
+        pending = Pending.search_read([],
+            fields_names=['pregnancy', 'model', 'record'])
+        pregnancy_ids = sorted(set(p['pregnancy'] for p in pending))
+        rebuild = set(p['pregnancy'] for p in pending if not p['record'])
+        records = {}
+        for p in pending:
+            if p['record']:
+                records.setdefault(p['model'], []).append(p['record'])
+
+        for i in range(0, len(pregnancy_ids), cursor.IN_MAX):
+            sub_ids = pregnancy_ids[i:i + cursor.IN_MAX]
+            states = dict((s['pregnancy'], s) for s in cls.search_read([
+                        ('pregnancy', 'in', sub_ids),
+                        ], fields_names=['pregnancy', 'alerts',
+                        'last_reading', 'last_ebl', 'ebl_rises',
+                        'ebl_total', 'ebl_window']))
+
+            # --------------------------------------------------------
+            # The new readings are added to the stored state when
+            # they are all later than its last reading.
+            # --------------------------------------------------------
+            readings = {}
+            for pregnancy_id, rows in cls.get_readings([j for j in sub_ids
+                        if j not in rebuild and j in states],
+                    records).iteritems():
+                last = states[pregnancy_id]['last_reading']
+                if last and all(r['date'] and r['date'] > last
+                        for r in rows):
+                    readings[pregnancy_id] = rows
+            resumed = set(readings)
+            readings.update(cls.get_readings([j for j in sub_ids
+                        if j not in resumed]))
+
+            to_create = []
+            to_delete = []
+            for pregnancy_id in sub_ids:
+                state = states.get(pregnancy_id)
+                if pregnancy_id in resumed:
+                    running = cls.get_running(state)
+                elif not readings[pregnancy_id]:
+                    if state:
+                        to_delete.append(state['id'])
+                    continue
+                else:
+                    running = new_state()
+                for reading in readings[pregnancy_id]:
+                    apply_reading(running, reading)
+
+                values = cls.get_values(running)
+                previous = set((state and state['alerts'] or '').split())
+                if running['alerts'] - previous:
+                    values['acknowledged'] = False
+                if state:
+                    cls.write([cls(state['id'])], values)
+                else:
+                    values['pregnancy'] = pregnancy_id
+                    to_create.append(values)
+            if to_create:
+                cls.create(to_create)
+            if to_delete:
+                cls.delete(cls.browse(to_delete))
+
+        # Only the rows read above: a change committed since then
+        # stays queued for the next check.
+        Pending.delete(Pending.browse([p['id'] for p in pending]))
+        if pregnancy_ids:
+            mmcLog.info('Checked postpartum readings of %d pregnancies'
+                % len(pregnancy_ids))
+        return len(pregnancy_ids)
+
+
+class MmcAlertCheckResult(ModelView):
+    'Check Postpartum Alerts'
+    __name__ = 'mmc.alert.check.result'
+
+    pregnancies = fields.Integer('Pregnancies with changed readings',
+        readonly=True)
+    attention = fields.Integer('Needing attention', readonly=True)
+
+
+class MmcAlertCheck(Wizard):
+    'Check Postpartum Alerts'
+    __name__ = 'mmc.alert.check'
+
+    start = StateView('mmc.alert.check.result',
+        'mmc.mmc_alert_check_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_start(self, fields):
+        State = Pool().get('mmc.alert.state')
+        return {
+            'pregnancies': State.check(),
+            'attention': State.search_count([
+                    ('needs_attention', '=', True),
+                    ('acknowledged', '=', False),
+                    ]),
+            }
@@ -0,0 +1,60 @@
+# -------------------------------------------------------------------------------
+# mmc_archive.py
+#
+# Archiving of the pregnancies closed long ago with their evaluations and
+# monitors.
+# -------------------------------------------------------------------------------
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.wizard import Wizard, StateView, Button
+from trytond.config import CONFIG
+
+from .mmc import ARCHIVE_DAYS
+
+__all__ = [
+    'MmcArchiveStart',
+    'MmcArchiveResult',
+    'MmcArchive',
+    ]
+
+
+class MmcArchiveStart(ModelView):
+    'Archive Closed Pregnancies'
+    __name__ = 'mmc.archive.start'
+
+    days = fields.Integer('Closed for more than (days)', required=True)
+
+    @staticmethod
+    def default_days():
+        return int(CONFIG.get('mmc_archive_days') or ARCHIVE_DAYS)
+
+
+class MmcArchiveResult(ModelView):
+    'Archive Closed Pregnancies'
+    __name__ = 'mmc.archive.result'
+
+    archived = fields.Integer('Pregnancies archived', readonly=True)
+
+
+class MmcArchive(Wizard):
+    '''
+    Archive now the pregnancies that ended more than the given number of
+    days ago instead of waiting for the weekly cron.
+    '''
+    __name__ = 'mmc.archive'
+
+    start = StateView('mmc.archive.start',
+        'mmc.mmc_archive_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Archive', 'result', 'tryton-ok', default=True),
+            ])
+    result = StateView('mmc.archive.result',
+        'mmc.mmc_archive_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_result(self, fields):
+        Pregnancy = Pool().get('gnuhealth.patient.pregnancy')
+        return {
+            'archived': Pregnancy.archive_closed(self.start.days),
+            }
@@ -0,0 +1,434 @@
+# -------------------------------------------------------------------------------
+# mmc_barangay.py
+#
+# Reference list of the barangays, the link of the addresses to it and
+# the catchment report of the patients by barangay.
+# -------------------------------------------------------------------------------
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, Button
+
+import csv
+import datetime
+import io
+import logging
+import re
+import unicodedata
+
+__all__ = [
+    'MmcBarangay',
+    'MmcBarangayNormalizeStart',
+    'MmcBarangayNormalizeResult',
+    'MmcBarangayNormalize',
+    'MmcCatchmentStart',
+    'MmcCatchmentResult',
+    'MmcCatchment',
+    ]
+
+mmcLog = logging.getLogger('mmcBarangay')
+
+# --------------------------------------------------------
+# A key for the name of a barangay so that the usual ways of
+# writing it compare equal, e.g. Brgy. Sto. Nino, STO NIÑO and
+# barangay santo nino.
+# --------------------------------------------------------
+BARANGAY_PREFIXES = set(['brgy', 'bgy', 'brg', 'barangay'])
+BARANGAY_ABBREVIATIONS = {
+    'sto': 'santo',
+    'sta': 'santa',
+    'st': 'saint',
+    'gov': 'governor',
+    'gen': 'general',
+    'pres': 'president',
+    'pob': 'poblacion',
+    }
+
+def barangay_key(value):
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
+    words = re.findall(r'[a-z0-9]+', value.lower())
+    while words and words[0] in BARANGAY_PREFIXES:
+        words.pop(0)
+    if not words:
+        return None
+    return ' '.join(BARANGAY_ABBREVIATIONS.get(w, w) for w in words)
+
+# --------------------------------------------------------
+# The current address of each party: the first active one in
+# the order of the addresses of the party, as shown on the
+# patient form. A query returning id, party and barangay_ref.
+# Every query about the address of a patient uses it.
+# --------------------------------------------------------
+def current_address_query(address_table):
+    return ('SELECT a.id, a.party, a.barangay_ref '
+        'FROM "' + address_table + '" a '
+        'WHERE a.active = %s AND NOT EXISTS ('
+            'SELECT 1 FROM "' + address_table + '" b '
+            'WHERE b.party = a.party AND b.active = %s '
+            'AND (COALESCE(b.sequence, 0) < COALESCE(a.sequence, 0) '
+                'OR (COALESCE(b.sequence, 0) = COALESCE(a.sequence, 0) '
+                    'AND b.id < a.id)))'), [True, True]
+
+
+# --------------------------------------------------------
+# Return the id of the current address of the parties keyed
+# by party, for the parties that have one.
+# --------------------------------------------------------
+def current_address_ids(party_ids):
+    Address = Pool().get('party.address')
+    cursor = Transaction().cursor
+    current, params = current_address_query(Address._table)
+    party_ids = list(party_ids)
+    result = {}
+    for i in range(0, len(party_ids), cursor.IN_MAX):
+        sub_ids = party_ids[i:i + cursor.IN_MAX]
+        cursor.execute('SELECT ca.party, ca.id FROM (' + current + ') ca '
+            'WHERE ca.party IN (' + ','.join(('%s',) * len(sub_ids)) + ')',
+            params + sub_ids)
+        result.update(cursor.fetchall())
+    return result
+
+
+class MmcBarangay(ModelSQL, ModelView):
+    '''
+    The barangays the patients come from. The free text barangay of the
+    addresses is matched to this list, by name or by one of the other
+    spellings of the barangay, so that the patients can be counted by
+    barangay with a grouped query.
+    '''
+    __name__ = 'mmc.barangay'
+
+    name = fields.Char('Name', required=True)
+    key = fields.Char('Key', readonly=True, select=True)
+    aliases = fields.Text('Other spellings',
+        help="Other ways the barangay is written, one per line")
+    district = fields.Char('District', select=True)
+    city = fields.Char('City')
+    catchment = fields.Boolean('In catchment area', select=True,
+        help="Check if the barangay is in the catchment area of the clinic")
+    active = fields.Boolean('Active', select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(MmcBarangay, cls).__setup__()
+        cls._sql_constraints += [
+            ('key_uniq', 'UNIQUE(key)', 'The barangay already exists !'),
+        ]
+        cls._order.insert(0, ('name', 'ASC'))
+
+    @staticmethod
+    def default_city():
+        return 'Davao City'
+
+    @staticmethod
+    def default_catchment():
+        return False
+
+    @staticmethod
+    def default_active():
+        return True
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        for values in vlist:
+            values['key'] = barangay_key(values.get('name'))
+        return super(MmcBarangay, cls).create(vlist)
+
+    @classmethod
+    def write(cls, barangays, values):
+        values = values.copy()
+        if 'name' in values:
+            values['key'] = barangay_key(values['name'])
+        super(MmcBarangay, cls).write(barangays, values)
+
+    # --------------------------------------------------------
+    # The barangay ids by the keys of their name and of their
+    # other spellings.
+    # --------------------------------------------------------
+    @classmethod
+    def get_key_map(cls):
+        keys = {}
+        barangays = cls.search_read([], fields_names=['key', 'aliases'])
+        for barangay in barangays:
+            for alias in (barangay['aliases'] or '').splitlines():
+                alias = barangay_key(alias)
+                if alias:
+                    keys.setdefault(alias, barangay['id'])
+        for barangay in barangays:
+            if barangay['key']:
+                keys[barangay['key']] = barangay['id']
+        return keys
+
+    # --------------------------------------------------------
+    # Set barangay_ref of the address values that have a free
+    # text barangay but no barangay_ref. Called when addresses
+    # are created or written.
+    # --------------------------------------------------------
+    @classmethod
+    def match_addresses(cls, vlist):
+        todo = [v for v in vlist
+            if v.get('barangay') and not v.get('barangay_ref')]
+        if not todo:
+            return
+        keys = cls.get_key_map()
+        for values in todo:
+            barangay_id = keys.get(barangay_key(values['barangay']))
+            if barangay_id:
+                values['barangay_ref'] = barangay_id
+
+    # --------------------------------------------------------
+    # Link the existing addresses to the barangays from their
+    # free text barangay, one update per barangay. With
+    # create_missing, a barangay is created for every key that
+    # does not match, named after its most frequent spelling.
+    # Returns the number of addresses linked and the spellings
+    # that did not match with their number of addresses.
+    # --------------------------------------------------------
+    @classmethod
+    def normalize_addresses(cls, create_missing=False):
+        Address = Pool().get('party.address')
+        transaction = Transaction()
+        cursor = transaction.cursor
+
+        cursor.execute('SELECT barangay, COUNT(*) '
+            'FROM "' + Address._table + '" '
+            'WHERE barangay_ref IS NULL AND barangay IS NOT NULL '
+            'AND barangay != %s GROUP BY barangay', ('',))
+        spellings = {}
+        for value, count in cursor.fetchall():
+            key = barangay_key(value)
+            if key:
+                spellings.setdefault(key, []).append((count, value))
+
+        keys = cls.get_key_map()
+        if create_missing:
+            missing = [k for k in spellings if k not in keys]
+            if missing:
+                for barangay in cls.create([{
+                                'name': max(spellings[k])[1].strip(),
+                                } for k in missing]):
+                    keys[barangay.key] = barangay.id
+
+        linked = 0
+        unmatched = []
+        now = datetime.datetime.now()
+        for key, values in spellings.iteritems():
+            barangay_id = keys.get(key)
+            if not barangay_id:
+                unmatched.extend((v, c) for c, v in values)
+                continue
+            names = [v for _, v in values]
+            for i in range(0, len(names), cursor.IN_MAX):
+                sub_names = names[i:i + cursor.IN_MAX]
+                cursor.execute('UPDATE "' + Address._table + '" '
+                    'SET barangay_ref = %s, write_date = %s, write_uid = %s '
+                    'WHERE barangay_ref IS NULL AND barangay IN ('
+                    + ','.join(('%s',) * len(sub_names)) + ')',
+                    [barangay_id, now, transaction.user] + sub_names)
+            linked += sum(c for c, _ in values)
+        unmatched.sort(key=lambda u: (-u[1], u[0]))
+        mmcLog.info('Linked %d addresses to their barangay, %d spellings '
+            'did not match' % (linked, len(unmatched)))
+        return linked, unmatched
+
+    # --------------------------------------------------------
+    # The catchment figures of each barangay for the period, by
+    # the current address of the patients, with one grouped
+    # query: the patients seen for a prenatal visit, the
+    # deliveries and the pregnancies registered with how many
+    # of them got quality care. Keyed by barangay id, None for
+    # the patients whose address is not linked to a barangay.
+    # --------------------------------------------------------
+    @classmethod
+    def get_catchment(cls, start, end):
+        pool = Pool()
+        Pregnancy = pool.get('gnuhealth.patient.pregnancy')
+        Patient = pool.get('gnuhealth.patient')
+        Address = pool.get('party.address')
+        Evaluation = pool.get('gnuhealth.patient.prenatal.evaluation')
+        Fact = pool.get('mmc.prenatal.report.fact')
+        cursor = Transaction().cursor
+
+        current, current_params = current_address_query(Address._table)
+        where = ('FROM "' + Pregnancy._table + '" p '
+            'JOIN "' + Patient._table + '" pt ON pt.id = p.name '
+            'LEFT JOIN (' + current + ') ca ON ca.party = pt.name ')
+        start_dt = datetime.datetime.combine(start, datetime.time())
+        end_dt = datetime.datetime.combine(end + datetime.timedelta(days=1),
+            datetime.time())
+
+        cursor.execute('SELECT barangay_ref, SUM(patients), SUM(deliveries), '
+                'SUM(registered), SUM(quality) FROM ('
+            'SELECT ca.barangay_ref, COUNT(DISTINCT pt.id) AS patients, '
+                '0 AS deliveries, 0 AS registered, 0 AS quality '
+                + where + 'WHERE EXISTS (SELECT 1 FROM "'
+                + Evaluation._table + '" e WHERE e.name = p.id '
+                'AND e.evaluation_date >= %s AND e.evaluation_date < %s) '
+                'GROUP BY ca.barangay_ref '
+            'UNION ALL '
+            'SELECT ca.barangay_ref, 0, COUNT(*), 0, 0 '
+                + where + 'WHERE p.pregnancy_end_date >= %s '
+                'AND p.pregnancy_end_date < %s '
+                'GROUP BY ca.barangay_ref '
+            'UNION ALL '
+            'SELECT ca.barangay_ref, 0, 0, COUNT(*), '
+                'SUM(CASE WHEN f.quality THEN 1 ELSE 0 END) '
+                + where + 'JOIN "' + Fact._table + '" f '
+                'ON f.pregnancy = p.id '
+                'WHERE f.registration_date >= %s '
+                'AND f.registration_date <= %s '
+                'GROUP BY ca.barangay_ref'
+            ') catchment GROUP BY barangay_ref',
+            current_params + [start_dt, end_dt]
+            + current_params + [start_dt, end_dt]
+            + current_params + [start, end])
+
+        result = {}
+        for barangay_id, patients, deliveries, registered, quality \
+                in cursor.fetchall():
+            result[barangay_id] = {
+                'patients': int(patients or 0),
+                'deliveries': int(deliveries or 0),
+                'registered': int(registered or 0),
+                'quality': int(quality or 0),
+                'quality_rate': registered and
+                    100.0 * (quality or 0) / registered or None,
+                }
+        return result
+
+
+class MmcBarangayNormalizeStart(ModelView):
+    'Link Addresses to Barangays'
+    __name__ = 'mmc.barangay.normalize.start'
+
+    create_missing = fields.Boolean('Create missing barangays',
+        help="Create a barangay for every spelling that does not match "
+        "one of the list")
+
+
+class MmcBarangayNormalizeResult(ModelView):
+    'Link Addresses to Barangays'
+    __name__ = 'mmc.barangay.normalize.result'
+
+    linked = fields.Integer('Addresses linked', readonly=True)
+    unmatched = fields.Text('Spellings not matched', readonly=True,
+        help="Add them as other spellings of their barangay and run again")
+
+
+class MmcBarangayNormalize(Wizard):
+    'Link Addresses to Barangays'
+    __name__ = 'mmc.barangay.normalize'
+
+    start = StateView('mmc.barangay.normalize.start',
+        'mmc.mmc_barangay_normalize_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Link', 'result', 'tryton-ok', default=True),
+            ])
+    result = StateView('mmc.barangay.normalize.result',
+        'mmc.mmc_barangay_normalize_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_result(self, fields):
+        Barangay = Pool().get('mmc.barangay')
+        linked, unmatched = Barangay.normalize_addresses(
+            create_missing=self.start.create_missing)
+        return {
+            'linked': linked,
+            'unmatched': "\n".join('%s (%d)' % u for u in unmatched),
+            }
+
+
+class MmcCatchmentStart(ModelView):
+    'Catchment by Barangay'
+    __name__ = 'mmc.catchment.start'
+
+    start_date = fields.Date('Start Date', required=True)
+    end_date = fields.Date('End Date', required=True)
+
+    @staticmethod
+    def default_start_date():
+        return Pool().get('mmc.prenatal.report.start').default_start_date()
+
+    @staticmethod
+    def default_end_date():
+        return Pool().get('mmc.prenatal.report.start').default_end_date()
+
+
+class MmcCatchmentResult(ModelView):
+    'Catchment by Barangay'
+    __name__ = 'mmc.catchment.result'
+
+    details = fields.Text('Barangays', readonly=True)
+    data = fields.Binary('File', readonly=True, filename='filename')
+    filename = fields.Char('File name', readonly=True)
+
+
+class MmcCatchment(Wizard):
+    'Catchment by Barangay'
+    __name__ = 'mmc.catchment'
+
+    start = StateView('mmc.catchment.start',
+        'mmc.mmc_catchment_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Compute', 'result', 'tryton-ok', default=True),
+            ])
+    result = StateView('mmc.catchment.result',
+        'mmc.mmc_catchment_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    _columns = [
+        ('patients', 'Patients'),
+        ('deliveries', 'Deliveries'),
+        ('registered', 'Registered'),
+        ('quality', 'Quality care'),
+        ('quality_rate', 'Quality care %'),
+        ]
+
+    def default_result(self, fields):
+        Barangay = Pool().get('mmc.barangay')
+        catchment = Barangay.get_catchment(self.start.start_date,
+            self.start.end_date)
+        names = dict((b['id'], b) for b in Barangay.search_read([
+                    ('id', 'in', [i for i in catchment if i]),
+                    ('active', 'in', [True, False]),
+                    ], fields_names=['name', 'district']))
+        rows = []
+        for barangay_id, values in catchment.iteritems():
+            barangay = names.get(barangay_id, {})
+            rows.append((barangay.get('name') or 'Not linked',
+                    barangay.get('district') or '', values))
+        rows.sort(key=lambda r: (r[0] == 'Not linked', r[0]))
+
+        def fmt(value):
+            if value is None:
+                return ''
+            if isinstance(value, float):
+                return '%.1f' % value
+            return str(value)
+
+        details = ['%-30s %-12s ' % ('Barangay', 'District')
+            + ' '.join('%14s' % h for _, h in self._columns)]
+        out = io.BytesIO()
+        writer = csv.writer(out)
+        writer.writerow(['Barangay', 'District']
+            + [h for _, h in self._columns])
+        for name, district, values in rows:
+            cells = [fmt(values[c]) for c, _ in self._columns]
+            details.append('%-30s %-12s ' % (name[:30], district[:12])
+                + ' '.join('%14s' % c for c in cells))
+            writer.writerow([name.encode('utf-8'), district.encode('utf-8')]
+                + cells)
+        return {
+            'details': "\n".join(details),
+            'data': buffer(out.getvalue()),
+            'filename': 'catchment_%s_%s.csv' % (
+                self.start.start_date.strftime('%Y%m%d'),
+                self.start.end_date.strftime('%Y%m%d')),
+            }
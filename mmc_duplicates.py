@@ -0,0 +1,46 @@
+# -------------------------------------------------------------------------------
+# mmc_duplicates.py
+#
+# Scan of the patient table for mothers registered more than once.
+# -------------------------------------------------------------------------------
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.wizard import Wizard, StateView, Button
+
+import logging
+
+__all__ = [
+    'MmcDuplicatePatientsResult',
+    'MmcDuplicatePatients',
+    ]
+
+mmcLog = logging.getLogger('mmcDuplicates')
+
+
+class MmcDuplicatePatientsResult(ModelView):
+    'Duplicate Patients'
+    __name__ = 'mmc.duplicate.patients.result'
+
+    clusters = fields.Integer('Possible duplicates', readonly=True,
+        help="Number of groups of patients that may be the same person")
+    details = fields.Text('Patients', readonly=True)
+
+
+class MmcDuplicatePatients(Wizard):
+    'Duplicate Patients'
+    __name__ = 'mmc.duplicate.patients'
+
+    start = StateView('mmc.duplicate.patients.result',
+        'mmc.mmc_duplicate_patients_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_start(self, fields):
+        Patient = Pool().get('gnuhealth.patient')
+        clusters = Patient.find_duplicate_clusters()
+        mmcLog.info('Found %d possible duplicate patients' % len(clusters))
+        return {
+            'clusters': len(clusters),
+            'details': "\n".join(" / ".join(row['rec_name'] for row in cluster)
+                for cluster in clusters),
+            }
@@ -0,0 +1,197 @@
+# -------------------------------------------------------------------------------
+# mmc_export.py
+#
+# Export of the prenatal master register as a CSV file or XLSX spreadsheet.
+# -------------------------------------------------------------------------------
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.wizard import Wizard, StateView, Button
+
+import csv
+import datetime
+import logging
+import tempfile
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+mmcLog = logging.getLogger('mmcExport')
+
+__all__ = [
+    'MmcPrenatalExportStart',
+    'MmcPrenatalExportResult',
+    'MmcPrenatalExport',
+    ]
+
+
+# --------------------------------------------------------
+# The columns of the export, the keys of the rows built by
+# MmcPrenatalReport.get_record() in the order of the paper
+# register.
+# --------------------------------------------------------
+EXPORT_COLUMNS = [
+    ('lastname', 'Last name'),
+    ('firstname', 'First name'),
+    ('dob', 'Date of birth'),
+    ('age', 'Age'),
+    ('address', 'Address'),
+    ('lmp', 'LMP'),
+    ('edd', 'EDD'),
+    ('dateReg', 'Date of registration'),
+    ('gpas', 'G, P, A, S'),
+    ('weeksTo12', 'Visits up to 12 weeks'),
+    ('weeksTo27', 'Visits 13 to 27 weeks'),
+    ('weeksTo40', 'Visits 28 to 40 weeks'),
+    ('riskcode', 'Risk code'),
+    ('ttprev', 'TT before LMP'),
+    ('ttcurr', 'TT current'),
+    ('doctor_consult', 'Doctor consultation'),
+    ('dentist_consult', 'Dentist consultation'),
+    ('phil_health', 'Phil Health'),
+    ('partner', 'Partner'),
+    ('mb_book', 'MB Book'),
+    ('iodized_salt', 'Iodized salt'),
+    ('quality', 'Quality care'),
+    ('where_deliver', 'Where deliver'),
+    ]
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.date):
+        return value.strftime("%m/%d/%Y")
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+# --------------------------------------------------------
+# Write the rows, lists of values in the order of the
+# columns, as they are generated. Neither writer keeps more
+# than the current row in memory.
+# --------------------------------------------------------
+def write_csv(fileobj, rows):
+    writer = csv.writer(fileobj)
+    writer.writerow([header for _, header in EXPORT_COLUMNS])
+    count = 0
+    for row in rows:
+        writer.writerow([_csv_value(v) for v in row])
+        count += 1
+    return count
+
+
+def write_xlsx(fileobj, rows):
+    if openpyxl is None:
+        raise ValueError('XLSX export needs the openpyxl library')
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('Prenatal register')
+    sheet.append([header for _, header in EXPORT_COLUMNS])
+    count = 0
+    for row in rows:
+        sheet.append(row)
+        count += 1
+    workbook.save(fileobj)
+    return count
+
+
+class MmcPrenatalExportStart(ModelView):
+    'Export Prenatal Register'
+    __name__ = 'mmc.prenatal.export.start'
+
+    start_date = fields.Date('Start Date', required=True)
+    end_date = fields.Date('End Date', required=True)
+    barangay = fields.Char('Barangay',
+        help="Only include patients with an address in this barangay")
+    format = fields.Selection([
+        ('csv', 'CSV'),
+        ('xlsx', 'Spreadsheet (XLSX)'),
+        ], 'Format', required=True)
+
+    @staticmethod
+    def default_start_date():
+        return Pool().get('mmc.prenatal.report.start').default_start_date()
+
+    @staticmethod
+    def default_end_date():
+        return Pool().get('mmc.prenatal.report.start').default_end_date()
+
+    @staticmethod
+    def default_format():
+        return 'xlsx' if openpyxl else 'csv'
+
+
+class MmcPrenatalExportResult(ModelView):
+    'Export Prenatal Register'
+    __name__ = 'mmc.prenatal.export.result'
+
+    rows = fields.Integer('Pregnancies', readonly=True)
+    data = fields.Binary('File', readonly=True, filename='filename')
+    filename = fields.Char('File name', readonly=True)
+
+
+class MmcPrenatalExport(Wizard):
+    '''
+    Export the rows of the prenatal master report for a date range as a
+    CSV file or XLSX spreadsheet. The rows are generated a chunk of
+    pregnancies at a time and written as they come. For a very large
+    export use export() from a script to write straight to disk.
+    '''
+    __name__ = 'mmc.prenatal.export'
+
+    start = StateView('mmc.prenatal.export.start',
+        'mmc.mmc_prenatal_export_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'result', 'tryton-ok', default=True),
+            ])
+    result = StateView('mmc.prenatal.export.result',
+        'mmc.mmc_prenatal_export_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    @classmethod
+    def __setup__(cls):
+        super(MmcPrenatalExport, cls).__setup__()
+        cls._error_messages.update({
+                'no_openpyxl': ('Exporting a spreadsheet requires the '
+                    'openpyxl library. Export as CSV instead.'),
+                })
+
+    @staticmethod
+    def iter_rows(data):
+        Report = Pool().get('gnuhealth.patient.doh.prenatal', type='report')
+        for rec in Report.iter_records(Report.get_pregnancy_ids(data)):
+            yield [rec[key] for key, _ in EXPORT_COLUMNS]
+
+    @classmethod
+    def export(cls, fileobj, data, format='csv'):
+        writer = write_xlsx if format == 'xlsx' else write_csv
+        count = writer(fileobj, cls.iter_rows(data))
+        mmcLog.info('Exported %d prenatal register rows as %s'
+            % (count, format))
+        return count
+
+    def default_result(self, fields):
+        if self.start.format == 'xlsx' and openpyxl is None:
+            self.raise_user_error('no_openpyxl')
+        data = {
+            'start_date': self.start.start_date,
+            'end_date': self.start.end_date,
+            'barangay': self.start.barangay,
+            }
+        fileobj = tempfile.TemporaryFile()
+        try:
+            count = self.export(fileobj, data, self.start.format)
+            fileobj.seek(0)
+            content = fileobj.read()
+        finally:
+            fileobj.close()
+        return {
+            'rows': count,
+            'data': buffer(content),
+            'filename': 'prenatal_register_%s_%s.%s' % (
+                self.start.start_date.strftime('%Y%m%d'),
+                self.start.end_date.strftime('%Y%m%d'), self.start.format),
+            }
@@ -0,0 +1,572 @@
+# -------------------------------------------------------------------------------
+# mmc_import.py
+#
+# Bulk import of historical patient records from paper charts.
+# -------------------------------------------------------------------------------
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, Button
+
+from .mmc import normalize_doh_id, normalize_phil_health_id, \
+    is_valid_doh_id, is_valid_phil_health_id
+
+import csv
+import datetime
+import io
+import logging
+import os
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+mmcLog = logging.getLogger('mmcImport')
+
+__all__ = [
+    'MmcImportStart',
+    'MmcImportResult',
+    'MmcImport',
+    ]
+
+
+# --------------------------------------------------------
+# The columns of the import file. Every row has a
+# record_type and the doh_id of the patient it belongs to.
+# Pregnancies are identified by the patient and their
+# pregnancy number (gravida_number).
+# --------------------------------------------------------
+COLUMNS = [
+    'record_type', 'doh_id',
+    # patient
+    'lastname', 'firstname', 'dob', 'gravida', 'para', 'abortions',
+    'stillbirths', 'living', 'phil_health_id', 'street', 'barangay',
+    # pregnancy
+    'gravida_number', 'lmp', 'pregnancy_end_date',
+    # vaccination
+    'vaccine', 'dose', 'cdate', 'cdate_month', 'cdate_year',
+    # prenatal evaluation
+    'evaluation_date', 'weight', 'systolic', 'diastolic', 'fundal_height',
+    'fetus_heart_rate', 'examiner', 'next_appt',
+    ]
+
+RECORD_TYPES = ['patient', 'pregnancy', 'vaccination', 'evaluation']
+
+DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y']
+DATETIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%m/%d/%Y %H:%M']
+
+
+class ImportRowError(Exception):
+    pass
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return value.strip()
+
+def _integer(row, name, required=False):
+    value = _text(row.get(name))
+    if not value:
+        if required:
+            raise ImportRowError('%s is required' % name)
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        raise ImportRowError('%s is not a number: %s' % (name, value))
+
+def _date(row, name, required=False):
+    value = row.get(name)
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    value = _text(value)
+    if not value:
+        if required:
+            raise ImportRowError('%s is required' % name)
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ImportRowError('%s is not a date: %s' % (name, value))
+
+def _datetime(row, name, required=False):
+    value = row.get(name)
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time())
+    value = _text(value)
+    if not value:
+        if required:
+            raise ImportRowError('%s is required' % name)
+        return None
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    date = _date(row, name)
+    return datetime.datetime.combine(date, datetime.time())
+
+
+# --------------------------------------------------------
+# Read the rows of a CSV file or of the first sheet of an
+# XLSX spreadsheet one at a time as dictionaries.
+# --------------------------------------------------------
+def iter_csv(fileobj):
+    for row in csv.DictReader(fileobj):
+        yield row
+
+def iter_xlsx(fileobj):
+    if openpyxl is None:
+        raise ImportRowError('Reading spreadsheets requires openpyxl')
+    workbook = openpyxl.load_workbook(fileobj, read_only=True)
+    rows = workbook.worksheets[0].iter_rows()
+    header = None
+    for cells in rows:
+        values = [c.value for c in cells]
+        if header is None:
+            header = [_text(v) for v in values]
+            continue
+        yield dict(zip(header, values))
+
+def iter_rows(fileobj, filename):
+    if os.path.splitext(filename or '')[1].lower() == '.xlsx':
+        return iter_xlsx(fileobj)
+    return iter_csv(fileobj)
+
+
+class MmcImporter(object):
+    '''
+    Imports patients, pregnancies, historical vaccinations and prenatal
+    evaluations from a stream of rows. The rows are validated and
+    created a batch at a time, and every batch is committed, so memory
+    use does not depend on the size of the file. A row that fails is
+    written to the error file with the reason instead of aborting the
+    import.
+    '''
+    batch_size = 500
+
+    # --------------------------------------------------------
+    # The maps from the identifiers of the file to database ids
+    # are bounded so that they do not grow with the file.
+    # --------------------------------------------------------
+    cache_size = 10000
+
+    def __init__(self, error_file):
+        self.error_file = error_file
+        self.error_writer = None
+        self.counts = dict((t, 0) for t in RECORD_TYPES)
+        self.errors = 0
+        self.pending_errors = []
+        self.patients = {}
+        self.pregnancies = {}
+        self.vaccines = {}
+
+    def run(self, rows):
+        batch = []
+        for number, row in enumerate(rows, 2):
+            batch.append((number, row))
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch)
+                batch = []
+        if batch:
+            self.import_batch(batch)
+        mmcLog.info('Imported %s with %d errors' % (self.counts, self.errors))
+        return self.counts, self.errors
+
+    # --------------------------------------------------------
+    # Errors are held until their batch is committed since a
+    # rolled back batch is imported again row by row.
+    # --------------------------------------------------------
+    def write_error(self, number, row, message):
+        self.pending_errors.append((number, row, message))
+
+    def flush_errors(self):
+        for number, row, message in self.pending_errors:
+            self._write_error(number, row, message)
+        self.pending_errors = []
+
+    def _write_error(self, number, row, message):
+        if self.error_writer is None:
+            fieldnames = ['line', 'error'] + COLUMNS + sorted(
+                k for k in row if k not in COLUMNS and k)
+            self.error_writer = csv.DictWriter(self.error_file, fieldnames,
+                extrasaction='ignore')
+            self.error_writer.writeheader()
+        values = dict((k, v.encode('utf-8') if isinstance(v, unicode) else v)
+            for k, v in row.items() if k)
+        values['line'] = number
+        values['error'] = message.encode('utf-8')
+        self.error_writer.writerow(values)
+        self.errors += 1
+
+    # --------------------------------------------------------
+    # Import and commit a batch. If the database refuses the
+    # batch it is rolled back and the rows are imported one at
+    # a time to find the ones that fail.
+    # --------------------------------------------------------
+    def import_batch(self, batch):
+        cursor = Transaction().cursor
+        try:
+            counts = self.create_batch(batch)
+            cursor.commit()
+        except Exception:
+            cursor.rollback()
+            self.clear_cache()
+            self.pending_errors = []
+            if len(batch) == 1:
+                number, row = batch[0]
+                mmcLog.exception('Import of line %d failed' % number)
+                self._write_error(number, row, u'Rejected by the database')
+                return
+            for item in batch:
+                self.import_batch([item])
+            return
+        self.flush_errors()
+        for record_type, count in counts.items():
+            self.counts[record_type] += count
+
+    def clear_cache(self):
+        self.patients.clear()
+        self.pregnancies.clear()
+        self.vaccines.clear()
+
+    def create_batch(self, batch):
+        parsed = dict((t, []) for t in RECORD_TYPES)
+        for number, row in batch:
+            record_type = _text(row.get('record_type')).lower()
+            if record_type not in parsed:
+                self.write_error(number, row,
+                    'Unknown record type: %s' % record_type)
+                continue
+            try:
+                values = getattr(self, 'parse_' + record_type)(row)
+            except ImportRowError as e:
+                self.write_error(number, row, unicode(e))
+                continue
+            parsed[record_type].append((number, row, values))
+
+        if len(self.patients) > self.cache_size:
+            self.clear_cache()
+
+        # --------------------------------------------------------
+        # Patients first since the other records of the batch may
+        # refer to them.
+        # --------------------------------------------------------
+        counts = {}
+        for record_type in RECORD_TYPES:
+            counts[record_type] = getattr(self, 'create_' + record_type)(
+                parsed[record_type])
+        return counts
+
+    # --------------------------------------------------------
+    # Row parsing and validation. These apply the rules of the
+    # patient form so imported ids are formatted the same way.
+    # --------------------------------------------------------
+    def parse_patient(self, row):
+        doh_id = normalize_doh_id(_text(row.get('doh_id')))
+        if not is_valid_doh_id(doh_id):
+            raise ImportRowError('Department of Health ID must be 6 numbers')
+        phic = normalize_phil_health_id(_text(row.get('phil_health_id')))
+        if not is_valid_phil_health_id(bool(phic), phic):
+            raise ImportRowError('PHIC# must be 12 numbers')
+        lastname = _text(row.get('lastname'))
+        firstname = _text(row.get('firstname'))
+        if not lastname or not firstname:
+            raise ImportRowError('lastname and firstname are required')
+        return {
+            'doh_id': doh_id or None,
+            'lastname': lastname,
+            'firstname': firstname,
+            'dob': _date(row, 'dob'),
+            'gravida': _integer(row, 'gravida') or 0,
+            'para': _integer(row, 'para'),
+            'abortions': _integer(row, 'abortions'),
+            'stillbirths': _integer(row, 'stillbirths'),
+            'living': _integer(row, 'living'),
+            'phil_health': bool(phic),
+            'phil_health_id': phic or None,
+            'street': _text(row.get('street')),
+            'barangay': _text(row.get('barangay')),
+            }
+
+    def parse_doh_id(self, row):
+        doh_id = normalize_doh_id(_text(row.get('doh_id')))
+        if not doh_id or not is_valid_doh_id(doh_id):
+            raise ImportRowError('A valid doh_id is required')
+        return doh_id
+
+    def parse_pregnancy(self, row):
+        end_date = _datetime(row, 'pregnancy_end_date')
+        return {
+            'doh_id': self.parse_doh_id(row),
+            'gravida': _integer(row, 'gravida_number', required=True),
+            'lmp': _date(row, 'lmp', required=True),
+            'pregnancy_end_date': end_date,
+            'current_pregnancy': end_date is None,
+            }
+
+    def parse_vaccination(self, row):
+        month = _text(row.get('cdate_month'))
+        if month:
+            month = month.zfill(2)
+            if month not in ['%02d' % m for m in range(1, 13)]:
+                raise ImportRowError('cdate_month must be 1 to 12')
+        year = _integer(row, 'cdate_year')
+        cdate = _date(row, 'cdate')
+        if not cdate and not year:
+            raise ImportRowError('cdate or cdate_year is required')
+        vaccine = _text(row.get('vaccine'))
+        if not vaccine:
+            raise ImportRowError('vaccine is required')
+        return {
+            'doh_id': self.parse_doh_id(row),
+            'vaccine': vaccine,
+            'dose': _integer(row, 'dose'),
+            'cdate': None if year else cdate,
+            'cdate_month': month if year else '',
+            'cdate_year': year,
+            }
+
+    def parse_evaluation(self, row):
+        weight = _text(row.get('weight'))
+        try:
+            weight = float(weight) if weight else None
+        except ValueError:
+            raise ImportRowError('weight is not a number: %s' % weight)
+        return {
+            'doh_id': self.parse_doh_id(row),
+            'gravida': _integer(row, 'gravida_number', required=True),
+            'evaluation_date': _datetime(row, 'evaluation_date',
+                required=True),
+            'weight': weight,
+            'systolic': _integer(row, 'systolic'),
+            'diastolic': _integer(row, 'diastolic'),
+            'fundal_height': _integer(row, 'fundal_height'),
+            'fetus_heart_rate': _integer(row, 'fetus_heart_rate'),
+            'examiner': _text(row.get('examiner')) or None,
+            'next_appt': _date(row, 'next_appt'),
+            }
+
+    # --------------------------------------------------------
+    # Look up the patients and pregnancies referred to by a
+    # batch with one search each.
+    # --------------------------------------------------------
+    def resolve_patients(self, doh_ids):
+        Patient = Pool().get('gnuhealth.patient')
+        missing = list(set(d for d in doh_ids if d not in self.patients))
+        if missing:
+            for patient in Patient.search_read([('doh_id', 'in', missing)],
+                    fields_names=['doh_id']):
+                self.patients[patient['doh_id']] = patient['id']
+        return self.patients
+
+    def resolve_pregnancies(self, keys):
+        Pregnancy = Pool().get('gnuhealth.patient.pregnancy')
+        patients = self.resolve_patients([k[0] for k in keys])
+        missing = [k for k in set(keys)
+            if k not in self.pregnancies and k[0] in patients]
+        if missing:
+            doh_ids = dict((patients[k[0]], k[0]) for k in missing)
+            for pregnancy in Pregnancy.search_read(
+                    [('name', 'in', list(doh_ids))],
+                    fields_names=['name', 'gravida']):
+                key = (doh_ids[pregnancy['name']], pregnancy['gravida'])
+                self.pregnancies[key] = pregnancy['id']
+        return self.pregnancies
+
+    def resolve_vaccines(self, names):
+        Product = Pool().get('product.product')
+        missing = list(set(n for n in names if n not in self.vaccines))
+        if missing:
+            for product in Product.search_read([
+                        ('name', 'in', missing),
+                        ('is_vaccine', '=', True),
+                        ], fields_names=['name']):
+                self.vaccines[product['name']] = product['id']
+        return self.vaccines
+
+    # --------------------------------------------------------
+    # Record creation, one create call per model and batch.
+    # Rows that refer to something that does not exist go to
+    # the error file.
+    # --------------------------------------------------------
+    def create_patient(self, items):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Patient = pool.get('gnuhealth.patient')
+        if not items:
+            return 0
+
+        existing = self.resolve_patients(
+            [v['doh_id'] for _, _, v in items if v['doh_id']])
+        seen = set()
+        accepted = []
+        for number, row, values in items:
+            if values['doh_id'] and (values['doh_id'] in existing
+                    or values['doh_id'] in seen):
+                self.write_error(number, row, 'The MMC ID already exists')
+                continue
+            seen.add(values['doh_id'])
+            accepted.append(values)
+        if not accepted:
+            return 0
+
+        parties = Party.create([{
+                    'name': v['firstname'],
+                    'lastname': v['lastname'],
+                    'is_person': True,
+                    'is_patient': True,
+                    'addresses': [('create', [{
+                                    'street': v['street'],
+                                    'barangay': v['barangay'],
+                                    }])],
+                    } for v in accepted])
+        patient_fields = ['doh_id', 'dob', 'gravida', 'para', 'abortions',
+            'stillbirths', 'living', 'phil_health', 'phil_health_id']
+        # Historical records are checked for duplicates afterwards
+        # with the duplicate patients scan, not one by one here.
+        with Transaction().set_context(mmc_skip_duplicate_check=True):
+            patients = Patient.create([dict([('name', party.id)] +
+                        [(f, v[f]) for f in patient_fields])
+                    for party, v in zip(parties, accepted)])
+        for patient in patients:
+            self.patients[patient.doh_id] = patient.id
+        return len(patients)
+
+    def create_pregnancy(self, items):
+        Pregnancy = Pool().get('gnuhealth.patient.pregnancy')
+        if not items:
+            return 0
+
+        patients = self.resolve_patients([v['doh_id'] for _, _, v in items])
+        vlist = []
+        for number, row, values in items:
+            if values['doh_id'] not in patients:
+                self.write_error(number, row, 'Unknown patient')
+                continue
+            values = values.copy()
+            values['name'] = patients[values.pop('doh_id')]
+            vlist.append(values)
+        if not vlist:
+            return 0
+
+        pregnancies = Pregnancy.create(vlist)
+        return len(pregnancies)
+
+    def create_vaccination(self, items):
+        Vaccination = Pool().get('gnuhealth.vaccination')
+        if not items:
+            return 0
+
+        patients = self.resolve_patients([v['doh_id'] for _, _, v in items])
+        vaccines = self.resolve_vaccines([v['vaccine'] for _, _, v in items])
+        vlist = []
+        for number, row, values in items:
+            if values['doh_id'] not in patients:
+                self.write_error(number, row, 'Unknown patient')
+                continue
+            if values['vaccine'] not in vaccines:
+                self.write_error(number, row, 'Unknown vaccine')
+                continue
+            values = values.copy()
+            values['name'] = patients[values.pop('doh_id')]
+            values['vaccine'] = vaccines[values['vaccine']]
+            vlist.append(values)
+        if not vlist:
+            return 0
+
+        return len(Vaccination.create(vlist))
+
+    def create_evaluation(self, items):
+        Evaluation = Pool().get('gnuhealth.patient.prenatal.evaluation')
+        if not items:
+            return 0
+
+        pregnancies = self.resolve_pregnancies(
+            [(v['doh_id'], v['gravida']) for _, _, v in items])
+        vlist = []
+        for number, row, values in items:
+            key = (values['doh_id'], values['gravida'])
+            if key not in pregnancies:
+                self.write_error(number, row, 'Unknown pregnancy')
+                continue
+            values = values.copy()
+            del values['doh_id'], values['gravida']
+            values['name'] = pregnancies[key]
+            vlist.append(values)
+        if not vlist:
+            return 0
+
+        return len(Evaluation.create(vlist))
+
+
+class MmcImportStart(ModelView):
+    'Import Patient Records'
+    __name__ = 'mmc.import.start'
+
+    data = fields.Binary('File', required=True,
+        help="A CSV file or XLSX spreadsheet with one record per row")
+    filename = fields.Char('File name',
+        help="Used to tell a spreadsheet (.xlsx) from a CSV file")
+
+
+class MmcImportResult(ModelView):
+    'Import Patient Records'
+    __name__ = 'mmc.import.result'
+
+    patients = fields.Integer('Patients', readonly=True)
+    pregnancies = fields.Integer('Pregnancies', readonly=True)
+    vaccinations = fields.Integer('Vaccinations', readonly=True)
+    evaluations = fields.Integer('Prenatal evaluations', readonly=True)
+    errors = fields.Integer('Rows with errors', readonly=True)
+    error_file = fields.Binary('Error file', readonly=True)
+
+
+class MmcImport(Wizard):
+    '''
+    Import patients, pregnancies, vaccinations and prenatal evaluations
+    from a file. Each batch of rows is committed as it is imported.
+    For very large files use import_file() from a script so that the
+    file is read from disk as it is imported.
+    '''
+    __name__ = 'mmc.import'
+
+    start = StateView('mmc.import.start',
+        'mmc.mmc_import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'result', 'tryton-ok', default=True),
+            ])
+    result = StateView('mmc.import.result',
+        'mmc.mmc_import_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    @staticmethod
+    def import_file(fileobj, error_file, filename=None):
+        importer = MmcImporter(error_file)
+        return importer.run(iter_rows(fileobj, filename))
+
+    def default_result(self, fields):
+        error_file = io.BytesIO()
+        counts, errors = self.import_file(io.BytesIO(bytes(self.start.data)),
+            error_file, self.start.filename)
+        return {
+            'patients': counts['patient'],
+            'pregnancies': counts['pregnancy'],
+            'vaccinations': counts['vaccination'],
+            'evaluations': counts['evaluation'],
+            'errors': errors,
+            'error_file': error_file.getvalue() if errors else None,
+            }
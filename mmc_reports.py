@@ -8,17 +8,262 @@ from trytond.pyson import Eval, Not, Bool
 from trytond.pool import Pool
 from trytond.report import Report
 from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateAction, Button
+from trytond.backend import Database
+from trytond.config import CONFIG
 
+import collections
+import csv
 import datetime
+import hashlib
+import io
+import multiprocessing
+import threading
 
 import logging
 
+from .mmc_stats import instrument
+from .mmc_barangay import barangay_key, current_address_query, \
+    current_address_ids
+
 mmcLog = logging.getLogger('mmcReports')
 
 __all__ = [
-    'MmcPrenatalReport'
+    'MmcPrenatalReportStart',
+    'MmcPrenatalReportWizard',
+    'MmcPrenatalReport',
+    'MmcPrenatalReportFact',
+    'MmcPrenatalReportFactRebuildStart',
+    'MmcPrenatalReportFactRebuildResult',
+    'MmcPrenatalReportFactRebuild',
+    'MmcFhsisStart',
+    'MmcFhsisResult',
+    'MmcFhsis',
     ]
 
+# --------------------------------------------------------
+# The prenatal visit periods of the report, by weeks before
+# the due date, 280 days after the LMP: the visits up to 12
+# weeks of pregnancy, from 13 to 27 weeks and after. Also in
+# days of pregnancy for the queries on gestational_days.
+# --------------------------------------------------------
+PDD_DAYS = 280
+WEEKS_12_BEFORE_PDD = 28
+WEEKS_27_BEFORE_PDD = 13
+WEEKS_12_DAYS = PDD_DAYS - WEEKS_12_BEFORE_PDD * 7
+WEEKS_27_DAYS = PDD_DAYS - WEEKS_27_BEFORE_PDD * 7
+
+# --------------------------------------------------------
+# Quality prenatal care needs this many visits after 27
+# weeks, and one in each of the periods before.
+# --------------------------------------------------------
+QUALITY_WEEKS_40_VISITS = 2
+
+
+class MmcPrenatalReportStart(ModelView):
+    'Prenatal Master Report Parameters'
+    __name__ = 'mmc.prenatal.report.start'
+
+    start_date = fields.Date('Start Date', required=True)
+    end_date = fields.Date('End Date', required=True)
+    barangay = fields.Char('Barangay',
+        help="Only include patients with an address in this barangay")
+
+    # --------------------------------------------------------
+    # Default to the current month since that is what the
+    # DOH asks for.
+    # --------------------------------------------------------
+    @staticmethod
+    def default_start_date():
+        return Pool().get('ir.date').today().replace(day=1)
+
+    @staticmethod
+    def default_end_date():
+        today = Pool().get('ir.date').today()
+        nextMonth = (today.replace(day=28) + datetime.timedelta(days=4))
+        return nextMonth - datetime.timedelta(days=nextMonth.day)
+
+
+class MmcPrenatalReportWizard(Wizard):
+    'Prenatal Master Report'
+    __name__ = 'mmc.prenatal.report.print'
+
+    start = StateView('mmc.prenatal.report.start',
+        'mmc.mmc_prenatal_report_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Print', 'print_', 'tryton-print', default=True),
+            ])
+    print_ = StateAction('mmc.mmc_report_prenatal_master')
+
+    def do_print_(self, action):
+        data = {
+            'start_date': self.start.start_date,
+            'end_date': self.start.end_date,
+            'barangay': self.start.barangay,
+            }
+        return action, data
+
+
+# --------------------------------------------------------
+# Escape the wildcards of user input for LIKE ... ESCAPE '!'.
+# --------------------------------------------------------
+def like_escape(value):
+    return value.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+# --------------------------------------------------------
+# State a forked report worker inherited from the Tryton
+# process. It is kept referenced so that the worker never
+# closes the connections the parent is still using.
+# --------------------------------------------------------
+_inheritedState = []
+
+def _init_report_worker():
+    transaction = Transaction()
+    _inheritedState.append(transaction.__dict__.copy())
+    transaction.__dict__.clear()
+    databases = getattr(Database, '_databases', None)
+    if databases is not None:
+        _inheritedState.append(databases.copy())
+        databases.clear()
+
+# --------------------------------------------------------
+# Build the prenatal report rows of one chunk of pregnancies
+# in a worker process over its own database connection.
+# --------------------------------------------------------
+def _prenatal_records_worker(args):
+    database_name, user, context, pregnancy_ids = args
+    with Transaction().start(database_name, user, context=context):
+        Report = Pool().get('gnuhealth.patient.doh.prenatal', type='report')
+        return list(Report.iter_records(pregnancy_ids))
+
+
+class PrenatalCohort(object):
+    '''
+    Loads everything the prenatal master report needs for a set of
+    pregnancies with one bulk read per model: the pregnancies, their
+    patients, the parties, the current address of each party, the
+    prenatal evaluations and the vaccinations. The report rows are
+    then assembled from these in-memory maps instead of following the
+    relations one record at a time.
+    '''
+
+    def __init__(self, pregnancy_ids, history=True):
+        pool = Pool()
+        Pregnancy = pool.get('gnuhealth.patient.pregnancy')
+        Patient = pool.get('gnuhealth.patient')
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        Evaluation = pool.get('gnuhealth.patient.prenatal.evaluation')
+        Vaccination = pool.get('gnuhealth.vaccination')
+        TetanusStatus = pool.get('mmc.tetanus.status')
+
+        self.pregnancy_ids = list(pregnancy_ids)
+
+        self.pregnancies = dict((p['id'], p) for p in Pregnancy.read(
+            self.pregnancy_ids, ['name', 'lmp', 'pdd',
+                'doctor_consult_date', 'dentist_consult_date', 'mb_book',
+                'iodized_salt', 'where_deliver']))
+
+        patient_ids = list(set(p['name'] for p in self.pregnancies.values()))
+        self.patients = dict((p['id'], p) for p in Patient.read(patient_ids,
+            ['name', 'dob', 'age', 'gravida', 'para', 'abortions',
+                'stillbirths', 'phil_health']))
+
+        party_ids = list(set(p['name'] for p in self.patients.values()))
+        self.parties = dict((p['id'], p) for p in Party.read(party_ids,
+            ['name', 'lastname']))
+
+        # --------------------------------------------------------
+        # The current address of a party, the same as the one the
+        # catchment report counts the patient under.
+        # --------------------------------------------------------
+        self.addresses = dict((a['party'], a) for a in Address.read(
+            current_address_ids(party_ids).values(), ['party', 'street']))
+
+        # --------------------------------------------------------
+        # The evaluations and vaccinations are only needed when the
+        # history is not taken from the report facts.
+        # --------------------------------------------------------
+        self.evaluations = dict((i, []) for i in self.pregnancy_ids)
+        self.vaccinations = dict((i, []) for i in patient_ids)
+        if not history:
+            return
+
+        for evaluation in Evaluation.search_read(
+                [('name', 'in', self.pregnancy_ids)],
+                fields_names=['name', 'eval_date_only']):
+            self.evaluations[evaluation['name']].append(evaluation)
+
+        # --------------------------------------------------------
+        # Only the tetanus toxoid doses are shown on the report.
+        # --------------------------------------------------------
+        for vaccination in Vaccination.search_read([
+                    ('name', 'in', patient_ids),
+                    ('vaccine', 'in', TetanusStatus.get_vaccine_ids()),
+                    ], order=[('effective_date', 'ASC')],
+                fields_names=['name', 'effective_date']):
+            self.vaccinations[vaccination['name']].append(vaccination)
+
+    def __iter__(self):
+        for pregnancy_id in self.pregnancy_ids:
+            pregnancy = self.pregnancies[pregnancy_id]
+            patient = self.patients[pregnancy['name']]
+            party = self.parties[patient['name']]
+            yield (pregnancy, patient, party,
+                self.addresses.get(party['id']))
+
+    def get_evaluations(self, pregnancy_id):
+        return self.evaluations[pregnancy_id]
+
+    def get_vaccinations(self, patient_id):
+        return self.vaccinations[patient_id]
+
+
+class RenderedReportCache(object):
+    '''
+    Least recently used cache of rendered report documents, bounded by
+    their total size in bytes. The keys are digests of everything the
+    document depends upon, see MmcPrenatalReport.get_cache_key(), so an
+    entry never has to be invalidated: changed data gives a new key and
+    the old entry is eventually evicted.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_size(value):
+        return sum(len(v) for v in value if isinstance(v, (basestring, buffer)))
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        size = self.get_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.get_size(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.get_size(evicted)
+
+# --------------------------------------------------------
+# Rendered documents kept per server process, in megabytes.
+# --------------------------------------------------------
+REPORT_CACHE = RenderedReportCache(
+    int(CONFIG.get('mmc_report_cache_size') or 64) * 1024 * 1024)
+
 
 class MmcPrenatalReport(Report):
     '''
@@ -28,124 +273,843 @@ class MmcPrenatalReport(Report):
     '''
     __name__ = 'gnuhealth.patient.doh.prenatal'
 
+    # --------------------------------------------------------
+    # Return the start and end dates (inclusive) of the report.
+    # When the report is printed without going through the
+    # wizard, the current month is used.
+    # --------------------------------------------------------
+    @staticmethod
+    def get_date_range(data):
+        Start = Pool().get('mmc.prenatal.report.start')
+        data = data or {}
+        start = data.get('start_date') or Start.default_start_date()
+        end = data.get('end_date') or Start.default_end_date()
+        return start, end
+
+    # --------------------------------------------------------
+    # Find the pregnancies that had a prenatal evaluation within
+    # the date range, and optionally live in the barangay. The
+    # filtering and the de-duplication happen in the database so
+    # that only the pregnancies of the period are ever loaded.
+    # The pregnancies are ordered by their first evaluation in
+    # the period.
+    # --------------------------------------------------------
     @classmethod
-    def parse(cls, report, records, data, localcontext):
+    def get_pregnancy_ids(cls, data):
+        pool = Pool()
+        Evaluation = pool.get('gnuhealth.patient.prenatal.evaluation')
+        Pregnancy = pool.get('gnuhealth.patient.pregnancy')
+        Patient = pool.get('gnuhealth.patient')
+        Address = pool.get('party.address')
+        Barangay = pool.get('mmc.barangay')
+        cursor = Transaction().cursor
+
+        start, end = cls.get_date_range(data)
+        query = ('SELECT e.name FROM "' + Evaluation._table + '" e '
+            'WHERE e.evaluation_date >= %s AND e.evaluation_date < %s ')
+        params = [
+            datetime.datetime.combine(start, datetime.time()),
+            datetime.datetime.combine(end + datetime.timedelta(days=1),
+                datetime.time()),
+            ]
+
+        # --------------------------------------------------------
+        # The barangay of the current address of the patient: the
+        # linked barangay when the name given is one of the list,
+        # else any barangay written like it.
+        # --------------------------------------------------------
+        barangay = (data or {}).get('barangay')
+        if barangay:
+            current, current_params = current_address_query(Address._table)
+            query += ('AND EXISTS (SELECT 1 FROM "' + Pregnancy._table + '" p '
+                'JOIN "' + Patient._table + '" pt ON pt.id = p.name '
+                'JOIN (' + current + ') ca ON ca.party = pt.name ')
+            params.extend(current_params)
+            barangay_id = Barangay.get_key_map().get(barangay_key(barangay))
+            if barangay_id:
+                query += 'WHERE p.id = e.name AND ca.barangay_ref = %s) '
+                params.append(barangay_id)
+            else:
+                query += ('JOIN "' + Address._table + '" a ON a.id = ca.id '
+                    'LEFT JOIN "' + Barangay._table + '" b '
+                    'ON b.id = ca.barangay_ref '
+                    'WHERE p.id = e.name '
+                    "AND (LOWER(a.barangay) LIKE %s ESCAPE '!' "
+                    "OR LOWER(b.name) LIKE %s ESCAPE '!')) ")
+                pattern = '%' + like_escape(barangay.strip().lower()) + '%'
+                params.extend([pattern, pattern])
+
+        query += 'GROUP BY e.name ORDER BY MIN(e.evaluation_date), e.name'
+        cursor.execute(query, params)
+        return [row[0] for row in cursor.fetchall()]
+
+    # --------------------------------------------------------
+    # Number of pregnancies that are loaded into memory at once.
+    # --------------------------------------------------------
+    chunk_size = 1000
+
+    # --------------------------------------------------------
+    # Build the report rows for the pregnancies, loading their
+    # data a chunk at a time. The per pregnancy history comes
+    # from the precomputed report facts.
+    # --------------------------------------------------------
+    @classmethod
+    def iter_records(cls, pregnancy_ids):
+        pool = Pool()
+        Fact = pool.get('mmc.prenatal.report.fact')
+        Risk = pool.get('mmc.risk.code')
+        for i in range(0, len(pregnancy_ids), cls.chunk_size):
+            chunk = pregnancy_ids[i:i + cls.chunk_size]
+            cohort = PrenatalCohort(chunk, history=False)
+            histories = Fact.get_histories(chunk)
+            riskcodes = Risk.get_codes(chunk)
+            for preg, patient, party, address in cohort:
+                yield cls.get_record(preg, patient, party, address,
+                    histories[preg['id']], riskcodes.get(preg['id'], ''))
+
+    # --------------------------------------------------------
+    # Compute the parts of a report row that depend upon the
+    # history of the pregnancy: the prenatal visits, the tetanus
+    # vaccinations, the consultations and the quality of care.
+    # These are what mmc.prenatal.report.fact stores.
+    # --------------------------------------------------------
+    @classmethod
+    def get_history(cls, preg, evals, vacs):
+        history = {}
+
+        # --------------------------------------------------------
+        # Date of registration.
+        # Find the earliest prenatal evaluation for this pregnancy and use that
+        # as the registration date.
+        # --------------------------------------------------------
+        evalDates = [e['eval_date_only'] for e in evals]
+        history['registration_date'] = min(evalDates)
+
+        # --------------------------------------------------------
+        # Prenatal visits.
+        # --------------------------------------------------------
+        weeks12Cut = preg['pdd'] - datetime.timedelta(
+            weeks=WEEKS_12_BEFORE_PDD)
+        weeks27Cut = preg['pdd'] - datetime.timedelta(
+            weeks=WEEKS_27_BEFORE_PDD)
+        history['weeks_to_12'] = " ".join([d.strftime("%m/%d/%Y") \
+                for d in evalDates if d < weeks12Cut])
+        history['weeks_to_27'] = " ".join([d.strftime("%m/%d/%Y") \
+                for d in evalDates if d > weeks12Cut and d < weeks27Cut])
+        history['weeks_to_40'] = " ".join([d.strftime("%m/%d/%Y") \
+                for d in evalDates if d > weeks27Cut])
+
+        # --------------------------------------------------------
+        # Tetanus toxoid doses. Historical doses with an unknown
+        # date are left out, approximate dates are on the first
+        # day of their month or year.
+        # --------------------------------------------------------
+        ttprev = []
+        ttcurr = []
+        for v in vacs:
+            vdate = v['effective_date']
+            if vdate is None:
+                continue
+            if preg['lmp'] and vdate < preg['lmp']:
+                ttprev.append(vdate)
+            else:
+                ttcurr.append(vdate)
+        history['tt_prev'] = " ".join(d.strftime("%m/%d/%Y") for d in ttprev)
+        history['tt_curr'] = " ".join(d.strftime("%m/%d/%Y") for d in ttcurr)
+
+        # --------------------------------------------------------
+        # Doctor/Dentist consultations.
+        # --------------------------------------------------------
+        history['doctor_consult'] = preg['doctor_consult_date']
+        history['dentist_consult'] = preg['dentist_consult_date']
+
+        # --------------------------------------------------------
+        # 'Quality' prenatal care depends upon:
+        #   - A doctor and dentist consultation.
+        #   - A prenatal visit in each of the first 2 trimesters.
+        #   - 2 prenatal visits in the 3rd trimester.
+        # --------------------------------------------------------
+        history['quality'] = bool(history['doctor_consult'] and
+                        history['dentist_consult'] and
+                        history['weeks_to_12'] and
+                        history['weeks_to_27'] and
+                        len(history['weeks_to_40'].split())
+                            >= QUALITY_WEEKS_40_VISITS)
+
+        return history
+
+    # --------------------------------------------------------
+    # The months between start and end, both included, as
+    # (first day, last day) clamped to the range.
+    # --------------------------------------------------------
+    @staticmethod
+    def get_months(start, end):
+        months = []
+        month = start.replace(day=1)
+        while month <= end:
+            next_month = (month.replace(day=28)
+                + datetime.timedelta(days=4)).replace(day=1)
+            months.append((max(month, start),
+                    min(next_month - datetime.timedelta(days=1), end)))
+            month = next_month
+        return months
+
+    # --------------------------------------------------------
+    # The monthly aggregate indicators the DOH asks for beside
+    # the prenatal master list, with a few grouped queries per
+    # month and no record loaded:
+    #   - registrations: pregnancies with their first prenatal
+    #     visit in the month,
+    #   - first_trimester: of those, the ones first seen up to
+    #     12 weeks,
+    #   - tt2: of those, the mothers with 2 or more tetanus
+    #     toxoid doses by the end of the month,
+    #   - four_visits: pregnancies with their 4th visit in the
+    #     month,
+    #   - deliveries: pregnancies that ended in the month, by
+    #     delivery mode of the labor record, and how many of
+    #     them had quality prenatal care, as get_history()
+    #     defines it, using the stored gestational days.
+    # --------------------------------------------------------
+    @classmethod
+    def get_indicators(cls, start, end):
+        pool = Pool()
+        Pregnancy = pool.get('gnuhealth.patient.pregnancy')
+        Evaluation = pool.get('gnuhealth.patient.prenatal.evaluation')
+        Vaccination = pool.get('gnuhealth.vaccination')
+        Perinatal = pool.get('gnuhealth.perinatal')
+        TetanusStatus = pool.get('mmc.tetanus.status')
+        cursor = Transaction().cursor
+
+        vaccine_ids = TetanusStatus.get_vaccine_ids()
+        if vaccine_ids:
+            tt_clause = ('v.vaccine IN ('
+                + ','.join(('%s',) * len(vaccine_ids)) + ')')
+        else:
+            tt_clause = '1 = 0'
+
+        registrations = ('SELECT COUNT(*), '
+                'SUM(CASE WHEN r.first_days < %s THEN 1 ELSE 0 END), '
+                'SUM(CASE WHEN (SELECT COUNT(*) '
+                    'FROM "' + Vaccination._table + '" v '
+                    'WHERE v.name = p.name AND ' + tt_clause + ' '
+                    'AND v.effective_date <= %s) >= 2 THEN 1 ELSE 0 END) '
+            'FROM (SELECT e.name AS pregnancy, '
+                    'MIN(e.eval_date_only) AS registered, '
+                    'MIN(e.gestational_days) AS first_days '
+                'FROM "' + Evaluation._table + '" e '
+                'WHERE e.name IN (SELECT name FROM "' + Evaluation._table
+                    + '" WHERE eval_date_only >= %s AND eval_date_only <= %s) '
+                'GROUP BY e.name) r '
+            'JOIN "' + Pregnancy._table + '" p ON p.id = r.pregnancy '
+            'WHERE r.registered >= %s')
+        four_visits = ('SELECT COUNT(*) FROM "' + Evaluation._table + '" e '
+            'WHERE e.eval_date_only >= %s AND e.eval_date_only <= %s '
+            'AND (SELECT COUNT(*) FROM "' + Evaluation._table + '" e2 '
+                'WHERE e2.name = e.name '
+                'AND (e2.evaluation_date < e.evaluation_date '
+                    'OR (e2.evaluation_date = e.evaluation_date '
+                        'AND e2.id < e.id))) = 3')
+        delivered = ('FROM "' + Pregnancy._table + '" p '
+            'WHERE p.pregnancy_end_date >= %s AND p.pregnancy_end_date < %s ')
+        quality = ('AND p.doctor_consult_date IS NOT NULL '
+            'AND p.dentist_consult_date IS NOT NULL '
+            'AND EXISTS (SELECT 1 FROM "' + Evaluation._table + '" e '
+                'WHERE e.name = p.id AND e.gestational_days < %s) '
+            'AND EXISTS (SELECT 1 FROM "' + Evaluation._table + '" e '
+                'WHERE e.name = p.id AND e.gestational_days > %s '
+                'AND e.gestational_days < %s) '
+            'AND (SELECT COUNT(*) FROM "' + Evaluation._table + '" e '
+                'WHERE e.name = p.id AND e.gestational_days > %s) >= %s')
+        modes = ('SELECT l.start_labor_mode, COUNT(DISTINCT p.id) '
+            'FROM "' + Pregnancy._table + '" p '
+            'JOIN "' + Perinatal._table + '" l ON l.name = p.id '
+            'WHERE p.pregnancy_end_date >= %s AND p.pregnancy_end_date < %s '
+            'GROUP BY l.start_labor_mode')
+
+        result = []
+        for first, last in cls.get_months(start, end):
+            after = datetime.datetime.combine(first, datetime.time())
+            before = datetime.datetime.combine(
+                last + datetime.timedelta(days=1), datetime.time())
+            month = {'month': first}
+
+            cursor.execute(registrations, [WEEKS_12_DAYS] + vaccine_ids
+                + [last, first, last, first])
+            count, first_trimester, tt2 = cursor.fetchone()
+            month['registrations'] = count or 0
+            month['first_trimester'] = first_trimester or 0
+            month['tt2'] = tt2 or 0
+
+            cursor.execute(four_visits, (first, last))
+            month['four_visits'] = cursor.fetchone()[0]
+
+            cursor.execute('SELECT COUNT(*) ' + delivered, (after, before))
+            month['deliveries'] = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) ' + delivered + quality,
+                (after, before, WEEKS_12_DAYS, WEEKS_12_DAYS, WEEKS_27_DAYS,
+                    WEEKS_27_DAYS, QUALITY_WEEKS_40_VISITS))
+            month['quality'] = cursor.fetchone()[0]
+
+            month['modes'] = {}
+            cursor.execute(modes, (after, before))
+            for mode, count in cursor.fetchall():
+                month['modes'][mode or ''] = count
+            result.append(month)
+        return result
+
+    @classmethod
+    def get_record(cls, preg, patient, party, address, history,
+            riskcode=''):
+        rec = {}
+        # --------------------------------------------------------
+        # Page 1
+        # --------------------------------------------------------
+
+        # --------------------------------------------------------
+        # General information.
+        # --------------------------------------------------------
+        rec['lastname'] = party['lastname']
+        rec['firstname'] = party['name']
+        rec['dob'] = patient['dob'].strftime("%m/%d/%Y")
+        rec['age'] = patient['age'].split(" ")[0].rstrip('y')
+        rec['lmp'] = preg['lmp'].strftime("%m/%d/%Y")
+        rec['edd'] = preg['pdd'].strftime("%m/%d/%Y")
+
+        # --------------------------------------------------------
+        # The current address of the patient, see PrenatalCohort.
+        # --------------------------------------------------------
+        rec['address'] = (address and address['street']) or ''
+
+        rec['dateReg'] = history['registration_date'].strftime("%m/%d/%Y")
+
+        # --------------------------------------------------------
+        # GPAS.
+        # --------------------------------------------------------
+        g,p,a,s = [((x and x) or 0) for x in [patient['gravida'], \
+            patient['para'], patient['abortions'], patient['stillbirths']]]
+        rec['gpas'] = "%d , %d , %d , %d" % (g,p,a,s)
+
+        # --------------------------------------------------------
+        # Prenatal visits.
+        # --------------------------------------------------------
+        rec['weeksTo12'] = history['weeks_to_12']
+        rec['weeksTo27'] = history['weeks_to_27']
+        rec['weeksTo40'] = history['weeks_to_40']
+
+        # --------------------------------------------------------
+        # Page 2 of the report.
+        # --------------------------------------------------------
+
+        # --------------------------------------------------------
+        # Risk code, see mmc.risk.code.
+        # --------------------------------------------------------
+        rec['riskcode'] = riskcode
+
+        # --------------------------------------------------------
+        # Tetanus.
+        # --------------------------------------------------------
+        rec['ttprev'] = history['tt_prev']
+        rec['ttcurr'] = history['tt_curr']
+
+        # --------------------------------------------------------
+        # Doctor/Dentist consultations.
+        # --------------------------------------------------------
+        rec['doctor_consult'] = history['doctor_consult']
+        rec['dentist_consult'] = history['dentist_consult']
 
+        rec['phil_health'] = (patient['phil_health'] and 'Y') or 'N'
+
+        # --------------------------------------------------------
+        # Per Krys, this is hard-coded.
         # --------------------------------------------------------
-        # TODO: set the date range.
-        # --------------------------------------------------------
-        evals = Pool().get('gnuhealth.patient.prenatal.evaluation').search([])
-        pregnancies = list(set([e.name for e in evals]))
-
-        recs = []
-        for preg in pregnancies:
-            rec = {}
-            # --------------------------------------------------------
-            # Page 1
-            # --------------------------------------------------------
-
-            # --------------------------------------------------------
-            # General information.
-            # --------------------------------------------------------
-            rec['lastname'] = preg.name.lastname
-            rec['firstname'] = preg.name.name.name
-            rec['dob'] = preg.name.dob.strftime("%m/%d/%Y")
-            rec['age'] = preg.name.age.split(" ")[0].rstrip('y')
-            rec['lmp'] = preg.lmp.strftime("%m/%d/%Y")
-            rec['edd'] = preg.pdd.strftime("%m/%d/%Y")
-
-            # --------------------------------------------------------
-            # TODO: check if this logic is right to get the address.
-            # Assumes first address is of the patient.
-            # --------------------------------------------------------
-            rec['address'] = preg.name.name.addresses[0].street
-
-            # --------------------------------------------------------
-            # Date of registration.
-            # Find the earliest prenatal evaluation for this pregnancy and use that
-            # as the registration date.
-            # --------------------------------------------------------
-            rec['dateReg'] = min([e.eval_date_only for e in \
-                preg.prenatal_evaluations]).strftime("%m/%d/%Y")
-
-            # --------------------------------------------------------
-            # GPAS.
-            # --------------------------------------------------------
-            g,p,a,s = [((x and x) or 0) for x in [preg.name.gravida, \
-                preg.name.para, preg.name.abortions, preg.name.stillbirths]]
-            rec['gpas'] = "%d , %d , %d , %d" % (g,p,a,s)
-
-            # --------------------------------------------------------
-            # Prenatal visits.
-            # --------------------------------------------------------
-            weeks12Cut = preg.pdd - datetime.timedelta(weeks=28)
-            weeks27Cut = preg.pdd - datetime.timedelta(weeks=13)
-            rec['weeksTo12'] = " ".join([e.eval_date_only.strftime("%m/%d/%Y") \
-                    for e in preg.prenatal_evaluations \
-                    if e.eval_date_only < weeks12Cut])
-            rec['weeksTo27'] = " ".join([e.eval_date_only.strftime("%m/%d/%Y") \
-                    for e in preg.prenatal_evaluations \
-                    if e.eval_date_only > weeks12Cut and e.eval_date_only < weeks27Cut])
-            rec['weeksTo40'] = " ".join([e.eval_date_only.strftime("%m/%d/%Y") \
-                    for e in preg.prenatal_evaluations \
-                    if e.eval_date_only > weeks27Cut])
-
-            # --------------------------------------------------------
-            # Page 2 of the report.
-            # --------------------------------------------------------
-
-            # --------------------------------------------------------
-            # Risk code.
-            # --------------------------------------------------------
-            rec['riskcode'] = 'TBD'
-
-            # --------------------------------------------------------
-            # Tetanus.
-            # --------------------------------------------------------
-            vacs = preg.name.vaccinations
-            ttprev = []
-            ttcurr = []
-            for v in vacs:
-                vdate = v.cdate
-                if vdate < preg.lmp:
-                    ttprev.append(vdate)
-                else:
-                    ttcurr.append(vdate)
-            rec['ttprev'] = " ".join(d.strftime("%m/%d/%Y") for d in ttprev)
-            rec['ttcurr'] = " ".join(d.strftime("%m/%d/%Y") for d in ttcurr)
-
-            # --------------------------------------------------------
-            # Doctor/Dentist consultations.
-            # --------------------------------------------------------
-            rec['doctor_consult'] = preg.doctor_consult_date
-            rec['dentist_consult'] = preg.dentist_consult_date
-
-            rec['phil_health'] = (preg.name.phil_health and 'Y') or 'N'
-
-            # --------------------------------------------------------
-            # Per Krys, this is hard-coded.
-            # --------------------------------------------------------
-            rec['partner'] = 'Midwife'
-
-            rec['mb_book'] = (preg.mb_book and 'Y') or 'N'
-            rec['iodized_salt'] = (preg.iodized_salt and 'Y') or 'N'
-
-            # --------------------------------------------------------
-            # 'Quality' prenatal care depends upon:
-            #   - A doctor and dentist consultation.
-            #   - A prenatal visit in each of the first 2 trimesters.
-            #   - 2 prenatal visits in the 3rd trimester.
-            # --------------------------------------------------------
-            rec['quality'] = ((rec['doctor_consult'] and
-                            rec['dentist_consult'] and
-                            rec['weeksTo12'] and
-                            rec['weeksTo27'] and
-                            len(rec['weeksTo40'].split()) >= 2) and 'Y') or 'N'
-
-            rec['where_deliver'] = preg.where_deliver
-
-            recs.append(rec)
-
-        records = recs
+        rec['partner'] = 'Midwife'
+
+        rec['mb_book'] = (preg['mb_book'] and 'Y') or 'N'
+        rec['iodized_salt'] = (preg['iodized_salt'] and 'Y') or 'N'
+
+        rec['quality'] = (history['quality'] and 'Y') or 'N'
+
+        rec['where_deliver'] = preg['where_deliver']
+
+        return rec
+
+    # --------------------------------------------------------
+    # Reports with more pregnancies than this, e.g. annual or
+    # multi-year submissions, can be built in parallel by a pool
+    # of worker processes, a chunk of pregnancies per task. It is
+    # off unless the mmc_report_processes option of trytond.conf
+    # is set to the number of processes, 0 meaning the number of
+    # CPUs.
+    #
+    # The workers are forked from the server process and read
+    # over their own database connections:
+    #  - they only see committed data, so a caller that changed
+    #    pregnancies in the same transaction must build the
+    #    report with mmc_report_serial in the context;
+    #  - forking a threaded server only copies the thread that
+    #    forks, and a lock held by another thread at that moment
+    #    stays held in the workers. This is not supported while
+    #    other transactions are running, so the report is built
+    #    serially when another cursor of the database is open.
+    #    Enable it on a server that runs the large reports
+    #    outside of busy hours.
+    # --------------------------------------------------------
+    parallel_threshold = 5000
+
+    # --------------------------------------------------------
+    # Whether a transaction other than the current one holds a
+    # connection of the database of the server process.
+    # --------------------------------------------------------
+    @staticmethod
+    def other_cursors(database_name):
+        database = getattr(Database, '_databases', {}).get(database_name)
+        used = getattr(getattr(database, '_connpool', None), '_used', None)
+        return bool(used) and len(used) > 1
+
+    @staticmethod
+    def get_processes():
+        processes = CONFIG.get('mmc_report_processes')
+        if processes in (None, '', False):
+            return 1
+        if int(processes):
+            return int(processes)
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+    # --------------------------------------------------------
+    # Build the report rows, in parallel for large reports. The
+    # workers each build whole chunks with iter_records() and the
+    # chunks are put back in their original order, so the rows
+    # are the same as when they are built serially. SQLite
+    # databases are not shared with other processes and are
+    # always done serially.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument('gnuhealth.patient.doh.prenatal.get_records')
+    def get_records(cls, pregnancy_ids):
+        processes = cls.get_processes()
+        if (len(pregnancy_ids) <= cls.parallel_threshold
+                or processes < 2
+                or CONFIG['db_type'] == 'sqlite'
+                or Transaction().context.get('mmc_report_serial')):
+            return list(cls.iter_records(pregnancy_ids))
+
+        transaction = Transaction()
+        if cls.other_cursors(transaction.cursor.database_name):
+            mmcLog.warning('Building the prenatal report serially as '
+                'other transactions are running')
+            return list(cls.iter_records(pregnancy_ids))
+        tasks = [(transaction.cursor.database_name, transaction.user,
+                transaction.context, pregnancy_ids[i:i + cls.chunk_size])
+            for i in range(0, len(pregnancy_ids), cls.chunk_size)]
+        mmcLog.info('Building %d prenatal report rows with %d processes'
+            % (len(pregnancy_ids), processes))
+        workers = multiprocessing.Pool(processes,
+            initializer=_init_report_worker)
+        try:
+            chunks = workers.map(_prenatal_records_worker, tasks, 1)
+        finally:
+            workers.close()
+            workers.join()
+        return [rec for chunk in chunks for rec in chunk]
+
+    # --------------------------------------------------------
+    # A stamp of the data of the pregnancies the report is made
+    # of: the number of rows and the latest change of each model
+    # the report reads, including the facts and risk codes which
+    # are recreated whenever their inputs change, and the
+    # evaluations and vaccinations the facts are computed from
+    # so that the stamp does not rely on the facts being up to
+    # date. The tetanus toxoid products are in it as renaming a
+    # product can add or remove doses.
+    # --------------------------------------------------------
+    @classmethod
+    def get_data_stamp(cls, pregnancy_ids):
+        pool = Pool()
+        Pregnancy = pool.get('gnuhealth.patient.pregnancy')
+        Patient = pool.get('gnuhealth.patient')
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        Evaluation = pool.get('gnuhealth.patient.prenatal.evaluation')
+        Vaccination = pool.get('gnuhealth.vaccination')
+        Fact = pool.get('mmc.prenatal.report.fact')
+        Risk = pool.get('mmc.risk.code')
+        TetanusStatus = pool.get('mmc.tetanus.status')
+        cursor = Transaction().cursor
+
+        patients = ('SELECT name FROM "' + Pregnancy._table + '" '
+            'WHERE id IN (%s)')
+        parties = 'SELECT name FROM "' + Patient._table + '" WHERE id IN (' \
+            + patients + ')'
+        queries = [
+            (Pregnancy._table, 'id IN (%s)'),
+            (Evaluation._table, 'name IN (%s)'),
+            (Fact._table, 'pregnancy IN (%s)'),
+            (Risk._table, 'pregnancy IN (%s)'),
+            (Patient._table, 'id IN (' + patients + ')'),
+            (Vaccination._table, 'name IN (' + patients + ')'),
+            (Party._table, 'id IN (' + parties + ')'),
+            (Address._table, 'party IN (' + parties + ')'),
+            ]
+        stamp = [sorted(TetanusStatus.get_vaccine_ids())]
+        for table, where in queries:
+            count, last = 0, None
+            for i in range(0, len(pregnancy_ids), cursor.IN_MAX):
+                sub_ids = pregnancy_ids[i:i + cursor.IN_MAX]
+                cursor.execute('SELECT COUNT(*), '
+                    'MAX(COALESCE(write_date, create_date)) '
+                    'FROM "' + table + '" WHERE '
+                    + where % ','.join(('%s',) * len(sub_ids)), sub_ids)
+                sub_count, sub_last = cursor.fetchone()
+                count += sub_count
+                if sub_last is not None and (last is None or sub_last > last):
+                    last = sub_last
+            stamp.append((table, count, str(last)))
+        return stamp
+
+    # --------------------------------------------------------
+    # The key of a rendered document: the report and its
+    # template, the parameters, the language, the data stamp of
+    # the pregnancies on it and today's date, as the ages and the
+    # risk codes from them depend on it.
+    # --------------------------------------------------------
+    @classmethod
+    def get_cache_key(cls, pregnancy_ids, data):
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        transaction = Transaction()
+        action_reports = ActionReport.search([
+                ('report_name', '=', cls.__name__),
+                ])
+        template = [(a.id, str(a.write_date or a.create_date))
+            for a in action_reports]
+        start, end = cls.get_date_range(data)
+        key = repr((transaction.cursor.database_name, cls.__name__, template,
+                str(start), str(end), (data or {}).get('barangay') or '',
+                transaction.language, str(pool.get('ir.date').today()),
+                pregnancy_ids, cls.get_data_stamp(pregnancy_ids)))
+        return hashlib.sha1(key).hexdigest()
+
+    # --------------------------------------------------------
+    # Serve the same document again when nothing it is made of
+    # has changed since it was rendered, e.g. for reprints. The
+    # mmc_report_nocache context key renders it anew.
+    # --------------------------------------------------------
+    @classmethod
+    def execute(cls, ids, data):
+        data = dict(data or {})
+        pregnancy_ids = cls.get_pregnancy_ids(data)
+        data['pregnancy_ids'] = pregnancy_ids
+        if Transaction().context.get('mmc_report_nocache'):
+            return super(MmcPrenatalReport, cls).execute(ids, data)
+        key = cls.get_cache_key(pregnancy_ids, data)
+        result = REPORT_CACHE.get(key)
+        if result is not None:
+            mmcLog.info('Prenatal report served from the cache')
+            return result
+        result = super(MmcPrenatalReport, cls).execute(ids, data)
+        REPORT_CACHE.set(key, result)
+        return result
+
+    @classmethod
+    @instrument('gnuhealth.patient.doh.prenatal.parse',
+        count=lambda cls, report, records, data, localcontext:
+            len((data or {}).get('pregnancy_ids') or ()))
+    def parse(cls, report, records, data, localcontext):
+        pregnancy_ids = (data or {}).get('pregnancy_ids')
+        if pregnancy_ids is None:
+            pregnancy_ids = cls.get_pregnancy_ids(data)
+        records = cls.get_records(pregnancy_ids)
+        localcontext['start_date'], localcontext['end_date'] = \
+            cls.get_date_range(data)
+        localcontext['barangay'] = (data or {}).get('barangay') or ''
         return super(MmcPrenatalReport, cls).parse(report, records, data, localcontext)
 
+
+class MmcPrenatalReportFact(ModelSQL, ModelView):
+    '''
+    One row per pregnancy holding the parts of the prenatal master
+    report that depend upon the history of the pregnancy. The rows are
+    kept up to date whenever a prenatal evaluation, a vaccination, a
+    tetanus toxoid product or the pregnancy fields they are computed
+    from are written so that printing the report does not recompute
+    the history of every pregnancy.
+    '''
+    __name__ = 'mmc.prenatal.report.fact'
+
+    pregnancy = fields.Many2One('gnuhealth.patient.pregnancy', 'Pregnancy',
+        required=True, readonly=True, select=True, ondelete='CASCADE')
+    registration_date = fields.Date('Registration', readonly=True,
+        select=True)
+    weeks_to_12 = fields.Char('Visits to 12 weeks', readonly=True)
+    weeks_to_27 = fields.Char('Visits to 27 weeks', readonly=True)
+    weeks_to_40 = fields.Char('Visits to 40 weeks', readonly=True)
+    tt_prev = fields.Char('TT before LMP', readonly=True)
+    tt_curr = fields.Char('TT current', readonly=True)
+    doctor_consult = fields.Date('Dr consult date', readonly=True)
+    dentist_consult = fields.Date('Dentist consult date', readonly=True)
+    quality = fields.Boolean('Quality care', readonly=True)
+
+    # --------------------------------------------------------
+    # The fields that hold the history computed by
+    # MmcPrenatalReport.get_history().
+    # --------------------------------------------------------
+    _history_fields = ['registration_date', 'weeks_to_12', 'weeks_to_27',
+        'weeks_to_40', 'tt_prev', 'tt_curr', 'doctor_consult',
+        'dentist_consult', 'quality']
+
+    # --------------------------------------------------------
+    # The fields of the pregnancy the history is computed from,
+    # the due date being computed from the LMP.
+    # --------------------------------------------------------
+    _pregnancy_fields = ['name', 'lmp', 'doctor_consult_date',
+        'dentist_consult_date']
+
+    @classmethod
+    def __setup__(cls):
+        super(MmcPrenatalReportFact, cls).__setup__()
+        cls._sql_constraints += [
+            ('pregnancy_uniq', 'UNIQUE(pregnancy)',
+                'The pregnancy already has a report fact !'),
+        ]
+
+    # --------------------------------------------------------
+    # Compute the history of the pregnancies from their current
+    # data. Pregnancies without a prenatal evaluation do not
+    # appear on the report and have no history.
+    # --------------------------------------------------------
+    @classmethod
+    def compute(cls, pregnancy_ids):
+        Report = Pool().get('gnuhealth.patient.doh.prenatal', type='report')
+        result = {}
+        for i in range(0, len(pregnancy_ids), Report.chunk_size):
+            cohort = PrenatalCohort(pregnancy_ids[i:i + Report.chunk_size])
+            for preg, patient, party, address in cohort:
+                evals = cohort.get_evaluations(preg['id'])
+                if not evals:
+                    continue
+                result[preg['id']] = Report.get_history(preg, evals,
+                    cohort.get_vaccinations(patient['id']))
+        return result
+
+    # --------------------------------------------------------
+    # Convert a stored fact into the history computed by the
+    # report. Empty strings may come back from the database as
+    # None.
+    # --------------------------------------------------------
+    @classmethod
+    def get_history(cls, fact):
+        history = dict((f, fact[f]) for f in cls._history_fields)
+        for f in ('weeks_to_12', 'weeks_to_27', 'weeks_to_40', 'tt_prev',
+                'tt_curr'):
+            history[f] = history[f] or ''
+        history['quality'] = bool(history['quality'])
+        return history
+
+    # --------------------------------------------------------
+    # Return the history of the pregnancies for the report, from
+    # the stored facts when there are some.
+    # --------------------------------------------------------
+    @classmethod
+    @instrument('mmc.prenatal.report.fact.get_histories')
+    def get_histories(cls, pregnancy_ids):
+        result = {}
+        for fact in cls.search_read([('pregnancy', 'in', pregnancy_ids)],
+                fields_names=['pregnancy'] + cls._history_fields):
+            result[fact['pregnancy']] = cls.get_history(fact)
+        missing = [i for i in pregnancy_ids if i not in result]
+        if missing:
+            result.update(cls.compute(missing))
+        return result
+
+    # --------------------------------------------------------
+    # Recompute the facts of the pregnancies. Called whenever
+    # something the report depends upon is written.
+    # --------------------------------------------------------
+    @classmethod
+    def update_pregnancies(cls, pregnancy_ids):
+        pregnancy_ids = list(set(i for i in pregnancy_ids if i))
+        if not pregnancy_ids:
+            return
+        cls.delete(cls.search([('pregnancy', 'in', pregnancy_ids)]))
+        vlist = []
+        for pregnancy_id, history in cls.compute(pregnancy_ids).items():
+            values = history.copy()
+            values['pregnancy'] = pregnancy_id
+            vlist.append(values)
+        if vlist:
+            cls.create(vlist)
+
+    # --------------------------------------------------------
+    # Compare the stored facts with freshly computed ones and
+    # optionally replace the ones that differ. Returns the number
+    # of pregnancies checked and the ids of those whose facts were
+    # missing, stale or should not exist.
+    # --------------------------------------------------------
+    @classmethod
+    def rebuild(cls, check_only=False):
+        Evaluation = Pool().get('gnuhealth.patient.prenatal.evaluation')
+        cursor = Transaction().cursor
+
+        cursor.execute('SELECT DISTINCT name FROM "' + Evaluation._table +
+            '" WHERE name IS NOT NULL')
+        pregnancy_ids = sorted(row[0] for row in cursor.fetchall())
+        cursor.execute('SELECT pregnancy FROM "' + cls._table + '"')
+        stored_ids = set(row[0] for row in cursor.fetchall())
+
+        wrong = sorted(stored_ids - set(pregnancy_ids))
+        if wrong and not check_only:
+            cls.delete(cls.search([('pregnancy', 'in', wrong)]))
+
+        chunk_size = Pool().get('gnuhealth.patient.doh.prenatal',
+            type='report').chunk_size
+        for i in range(0, len(pregnancy_ids), chunk_size):
+            chunk = pregnancy_ids[i:i + chunk_size]
+            stored = {}
+            for fact in cls.search_read([('pregnancy', 'in', chunk)],
+                    fields_names=['pregnancy'] + cls._history_fields):
+                stored[fact['pregnancy']] = cls.get_history(fact)
+            stale = [pregnancy_id
+                for pregnancy_id, history in cls.compute(chunk).items()
+                if stored.get(pregnancy_id) != history]
+            wrong.extend(stale)
+            if stale and not check_only:
+                cls.update_pregnancies(stale)
+
+        if wrong:
+            mmcLog.info('%d prenatal report facts were out of date'
+                % len(wrong))
+        return len(pregnancy_ids), wrong
+
+
+class MmcPrenatalReportFactRebuildStart(ModelView):
+    'Rebuild Prenatal Report Facts'
+    __name__ = 'mmc.prenatal.report.fact.rebuild.start'
+
+    check_only = fields.Boolean('Check only',
+        help="Only report the facts that are out of date without fixing them")
+
+
+class MmcPrenatalReportFactRebuildResult(ModelView):
+    'Rebuild Prenatal Report Facts'
+    __name__ = 'mmc.prenatal.report.fact.rebuild.result'
+
+    checked = fields.Integer('Pregnancies checked', readonly=True)
+    out_of_date = fields.Integer('Out of date', readonly=True)
+    pregnancies = fields.Text('Pregnancy ids', readonly=True)
+
+
+class MmcPrenatalReportFactRebuild(Wizard):
+    'Rebuild Prenatal Report Facts'
+    __name__ = 'mmc.prenatal.report.fact.rebuild'
+
+    start = StateView('mmc.prenatal.report.fact.rebuild.start',
+        'mmc.mmc_prenatal_report_fact_rebuild_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Run', 'result', 'tryton-ok', default=True),
+            ])
+    result = StateView('mmc.prenatal.report.fact.rebuild.result',
+        'mmc.mmc_prenatal_report_fact_rebuild_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_result(self, fields):
+        Fact = Pool().get('mmc.prenatal.report.fact')
+        checked, wrong = Fact.rebuild(check_only=self.start.check_only)
+        return {
+            'checked': checked,
+            'out_of_date': len(wrong),
+            'pregnancies': " ".join(str(i) for i in wrong),
+            }
+
+
+class MmcFhsisStart(ModelView):
+    'FHSIS Indicators'
+    __name__ = 'mmc.fhsis.start'
+
+    start_date = fields.Date('Start Date', required=True)
+    end_date = fields.Date('End Date', required=True)
+
+    # --------------------------------------------------------
+    # Default to the year to date.
+    # --------------------------------------------------------
+    @staticmethod
+    def default_start_date():
+        return Pool().get('ir.date').today().replace(month=1, day=1)
+
+    @staticmethod
+    def default_end_date():
+        return Pool().get('mmc.prenatal.report.start').default_end_date()
+
+
+class MmcFhsisResult(ModelView):
+    'FHSIS Indicators'
+    __name__ = 'mmc.fhsis.result'
+
+    details = fields.Text('Indicators', readonly=True)
+    data = fields.Binary('File', readonly=True, filename='filename')
+    filename = fields.Char('File name', readonly=True)
+
+
+class MmcFhsis(Wizard):
+    'FHSIS Indicators'
+    __name__ = 'mmc.fhsis'
+
+    start = StateView('mmc.fhsis.start',
+        'mmc.mmc_fhsis_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Compute', 'result', 'tryton-ok', default=True),
+            ])
+    result = StateView('mmc.fhsis.result',
+        'mmc.mmc_fhsis_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    _indicators = [
+        ('registrations', 'Prenatal registrations'),
+        ('first_trimester', 'Registered in 1st trimester'),
+        ('tt2', 'Registered with TT2 plus'),
+        ('four_visits', 'Reached 4 prenatal visits'),
+        ('deliveries', 'Deliveries'),
+        ('quality', 'Deliveries with quality care'),
+        ]
+
+    def default_result(self, fields):
+        pool = Pool()
+        Report = pool.get('gnuhealth.patient.doh.prenatal', type='report')
+        Perinatal = pool.get('gnuhealth.perinatal')
+        months = Report.get_indicators(self.start.start_date,
+            self.start.end_date)
+
+        rows = [(label, [m[key] for m in months])
+            for key, label in self._indicators]
+        seen = set(mode for m in months for mode in m['modes'])
+        for mode, label in Perinatal.start_labor_mode.selection:
+            if mode in seen:
+                rows.append(('Deliveries ' + label,
+                        [m['modes'].get(mode, 0) for m in months]))
+                seen.discard(mode)
+        if seen:
+            rows.append(('Deliveries mode not recorded',
+                    [sum(c for mode, c in m['modes'].iteritems()
+                            if mode in seen) for m in months]))
+
+        headers = [m['month'].strftime('%b %Y') for m in months]
+        details = ['%-32s ' % '' + ' '.join('%9s' % h for h in headers)]
+        out = io.BytesIO()
+        writer = csv.writer(out)
+        writer.writerow(['Indicator'] + headers)
+        for label, values in rows:
+            details.append('%-32s ' % label
+                + ' '.join('%9d' % v for v in values))
+            writer.writerow([label] + values)
+        return {
+            'details': "\n".join(details),
+            'data': buffer(out.getvalue()),
+            'filename': 'fhsis_%s_%s.csv' % (
+                self.start.start_date.strftime('%Y%m%d'),
+                self.start.end_date.strftime('%Y%m%d')),
+            }
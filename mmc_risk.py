@@ -0,0 +1,278 @@
+# -------------------------------------------------------------------------------
+# mmc_risk.py
+#
+# Obstetric risk codes of the pregnancies as written on the DOH prenatal
+# master report.
+# -------------------------------------------------------------------------------
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, Button
+
+import logging
+import operator
+
+__all__ = [
+    'MmcRiskCode',
+    'MmcRiskCodeRebuildResult',
+    'MmcRiskCodeRebuild',
+    ]
+
+mmcLog = logging.getLogger('mmcRisk')
+
+# --------------------------------------------------------
+# The risk rules, one per code:
+#   (code, description, column, operator, value)
+# A pregnancy gets a code when any of the rules of the code
+# is true. The codes follow the DOH prenatal master list.
+# C (short stature) is not used as the height is not
+# recorded. H and R are MMC additions.
+# --------------------------------------------------------
+RISK_RULES = [
+    ('A', 'Younger than 18', 'age', '<', 18),
+    ('B', 'Older than 35', 'age', '>', 35),
+    ('D', 'Fourth or more baby', 'gravida', '>=', 4),
+    ('D', 'Grand multipara', 'para', '>=', 5),
+    ('E', 'Three or more miscarriages', 'abortions', '>=', 3),
+    ('E', 'Previous stillbirth', 'stillbirths', '>=', 1),
+    ('F', 'Tuberculosis', 'pathologies', 'startswith',
+        ('A15', 'A16', 'A17', 'A18', 'A19')),
+    ('F', 'Heart disease', 'pathologies', 'startswith',
+        ('I05', 'I06', 'I07', 'I08', 'I09', 'I11', 'I20', 'I21', 'I25',
+            'I34', 'I35', 'I42', 'I50')),
+    ('F', 'Diabetes', 'pathologies', 'startswith',
+        ('E10', 'E11', 'E13', 'E14', 'O24')),
+    ('F', 'Bronchial asthma', 'pathologies', 'startswith', ('J45',)),
+    ('F', 'Goiter', 'pathologies', 'startswith',
+        ('E01', 'E04', 'E05')),
+    ('H', 'Hypertensive systolic BP', 'systolic', '>=', 140),
+    ('H', 'Hypertensive diastolic BP', 'diastolic', '>=', 90),
+    ('R', 'Rh negative', 'rh', '==', '-'),
+    ]
+
+RISK_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    'startswith': lambda codes, prefixes: any(c.startswith(prefixes)
+        for c in codes),
+    }
+
+# --------------------------------------------------------
+# Turn the rules into functions taking the column of values
+# of every pregnancy and returning the positions where the
+# rule is true. Done once when the module is loaded.
+# --------------------------------------------------------
+def compile_rules(rules):
+    compiled = []
+    for code, description, column, op, value in rules:
+        def test(values, op=RISK_OPERATORS[op], value=value):
+            return [i for i, v in enumerate(values)
+                if v is not None and op(v, value)]
+        compiled.append((code, column, test))
+    return compiled
+
+COMPILED_RISK_RULES = compile_rules(RISK_RULES)
+RISK_COLUMNS = sorted(set(rule[2] for rule in RISK_RULES))
+
+
+class MmcRiskCode(ModelSQL, ModelView):
+    '''
+    One row per pregnancy holding its obstetric risk codes. The rows are
+    recomputed whenever the patient, one of her conditions or a prenatal
+    evaluation of the pregnancy is written so that the prenatal report
+    and the high risk list only read them.
+    '''
+    __name__ = 'mmc.risk.code'
+
+    pregnancy = fields.Many2One('gnuhealth.patient.pregnancy', 'Pregnancy',
+        required=True, readonly=True, select=True, ondelete='CASCADE')
+    patient = fields.Many2One('gnuhealth.patient', 'Patient', readonly=True,
+        select=True, ondelete='CASCADE')
+    current = fields.Boolean('Current pregnancy', readonly=True, select=True)
+    codes = fields.Char('Risk codes', readonly=True)
+    high_risk = fields.Boolean('High risk', readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(MmcRiskCode, cls).__setup__()
+        cls._sql_constraints += [
+            ('pregnancy_uniq', 'UNIQUE(pregnancy)',
+                'The pregnancy already has risk codes !'),
+        ]
+
+    # --------------------------------------------------------
+    # Load the inputs of the rules for the pregnancies as one
+    # list of values per column, in the order of the ids, with
+    # one query per model.
+    # --------------------------------------------------------
+    @staticmethod
+    def get_columns(pregnancy_ids):
+        pool = Pool()
+        Pregnancy = pool.get('gnuhealth.patient.pregnancy')
+        Patient = pool.get('gnuhealth.patient')
+        Evaluation = pool.get('gnuhealth.patient.prenatal.evaluation')
+        Disease = pool.get('gnuhealth.patient.disease')
+        Pathology = pool.get('gnuhealth.pathology')
+        cursor = Transaction().cursor
+
+        pregnancies = dict((p['id'], p) for p in Pregnancy.read(
+                pregnancy_ids, ['name', 'lmp', 'current_pregnancy']))
+        patient_ids = list(set(p['name'] for p in pregnancies.values()))
+        patients = dict((p['id'], p) for p in Patient.read(patient_ids,
+                ['dob', 'gravida', 'para', 'abortions', 'stillbirths',
+                    'rh']))
+
+        def in_clause(ids):
+            return ','.join(('%s',) * len(ids))
+
+        pressures = {}
+        for i in range(0, len(pregnancy_ids), cursor.IN_MAX):
+            sub_ids = pregnancy_ids[i:i + cursor.IN_MAX]
+            cursor.execute('SELECT name, MAX(systolic), MAX(diastolic) '
+                'FROM "' + Evaluation._table + '" '
+                'WHERE name IN (' + in_clause(sub_ids) + ') '
+                'GROUP BY name', sub_ids)
+            for pregnancy_id, systolic, diastolic in cursor.fetchall():
+                pressures[pregnancy_id] = (systolic, diastolic)
+
+        pathologies = dict((i, []) for i in patient_ids)
+        for i in range(0, len(patient_ids), cursor.IN_MAX):
+            sub_ids = patient_ids[i:i + cursor.IN_MAX]
+            cursor.execute('SELECT d.name, p.code '
+                'FROM "' + Disease._table + '" d '
+                'JOIN "' + Pathology._table + '" p ON p.id = d.pathology '
+                'WHERE d.is_active AND d.name IN (' + in_clause(sub_ids)
+                + ')', sub_ids)
+            for patient_id, code in cursor.fetchall():
+                if code:
+                    pathologies[patient_id].append(code.upper())
+
+        columns = dict((c, []) for c in RISK_COLUMNS + ['patient', 'current'])
+        today = pool.get('ir.date').today()
+        for pregnancy_id in pregnancy_ids:
+            preg = pregnancies[pregnancy_id]
+            patient = patients[preg['name']]
+            dob = patient['dob']
+            at = preg['lmp'] or today
+            columns['patient'].append(preg['name'])
+            columns['current'].append(bool(preg['current_pregnancy']))
+            columns['age'].append(dob and (at.year - dob.year
+                    - ((at.month, at.day) < (dob.month, dob.day))))
+            for column in ('gravida', 'para', 'abortions', 'stillbirths',
+                    'rh'):
+                columns[column].append(patient[column])
+            systolic, diastolic = pressures.get(pregnancy_id, (None, None))
+            columns['systolic'].append(systolic)
+            columns['diastolic'].append(diastolic)
+            columns['pathologies'].append(pathologies[preg['name']])
+        return columns
+
+    # --------------------------------------------------------
+    # Evaluate every rule over the columns of the pregnancies and
+    # return the risk codes of each pregnancy, e.g. 'B D', keyed
+    # by pregnancy id.
+    # --------------------------------------------------------
+    @classmethod
+    def compute(cls, pregnancy_ids):
+        pregnancy_ids = list(set(i for i in pregnancy_ids if i))
+        if not pregnancy_ids:
+            return {}
+        columns = cls.get_columns(pregnancy_ids)
+        codes = [set() for i in pregnancy_ids]
+        for code, column, test in COMPILED_RISK_RULES:
+            for i in test(columns[column]):
+                codes[i].add(code)
+        result = {}
+        for i, pregnancy_id in enumerate(pregnancy_ids):
+            result[pregnancy_id] = {
+                'patient': columns['patient'][i],
+                'current': columns['current'][i],
+                'codes': " ".join(sorted(codes[i])),
+                'high_risk': bool(codes[i]),
+                }
+        return result
+
+    # --------------------------------------------------------
+    # Return the risk codes of the pregnancies, from the stored
+    # rows when there are some.
+    # --------------------------------------------------------
+    @classmethod
+    def get_codes(cls, pregnancy_ids):
+        result = {}
+        for risk in cls.search_read([('pregnancy', 'in', pregnancy_ids)],
+                fields_names=['pregnancy', 'codes']):
+            result[risk['pregnancy']] = risk['codes'] or ''
+        missing = [i for i in pregnancy_ids if i not in result]
+        if missing:
+            result.update((i, risk['codes'])
+                for i, risk in cls.compute(missing).iteritems())
+        return result
+
+    # --------------------------------------------------------
+    # Recompute the risk codes of the pregnancies, or of all the
+    # pregnancies of the patients. Called whenever one of the
+    # inputs of the rules is written.
+    # --------------------------------------------------------
+    @classmethod
+    def update_pregnancies(cls, pregnancy_ids):
+        pregnancy_ids = list(set(i for i in pregnancy_ids if i))
+        if not pregnancy_ids:
+            return
+        cls.delete(cls.search([('pregnancy', 'in', pregnancy_ids)]))
+        vlist = []
+        for pregnancy_id, values in cls.compute(pregnancy_ids).iteritems():
+            values = values.copy()
+            values['pregnancy'] = pregnancy_id
+            vlist.append(values)
+        if vlist:
+            cls.create(vlist)
+
+    @classmethod
+    def update_patients(cls, patient_ids):
+        Pregnancy = Pool().get('gnuhealth.patient.pregnancy')
+        patient_ids = list(set(i for i in patient_ids if i))
+        if patient_ids:
+            cls.update_pregnancies([p.id for p in
+                Pregnancy.search([('name', 'in', patient_ids)])])
+
+    # --------------------------------------------------------
+    # Recompute the risk codes of every pregnancy, e.g. after
+    # the rules have changed.
+    # --------------------------------------------------------
+    @classmethod
+    def rebuild(cls):
+        Pregnancy = Pool().get('gnuhealth.patient.pregnancy')
+        cursor = Transaction().cursor
+        cursor.execute('SELECT id FROM "' + Pregnancy._table + '"')
+        pregnancy_ids = [row[0] for row in cursor.fetchall()]
+        for i in range(0, len(pregnancy_ids), cursor.IN_MAX):
+            cls.update_pregnancies(pregnancy_ids[i:i + cursor.IN_MAX])
+        mmcLog.info('Rebuilt the risk codes of %d pregnancies'
+            % len(pregnancy_ids))
+
+
+class MmcRiskCodeRebuildResult(ModelView):
+    'Rebuild Risk Codes'
+    __name__ = 'mmc.risk.code.rebuild.result'
+
+    high_risk = fields.Integer('High risk pregnancies', readonly=True)
+
+
+class MmcRiskCodeRebuild(Wizard):
+    'Rebuild Risk Codes'
+    __name__ = 'mmc.risk.code.rebuild'
+
+    start = StateView('mmc.risk.code.rebuild.result',
+        'mmc.mmc_risk_code_rebuild_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_start(self, fields):
+        Risk = Pool().get('mmc.risk.code')
+        Risk.rebuild()
+        return {
+            'high_risk': Risk.search_count([('high_risk', '=', True)]),
+            }
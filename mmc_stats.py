@@ -0,0 +1,224 @@
+# -------------------------------------------------------------------------------
+# mmc_stats.py
+#
+# Optional instrumentation of the hot paths of the module: the creates,
+# validators, function field getters and the prenatal report.
+# -------------------------------------------------------------------------------
+from trytond.model import ModelView, fields
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.config import CONFIG
+
+import datetime
+import functools
+import inspect
+import logging
+import threading
+import time
+
+__all__ = [
+    'MmcStatsResult',
+    'MmcStats',
+    ]
+
+mmcLog = logging.getLogger('mmcStats')
+
+# --------------------------------------------------------
+# Instrumentation is off unless mmc_instrument is set in the
+# trytond configuration file. The statistics are then logged
+# every mmc_instrument_interval seconds, 0 meaning never, and
+# shown by the Performance Statistics wizard. They are kept
+# per server process.
+# --------------------------------------------------------
+INSTRUMENT = bool(CONFIG.get('mmc_instrument'))
+DUMP_INTERVAL = int(CONFIG.get('mmc_instrument_interval') or 600)
+
+
+class Stats(object):
+    '''
+    The calls of the instrumented functions aggregated by name: the
+    number of calls, of records handled, of SQL queries run and the
+    wall time spent, including the time spent in nested instrumented
+    functions.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.entries = {}
+            self.since = datetime.datetime.now()
+            self.last_dump = time.time()
+
+    def add(self, name, records, seconds, queries):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                entry = self.entries[name] = {
+                    'calls': 0,
+                    'records': 0,
+                    'seconds': 0.0,
+                    'max_seconds': 0.0,
+                    'queries': 0,
+                    }
+            entry['calls'] += 1
+            entry['records'] += records
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['queries'] += queries
+            due = DUMP_INTERVAL and \
+                time.time() - self.last_dump >= DUMP_INTERVAL
+            if due:
+                self.last_dump = time.time()
+        if due:
+            self.dump()
+
+    # --------------------------------------------------------
+    # The entries with their averages per call, the most time
+    # consuming first.
+    # --------------------------------------------------------
+    def snapshot(self):
+        with self.lock:
+            rows = [dict(entry, name=name)
+                for name, entry in self.entries.iteritems()]
+        for row in rows:
+            row['records_per_call'] = float(row['records']) / row['calls']
+            row['ms_per_call'] = row['seconds'] * 1000.0 / row['calls']
+            row['queries_per_call'] = float(row['queries']) / row['calls']
+        rows.sort(key=lambda r: r['seconds'], reverse=True)
+        return rows
+
+    def format(self):
+        lines = ['Since %s' % self.since.strftime('%Y-%m-%d %H:%M:%S'),
+            '%-55s %8s %10s %10s %10s %10s' % ('', 'calls', 'rec/call',
+                'ms/call', 'max ms', 'sql/call')]
+        for row in self.snapshot():
+            lines.append('%-55s %8d %10.1f %10.1f %10.1f %10.1f' % (
+                    row['name'], row['calls'], row['records_per_call'],
+                    row['ms_per_call'], row['max_seconds'] * 1000.0,
+                    row['queries_per_call']))
+        return '\n'.join(lines)
+
+    def dump(self):
+        mmcLog.info('Performance statistics\n' + self.format())
+
+STATS = Stats()
+
+# --------------------------------------------------------
+# The SQL queries of the thread are counted by replacing the
+# execute method of the cursor of the transaction the first
+# time an instrumented function runs in it.
+# --------------------------------------------------------
+_local = threading.local()
+
+
+def _query_count():
+    cursor = Transaction().cursor
+    if cursor is None:
+        return 0
+    if not getattr(cursor, '_mmc_counted', False):
+        execute = cursor.execute
+
+        def counting_execute(*args, **kwargs):
+            _local.queries = getattr(_local, 'queries', 0) + 1
+            return execute(*args, **kwargs)
+        cursor.execute = counting_execute
+        cursor._mmc_counted = True
+    return getattr(_local, 'queries', 0)
+
+
+def _count_records(args):
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            return len(arg)
+    return 0
+
+
+# --------------------------------------------------------
+# Return a function with the argument names and defaults of
+# func calling wrapper. Tryton inspects the arguments of some
+# methods, the getters of Function fields taking names among
+# them, so a (*args, **kwargs) wrapper would change how they
+# are called.
+# --------------------------------------------------------
+def _with_signature(func, wrapper):
+    args, varargs, varkw, defaults = inspect.getargspec(func)
+    names = list(args)
+    if varargs:
+        names.append('*' + varargs)
+    if varkw:
+        names.append('**' + varkw)
+    source = 'def %s(%s):\n    return _wrapper_(%s)\n' % (
+        func.__name__, ', '.join(names), ', '.join(names))
+    namespace = {'_wrapper_': wrapper}
+    exec(source, namespace)
+    result = namespace[func.__name__]
+    result.func_defaults = defaults
+    return functools.update_wrapper(result, func)
+
+
+def instrument(name, count=None):
+    '''
+    Decorator recording the calls of the function under name. The
+    number of records of a call is the length of the first list
+    argument, or what count returns when given the same arguments.
+    Put it under @classmethod or @staticmethod. It returns the
+    function unchanged when instrumentation is off, and a function
+    with the same signature otherwise.
+    '''
+    def decorator(func):
+        if not INSTRUMENT:
+            return func
+
+        def wrapper(*args, **kwargs):
+            queries = _query_count()
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.time() - start
+                if count is not None:
+                    records = count(*args, **kwargs)
+                else:
+                    records = _count_records(args)
+                STATS.add(name, records, seconds, _query_count() - queries)
+        return _with_signature(func, wrapper)
+    return decorator
+
+
+class MmcStatsResult(ModelView):
+    'Performance Statistics'
+    __name__ = 'mmc.stats.result'
+
+    enabled = fields.Boolean('Enabled', readonly=True,
+        help="Set mmc_instrument in the server configuration to enable")
+    stats = fields.Text('Statistics', readonly=True)
+
+
+class MmcStats(Wizard):
+    '''
+    Show the statistics of the instrumented functions in this server
+    process, and log them.
+    '''
+    __name__ = 'mmc.stats'
+
+    start = StateView('mmc.stats.result',
+        'mmc.mmc_stats_result_view_form', [
+            Button('Reset', 'reset', 'tryton-clear'),
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+    reset = StateTransition()
+
+    def default_start(self, fields):
+        if INSTRUMENT:
+            STATS.dump()
+        return {
+            'enabled': INSTRUMENT,
+            'stats': STATS.format(),
+            }
+
+    def transition_reset(self):
+        STATS.reset()
+        return 'start'
@@ -0,0 +1,328 @@
+# -------------------------------------------------------------------------------
+# mmc_tetanus.py
+#
+# Tetanus toxoid immunization status of the patients, TT1 to TT5, and
+# whether each mother will be protected at delivery.
+# -------------------------------------------------------------------------------
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, Button
+from trytond.cache import Cache
+
+import datetime
+import logging
+import re
+
+__all__ = [
+    'ProductTemplate',
+    'Product',
+    'MmcTetanusStatus',
+    'MmcTetanusStatusRebuildResult',
+    'MmcTetanusStatusRebuild',
+    ]
+
+mmcLog = logging.getLogger('mmcTetanus')
+
+# --------------------------------------------------------
+# Vaccines counted as a tetanus toxoid dose, by product name.
+# --------------------------------------------------------
+TT_VACCINE_RE = re.compile(r'\b(tt|td|tdap|dtap|tetanus)\b', re.IGNORECASE)
+
+# --------------------------------------------------------
+# The DOH tetanus toxoid schedule for women of child bearing
+# age. For each dose, the minimum number of days after the
+# previous dose and the number of years it protects for, None
+# meaning for life. TT1 alone gives no protection.
+# --------------------------------------------------------
+TT_SCHEDULE = [
+    (0, 0),         # TT1
+    (28, 3),        # TT2
+    (182, 5),       # TT3
+    (365, 10),      # TT4
+    (365, None),    # TT5
+    ]
+
+def add_years(date, years):
+    try:
+        return date.replace(year=date.year + years)
+    except ValueError:
+        # February 29th.
+        return date.replace(year=date.year + years, day=28)
+
+# --------------------------------------------------------
+# Compute the tetanus status from the doses of a patient as
+# (effective date, precision) pairs in date order and the due
+# date of her current pregnancy, if any. A dose given before
+# the minimum interval after the previous one does not count,
+# unless one of the dates is only approximate.
+# --------------------------------------------------------
+def tetanus_status(doses, pdd=None):
+    count = 0
+    last = None
+    for edate, precision in doses:
+        if count >= len(TT_SCHEDULE):
+            break
+        if last is not None and precision == 'day' and last[1] == 'day' \
+                and (edate - last[0]).days < TT_SCHEDULE[count][0]:
+            continue
+        count += 1
+        last = (edate, precision)
+
+    status = {
+        'doses': count,
+        'last_dose': last and last[0],
+        'protected_until': None,
+        'lifetime': False,
+        'next_due': None,
+        'pdd': pdd,
+        'protected_at_delivery': False,
+        }
+    if count:
+        years = TT_SCHEDULE[count - 1][1]
+        if years is None:
+            status['lifetime'] = True
+        elif years:
+            status['protected_until'] = add_years(last[0], years)
+        if count < len(TT_SCHEDULE):
+            status['next_due'] = last[0] + datetime.timedelta(
+                days=TT_SCHEDULE[count][0])
+    if pdd:
+        status['protected_at_delivery'] = bool(status['lifetime'] or
+            (status['protected_until'] and status['protected_until'] >= pdd))
+    return status
+
+
+# --------------------------------------------------------
+# Clear the cached tetanus toxoid vaccine ids whenever a
+# product, or the template its name comes from, is created,
+# written or deleted. When a write makes a product become or
+# stop being a tetanus toxoid, the tetanus status and the
+# prenatal report facts of the patients vaccinated with it
+# are recomputed.
+# --------------------------------------------------------
+class VaccineInvalidation(object):
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(VaccineInvalidation, cls).create(vlist)
+        Pool().get('mmc.tetanus.status').clear_vaccine_ids()
+        return records
+
+    @classmethod
+    def write(cls, records, values):
+        TetanusStatus = Pool().get('mmc.tetanus.status')
+        vaccine_ids = set(TetanusStatus.get_vaccine_ids())
+        super(VaccineInvalidation, cls).write(records, values)
+        TetanusStatus.clear_vaccine_ids()
+        TetanusStatus.update_vaccines(
+            vaccine_ids ^ set(TetanusStatus.get_vaccine_ids()))
+
+    @classmethod
+    def delete(cls, records):
+        super(VaccineInvalidation, cls).delete(records)
+        Pool().get('mmc.tetanus.status').clear_vaccine_ids()
+
+
+class ProductTemplate(VaccineInvalidation, ModelSQL, ModelView):
+    'Product Template'
+    __name__ = 'product.template'
+
+
+class Product(VaccineInvalidation, ModelSQL, ModelView):
+    'Product'
+    __name__ = 'product.product'
+
+
+class MmcTetanusStatus(ModelSQL, ModelView):
+    '''
+    One row per patient with a vaccination or a current pregnancy,
+    holding her tetanus toxoid status. The rows are kept up to date
+    whenever a vaccination or a pregnancy is written so that the
+    patient form, the prenatal report and the TT due list do not go
+    through the vaccination history of every patient.
+    '''
+    __name__ = 'mmc.tetanus.status'
+
+    patient = fields.Many2One('gnuhealth.patient', 'Patient', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    doses = fields.Integer('TT doses', readonly=True,
+        help="Position in the TT1 to TT5 series")
+    last_dose = fields.Date('Last dose', readonly=True)
+    protected_until = fields.Date('Protected until', readonly=True,
+        select=True)
+    lifetime = fields.Boolean('Protected for life', readonly=True)
+    next_due = fields.Date('Next dose due', readonly=True, select=True,
+        help="Earliest date of the next dose of the series")
+    pregnancy = fields.Many2One('gnuhealth.patient.pregnancy',
+        'Current pregnancy', readonly=True, ondelete='SET NULL')
+    pdd = fields.Date('Due Date', readonly=True)
+    protected_at_delivery = fields.Boolean('Protected at delivery',
+        readonly=True, select=True)
+
+    _status_fields = ['doses', 'last_dose', 'protected_until', 'lifetime',
+        'next_due', 'pdd', 'protected_at_delivery']
+
+    @classmethod
+    def __setup__(cls):
+        super(MmcTetanusStatus, cls).__setup__()
+        cls._sql_constraints += [
+            ('patient_uniq', 'UNIQUE(patient)',
+                'The patient already has a tetanus status !'),
+        ]
+        cls._order.insert(0, ('next_due', 'ASC'))
+
+    _vaccine_cache = Cache('mmc.tetanus.status.vaccine_ids')
+
+    # --------------------------------------------------------
+    # The ids of the vaccine products that are a tetanus toxoid.
+    # Cached until a product is changed, see VaccineInvalidation.
+    # --------------------------------------------------------
+    @classmethod
+    def get_vaccine_ids(cls):
+        vaccine_ids = cls._vaccine_cache.get('ids')
+        if vaccine_ids is None:
+            Product = Pool().get('product.product')
+            vaccine_ids = [p.id for p in Product.search([
+                        ('is_vaccine', '=', True)])
+                if TT_VACCINE_RE.search(p.rec_name or '')]
+            cls._vaccine_cache.set('ids', vaccine_ids)
+        return list(vaccine_ids)
+
+    @classmethod
+    def clear_vaccine_ids(cls):
+        cls._vaccine_cache.clear()
+
+    # --------------------------------------------------------
+    # Return the tetanus toxoid doses of the patients as lists
+    # of (effective date, precision) in date order, with one
+    # query using the index on the vaccination date.
+    # --------------------------------------------------------
+    @classmethod
+    def get_doses(cls, patient_ids):
+        Vaccination = Pool().get('gnuhealth.vaccination')
+        result = dict((i, []) for i in patient_ids)
+        vaccine_ids = cls.get_vaccine_ids()
+        if not vaccine_ids or not patient_ids:
+            return result
+        for vacc in Vaccination.search_read([
+                    ('name', 'in', patient_ids),
+                    ('vaccine', 'in', vaccine_ids),
+                    ('effective_date', '!=', None),
+                    ], order=[('effective_date', 'ASC'), ('id', 'ASC')],
+                fields_names=['name', 'effective_date', 'date_precision']):
+            result[vacc['name']].append((vacc['effective_date'],
+                    vacc['date_precision']))
+        return result
+
+    # --------------------------------------------------------
+    # Compute the status of the patients from their current
+    # data, keyed by patient id.
+    # --------------------------------------------------------
+    @classmethod
+    def compute(cls, patient_ids):
+        Pregnancy = Pool().get('gnuhealth.patient.pregnancy')
+        patient_ids = list(set(i for i in patient_ids if i))
+        pregnancies = {}
+        for preg in Pregnancy.search_read([
+                    ('name', 'in', patient_ids),
+                    ('current_pregnancy', '=', True),
+                    ], fields_names=['name', 'pdd']):
+            pregnancies[preg['name']] = preg
+
+        result = {}
+        for patient_id, doses in cls.get_doses(patient_ids).iteritems():
+            preg = pregnancies.get(patient_id)
+            if not doses and not preg:
+                continue
+            status = tetanus_status(doses, preg and preg['pdd'])
+            status['pregnancy'] = preg and preg['id']
+            result[patient_id] = status
+        return result
+
+    # --------------------------------------------------------
+    # Return the status of the patients, from the stored rows
+    # when there are some.
+    # --------------------------------------------------------
+    @classmethod
+    def get_statuses(cls, patient_ids):
+        result = {}
+        for status in cls.search_read([('patient', 'in', patient_ids)],
+                fields_names=['patient', 'pregnancy'] + cls._status_fields):
+            result[status['patient']] = status
+        missing = [i for i in patient_ids if i not in result]
+        if missing:
+            result.update(cls.compute(missing))
+        return result
+
+    # --------------------------------------------------------
+    # Recompute the status of the patients. Called whenever one
+    # of their vaccinations or pregnancies is written.
+    # --------------------------------------------------------
+    @classmethod
+    def update_patients(cls, patient_ids):
+        patient_ids = list(set(i for i in patient_ids if i))
+        if not patient_ids:
+            return
+        cls.delete(cls.search([('patient', 'in', patient_ids)]))
+        vlist = []
+        for patient_id, status in cls.compute(patient_ids).iteritems():
+            values = status.copy()
+            values['patient'] = patient_id
+            vlist.append(values)
+        if vlist:
+            cls.create(vlist)
+
+    # --------------------------------------------------------
+    # Recompute the status and the prenatal report facts of the
+    # patients vaccinated with the products.
+    # --------------------------------------------------------
+    @classmethod
+    def update_vaccines(cls, vaccine_ids):
+        Vaccination = Pool().get('gnuhealth.vaccination')
+        if not vaccine_ids:
+            return
+        patient_ids = list(set(v['name'] for v in Vaccination.search_read([
+                        ('vaccine', 'in', list(vaccine_ids)),
+                        ], fields_names=['name'])))
+        cls.update_patients(patient_ids)
+        Vaccination.update_report_facts(patient_ids)
+
+    # --------------------------------------------------------
+    # Recompute every status, e.g. after the module is updated
+    # or the statuses were found wrong.
+    # --------------------------------------------------------
+    @classmethod
+    def rebuild(cls):
+        Patient = Pool().get('gnuhealth.patient')
+        cursor = Transaction().cursor
+        cursor.execute('SELECT id FROM "' + Patient._table + '"')
+        patient_ids = [row[0] for row in cursor.fetchall()]
+        for i in range(0, len(patient_ids), cursor.IN_MAX):
+            cls.update_patients(patient_ids[i:i + cursor.IN_MAX])
+        mmcLog.info('Rebuilt the tetanus status of %d patients'
+            % len(patient_ids))
+
+
+class MmcTetanusStatusRebuildResult(ModelView):
+    'Rebuild Tetanus Status'
+    __name__ = 'mmc.tetanus.status.rebuild.result'
+
+    patients = fields.Integer('Patients with a status', readonly=True)
+
+
+class MmcTetanusStatusRebuild(Wizard):
+    'Rebuild Tetanus Status'
+    __name__ = 'mmc.tetanus.status.rebuild'
+
+    start = StateView('mmc.tetanus.status.rebuild.result',
+        'mmc.mmc_tetanus_status_rebuild_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_start(self, fields):
+        Status = Pool().get('mmc.tetanus.status')
+        Status.rebuild()
+        return {
+            'patients': Status.search_count([]),
+            }
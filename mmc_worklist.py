@@ -0,0 +1,216 @@
+# -------------------------------------------------------------------------------
+# mmc_worklist.py
+#
+# Expected prenatal and postpartum return visits, and the mothers who
+# missed one.
+# -------------------------------------------------------------------------------
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+import datetime
+import logging
+
+__all__ = [
+    'MmcWorklistVisit',
+    ]
+
+mmcLog = logging.getLogger('mmcWorklist')
+
+# --------------------------------------------------------
+# A mother arrived for her visit when she came back at most
+# GRACE_DAYS after the scheduled date. She missed it once
+# that is past. The daily refresh recomputes the visits
+# expected from PAST_DAYS ago to FUTURE_DAYS ahead.
+# --------------------------------------------------------
+GRACE_DAYS = 3
+PAST_DAYS = 30
+FUTURE_DAYS = 14
+
+
+def to_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+class MmcWorklistVisit(ModelSQL, ModelView):
+    '''
+    One row per scheduled return visit, next_appt of a prenatal evaluation
+    or m_next_visit of a postpartum ongoing monitor, with whether the
+    mother came back. The rows are refreshed every night for the days
+    around today and whenever a visit of the pregnancy is recorded, so the
+    worklists only read this table.
+    '''
+    __name__ = 'mmc.worklist.visit'
+
+    expected_date = fields.Date('Expected', readonly=True, select=True)
+    kind = fields.Selection([
+        ('prenatal', 'Prenatal'),
+        ('postpartum', 'Postpartum'),
+        ], 'Visit', readonly=True, select=True)
+    source = fields.Integer('Scheduled by', readonly=True, select=True,
+        help="The id of the evaluation or monitor that scheduled the visit")
+    scheduled_on = fields.Date('Scheduled on', readonly=True)
+    pregnancy = fields.Many2One('gnuhealth.patient.pregnancy', 'Pregnancy',
+        readonly=True, select=True, ondelete='CASCADE')
+    arrived = fields.Boolean('Arrived', readonly=True)
+    arrival_date = fields.Date('Arrival', readonly=True)
+    missed = fields.Boolean('Missed', readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(MmcWorklistVisit, cls).__setup__()
+        cls._sql_constraints += [
+            ('source_uniq', 'UNIQUE(kind, source)',
+                'The visit is already on the worklist !'),
+        ]
+        cls._order.insert(0, ('expected_date', 'ASC'))
+
+    # --------------------------------------------------------
+    # The models scheduling the visits, the field of the date of
+    # the visit they record and of the next visit they schedule.
+    # --------------------------------------------------------
+    _sources = [
+        ('prenatal', 'gnuhealth.patient.prenatal.evaluation',
+            'eval_date_only', 'next_appt'),
+        ('postpartum', 'gnuhealth.postpartum.ongoing.monitor',
+            'date_time', 'm_next_visit'),
+        ]
+
+    # --------------------------------------------------------
+    # Compute the visits expected between start and end, or all
+    # the visits of the given pregnancies when start and end are
+    # None. Two indexed queries per kind: the scheduled visits
+    # by their date and the visits of the same pregnancies that
+    # could be the return visit.
+    # --------------------------------------------------------
+    @classmethod
+    def compute(cls, start, end, pregnancy_ids=None):
+        pool = Pool()
+        Pregnancy = pool.get('gnuhealth.patient.pregnancy')
+        cursor = Transaction().cursor
+        today = pool.get('ir.date').today()
+
+        result = []
+        for kind, model, date_field, next_field in cls._sources:
+            Model = pool.get(model)
+            table = Model._table
+            sql = ('SELECT id, name, "' + date_field + '", "' + next_field
+                + '" FROM "' + table + '" '
+                'WHERE "' + next_field + '" IS NOT NULL '
+                'AND name IS NOT NULL')
+            params = []
+            if start is not None:
+                # Whole days, also for a DateTime next visit.
+                bounds = [start, end + datetime.timedelta(days=1)]
+                if isinstance(Model._fields[next_field], fields.DateTime):
+                    bounds = [datetime.datetime.combine(d, datetime.time())
+                        for d in bounds]
+                sql += (' AND "' + next_field + '" >= %s AND "'
+                    + next_field + '" < %s')
+                params += bounds
+            if pregnancy_ids is not None:
+                if not pregnancy_ids:
+                    continue
+                sql += (' AND name IN ('
+                    + ','.join(('%s',) * len(pregnancy_ids)) + ')')
+                params += pregnancy_ids
+            cursor.execute(sql, params)
+            scheduled = [(row[0], row[1], to_date(row[2]), to_date(row[3]))
+                for row in cursor.fetchall()]
+            if not scheduled:
+                continue
+
+            # --------------------------------------------------------
+            # The visits of these pregnancies after the first one that
+            # scheduled a visit, by pregnancy.
+            # --------------------------------------------------------
+            ids = sorted(set(s[1] for s in scheduled))
+            dates = [s[2] for s in scheduled if s[2]]
+            first = dates and min(dates) or start
+            visits = dict((i, []) for i in ids)
+            for i in range(0, len(ids), cursor.IN_MAX):
+                sub_ids = ids[i:i + cursor.IN_MAX]
+                sql = ('SELECT name, "' + date_field + '" '
+                    'FROM "' + table + '" WHERE name IN ('
+                    + ','.join(('%s',) * len(sub_ids)) + ')')
+                params = list(sub_ids)
+                if first is not None:
+                    sql += ' AND "' + date_field + '" >= %s'
+                    params.append(first)
+                cursor.execute(sql, params)
+                for pregnancy_id, visit_date in cursor.fetchall():
+                    visits[pregnancy_id].append(to_date(visit_date))
+
+            # --------------------------------------------------------
+            # Pregnancies that ended are not expected back for a
+            # prenatal visit after the birth.
+            # --------------------------------------------------------
+            ends = {}
+            if kind == 'prenatal':
+                for preg in Pregnancy.read(ids, ['pregnancy_end_date']):
+                    ends[preg['id']] = to_date(preg['pregnancy_end_date'])
+
+            for source, pregnancy_id, scheduled_on, expected in scheduled:
+                end_date = ends.get(pregnancy_id)
+                if end_date and end_date <= expected:
+                    continue
+                limit = expected + datetime.timedelta(days=GRACE_DAYS)
+                arrivals = [d for d in visits[pregnancy_id]
+                    if d and (scheduled_on is None or d > scheduled_on)
+                    and d <= limit]
+                result.append({
+                        'kind': kind,
+                        'source': source,
+                        'pregnancy': pregnancy_id,
+                        'scheduled_on': scheduled_on,
+                        'expected_date': expected,
+                        'arrived': bool(arrivals),
+                        'arrival_date': arrivals and min(arrivals) or None,
+                        'missed': not arrivals and limit < today,
+                        })
+        return result
+
+    # --------------------------------------------------------
+    # Replace the visits expected between start and end, by
+    # default the window around today. Run every night by cron.
+    # --------------------------------------------------------
+    @classmethod
+    def refresh(cls, start=None, end=None):
+        today = Pool().get('ir.date').today()
+        start = start or today - datetime.timedelta(days=PAST_DAYS)
+        end = end or today + datetime.timedelta(days=FUTURE_DAYS)
+        cls.delete(cls.search([
+                    ('expected_date', '>=', start),
+                    ('expected_date', '<=', end),
+                    ]))
+        vlist = cls.compute(start, end)
+        if vlist:
+            # A visit moved into the window from outside of it.
+            for kind in set(v['kind'] for v in vlist):
+                cls.delete(cls.search([
+                            ('kind', '=', kind),
+                            ('source', 'in', [v['source'] for v in vlist
+                                    if v['kind'] == kind]),
+                            ]))
+            cls.create(vlist)
+        mmcLog.info('Refreshed %d expected visits from %s to %s'
+            % (len(vlist), start, end))
+
+    # --------------------------------------------------------
+    # Replace all the visits of the pregnancies after one of
+    # their evaluations or monitors has been written, whatever
+    # their dates, so that a visit moved or deleted outside of
+    # the window of the nightly refresh does not stay behind.
+    # --------------------------------------------------------
+    @classmethod
+    def update_pregnancies(cls, pregnancy_ids):
+        pregnancy_ids = sorted(set(i for i in pregnancy_ids if i))
+        cursor = Transaction().cursor
+        for i in range(0, len(pregnancy_ids), cursor.IN_MAX):
+            sub_ids = pregnancy_ids[i:i + cursor.IN_MAX]
+            cls.delete(cls.search([('pregnancy', 'in', sub_ids)]))
+            vlist = cls.compute(None, None, sub_ids)
+            if vlist:
+                cls.create(vlist)
@@ -0,0 +1,3 @@
+from .test_mmc import suite
+
+__all__ = ['suite']
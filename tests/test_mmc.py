@@ -0,0 +1,804 @@
+#!/usr/bin/env python
+# -------------------------------------------------------------------------------
+# test_mmc.py
+#
+# Tests of the MMC module. The module has to be installed in trytond as
+# mmc. The prenatal report test needs a database that other processes can
+# open, i.e. PostgreSQL:
+#
+#   DB_NAME=test_mmc python -m trytond.tests.test_tryton -c trytond.conf \
+#       -m mmc
+# -------------------------------------------------------------------------------
+import argparse
+import datetime
+import imp
+import inspect
+import os
+import unittest
+from decimal import Decimal
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, \
+    test_view, test_depends
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+
+BENCH_MMC = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'benchmarks', 'bench_mmc.py')
+
+
+class MmcFunctionsTestCase(unittest.TestCase):
+    '''
+    Test the functions of the MMC module that do not use the database.
+    '''
+
+    def test0010parse_contractions(self):
+        '''
+        Test parse_contractions.
+        '''
+        from trytond.modules.mmc.mmc import parse_contractions
+        for value, expected in [
+                ('3', 3.0),
+                ('3/10', 3.0),
+                ('3 in 10', 3.0),
+                ('2x5', 4.0),
+                ('4 per 20 min', 2.0),
+                ('3/10 45', 3.0),
+                ('3/10 45s', 3.0),
+                ('2/10 30 secs', 2.0),
+                ('3/0', None),
+                ('strong', None),
+                ('', None),
+                (None, None),
+                ]:
+            self.assertEqual(parse_contractions(value), expected, value)
+
+    def test0020partograph_lines(self):
+        '''
+        Test partograph_lines.
+        '''
+        from trytond.modules.mmc.mmc import partograph_lines
+        start = datetime.datetime(2014, 3, 1, 8, 0)
+        dates = [start + datetime.timedelta(hours=h)
+            for h in (0, 1, 2, 3, 7, 8)]
+        dilations = [3, 4, None, 4, 6, 10]
+        self.assertEqual(partograph_lines(dates, dilations),
+            [None, None, None, 'alert', 'action', 'alert'])
+        self.assertEqual(partograph_lines(dates[:4], [4, 5, 6, 7]),
+            [None] * 4)
+        self.assertEqual(partograph_lines([], []), [])
+
+    def test0030downsample(self):
+        '''
+        Test the downsampling of the labor monitor series.
+        '''
+        from trytond.modules.mmc.mmc import MmcPerinatalMonitor
+        start = datetime.datetime(2014, 3, 1, 8, 0)
+        # date, fht, cr, dilation, contractions, systolic, diastolic
+        rows = [
+            (start, 140, 80, 4, 3.0, 120, 80),
+            (start + datetime.timedelta(minutes=10), 150, None, 5, 4.0,
+                130, 90),
+            (start + datetime.timedelta(minutes=20), 130, 90, 6, None,
+                110, 70),
+            (start + datetime.timedelta(minutes=30), 120, 100, 5, 5.0,
+                100, 60),
+            ]
+        self.assertEqual(MmcPerinatalMonitor.downsample(rows, 2), [
+                (start, 145.0, 80.0, 5, 3.5, 125.0, 85.0),
+                (start + datetime.timedelta(minutes=20), 125.0, 95.0, 6, 5.0,
+                    105.0, 65.0),
+                ])
+        self.assertEqual(len(MmcPerinatalMonitor.downsample(rows, 4)), 4)
+
+    def test0040risk_rules(self):
+        '''
+        Test the risk rules over columns of values.
+        '''
+        from trytond.modules.mmc.mmc_risk import COMPILED_RISK_RULES
+        columns = {
+            'age': [17, 25, 36],
+            'gravida': [1, 3, 6],
+            'para': [0, 2, 5],
+            'abortions': [0, 0, 0],
+            'stillbirths': [0, None, 0],
+            'rh': ['+', '-', '+'],
+            'pathologies': [[], ['J45.9'], []],
+            'systolic': [110, 120, None],
+            'diastolic': [70, 95, None],
+            }
+        codes = [set() for i in range(3)]
+        for code, column, test in COMPILED_RISK_RULES:
+            for i in test(columns[column]):
+                codes[i].add(code)
+        self.assertEqual(codes, [set(['A']), set(['F', 'H', 'R']),
+                set(['B', 'D'])])
+
+    def test0050apply_reading(self):
+        '''
+        Test the alerts raised and cleared by the postpartum readings.
+        '''
+        from trytond.modules.mmc.mmc_alerts import new_state, apply_reading
+        start = datetime.datetime(2014, 3, 1, 8, 0)
+        state = new_state()
+        for hours, reading, alerts, ebl_total in [
+                (0, {'systolic': 150, 'diastolic': 85, 'ebl': 100},
+                    ['BP-HIGH'], 100),
+                (1, {'systolic': 120, 'ebl': 200}, [], 300),
+                (2, {'ebl': 250, 'baby_temp': 36.0},
+                    ['B-COLD', 'EBL-RISING', 'PPH'], 550),
+                (3, {'baby_temp': 37.0}, ['EBL-RISING', 'PPH'], 550),
+                (30, {'ebl': 100}, [], 650),
+                ]:
+            reading['date'] = start + datetime.timedelta(hours=hours)
+            apply_reading(state, reading)
+            self.assertEqual(sorted(state['alerts']), alerts, hours)
+            self.assertEqual(state['ebl_total'], ebl_total, hours)
+        self.assertEqual(state['last_reading'],
+            start + datetime.timedelta(hours=30))
+
+    def test0060alert_state_resume(self):
+        '''
+        Test that resuming from a stored alert state gives the same state
+        as applying all the readings.
+        '''
+        from trytond.modules.mmc.mmc_alerts import new_state, \
+            apply_reading, MmcAlertState
+        start = datetime.datetime(2014, 3, 1, 8, 0)
+        readings = [{
+                'date': start + datetime.timedelta(hours=hours),
+                'ebl': ebl,
+                'systolic': systolic,
+                } for hours, ebl, systolic in [
+                (0, 100, 120), (1, 150, 145), (2, 200, None), (20, 50, 100),
+                (30, None, 85), (31, 600, 110)]]
+        full = new_state()
+        for reading in readings:
+            apply_reading(full, reading)
+        for i in range(len(readings) + 1):
+            running = new_state()
+            for reading in readings[:i]:
+                apply_reading(running, reading)
+            running = MmcAlertState.get_running(
+                MmcAlertState.get_values(running))
+            for reading in readings[i:]:
+                apply_reading(running, reading)
+            self.assertEqual(MmcAlertState.get_values(running),
+                MmcAlertState.get_values(full), i)
+
+    def test0070name_key(self):
+        '''
+        Test that the spelling variations of a name have the same key.
+        '''
+        from trytond.modules.mmc.mmc import name_key
+        for names, key in [
+                (['Ma. Cristina', 'Maria Kristina', 'MARIA CRISTINA'],
+                    'mariakristina'),
+                (['Villanueva', 'Vilanueva'], 'bilanueba'),
+                ([u'Pe\xf1a', 'Pena'], 'pena'),
+                (['Sta. Ana', 'Santa Ana'], 'santana'),
+                (['Joseph', 'Josef'], 'josef'),
+                (['', '123', None], None),
+                ]:
+            for name in names:
+                self.assertEqual(name_key(name), key, name)
+
+    def test0080duplicate_score(self):
+        '''
+        Test which pairs of patients score as likely duplicates.
+        '''
+        from trytond.modules.mmc.mmc import duplicate_score, \
+            DUPLICATE_THRESHOLD
+        patient = {
+            'phil_health_id_digits': '123456789012',
+            'lastname_key': 'dela krus',
+            'firstname_key': 'maria',
+            'dob': datetime.date(1990, 5, 1),
+            'barangay': 'centro',
+            }
+        for changes, duplicate in [
+                ({}, True),
+                # The same PHIC# alone.
+                ({'lastname_key': 'santos', 'firstname_key': 'ana',
+                        'dob': None, 'barangay': None}, True),
+                # The same name alone.
+                ({'phil_health_id_digits': None, 'dob': None,
+                        'barangay': None}, False),
+                # A new last name after marriage.
+                ({'phil_health_id_digits': None, 'lastname_key': 'santos'},
+                    True),
+                ({'phil_health_id_digits': None, 'lastname_key': 'santos',
+                        'dob': None}, False),
+                # Missing values never match.
+                (dict((k, None) for k in patient), False),
+                ]:
+            other = dict(patient, **changes)
+            self.assertEqual(duplicate_score(patient, other)
+                >= DUPLICATE_THRESHOLD, duplicate, changes)
+
+    def test0090vaccination_effective_date(self):
+        '''
+        Test the effective date and precision of the vaccinations.
+        '''
+        from trytond.modules.mmc.mmc import vaccination_effective_date
+        date = datetime.date(2013, 5, 6)
+        for args, expected in [
+                ((date, '', None), (date, 'day')),
+                ((date, None, None), (date, 'day')),
+                ((None, '03', 2012), (datetime.date(2012, 3, 1), 'month')),
+                ((None, '', 2012), (datetime.date(2012, 1, 1), 'year')),
+                # The approximate date comes first, as on display.
+                ((date, '', 2012), (datetime.date(2012, 1, 1), 'year')),
+                ((date, '11', 2012), (datetime.date(2012, 11, 1), 'month')),
+                ((None, '13', 2012), (None, None)),
+                ((None, '03', None), (None, None)),
+                ((None, '', None), (None, None)),
+                ]:
+            self.assertEqual(vaccination_effective_date(*args), expected,
+                args)
+
+    def test0100tetanus_status(self):
+        '''
+        Test the tetanus toxoid status from the doses of a patient.
+        '''
+        from trytond.modules.mmc.mmc_tetanus import tetanus_status
+        date = datetime.date
+        status = tetanus_status([])
+        self.assertEqual((status['doses'], status['next_due'],
+                status['protected_at_delivery']), (0, None, False))
+
+        # TT1 alone does not protect.
+        status = tetanus_status([(date(2012, 1, 10), 'day')],
+            date(2012, 9, 1))
+        self.assertEqual((status['doses'], status['protected_until'],
+                status['next_due'], status['protected_at_delivery']),
+            (1, None, date(2012, 2, 7), False))
+
+        # TT2 four weeks later protects for three years.
+        status = tetanus_status([(date(2012, 1, 10), 'day'),
+                (date(2012, 2, 7), 'day')], date(2012, 9, 1))
+        self.assertEqual((status['doses'], status['protected_until'],
+                status['next_due'], status['protected_at_delivery']),
+            (2, date(2015, 2, 7), date(2012, 8, 7), True))
+
+        # A dose given too early does not count.
+        status = tetanus_status([(date(2012, 1, 10), 'day'),
+                (date(2012, 1, 20), 'day'), (date(2012, 2, 10), 'day')],
+            date(2016, 9, 1))
+        self.assertEqual((status['doses'], status['last_dose'],
+                status['protected_at_delivery']),
+            (2, date(2012, 2, 10), False))
+
+        # The interval is not checked against an approximate date.
+        status = tetanus_status([(date(2012, 1, 1), 'year'),
+                (date(2012, 1, 10), 'day')])
+        self.assertEqual((status['doses'], status['protected_until']),
+            (2, date(2015, 1, 10)))
+
+        # TT5 protects for life, further doses are not counted.
+        status = tetanus_status([(date(2008, 1, 1), 'day'),
+                (date(2008, 2, 1), 'day'), (date(2008, 9, 1), 'day'),
+                (date(2009, 9, 1), 'day'), (date(2010, 9, 1), 'day'),
+                (date(2012, 1, 1), 'day')], date(2030, 1, 1))
+        self.assertEqual((status['doses'], status['last_dose'],
+                status['lifetime'], status['next_due'],
+                status['protected_at_delivery']),
+            (5, date(2010, 9, 1), True, None, True))
+
+        # Protected until the 28th for a dose on February 29th.
+        status = tetanus_status([(date(2012, 1, 1), 'day'),
+                (date(2012, 2, 29), 'day')], date(2015, 3, 1))
+        self.assertEqual((status['protected_until'],
+                status['protected_at_delivery']),
+            (date(2015, 2, 28), False))
+
+    def test0110with_signature(self):
+        '''
+        Test that the instrumented functions keep their signature.
+        '''
+        from trytond.modules.mmc.mmc_stats import _with_signature
+        calls = []
+
+        def getter(cls, records, names=None, *args, **kwargs):
+            'Getter'
+            return records
+
+        def wrapper(*args, **kwargs):
+            calls.append((args, kwargs))
+            return getter(*args, **kwargs)
+
+        wrapped = _with_signature(getter, wrapper)
+        self.assertEqual(inspect.getargspec(wrapped),
+            inspect.getargspec(getter))
+        self.assertEqual((wrapped.__name__, wrapped.__doc__),
+            ('getter', 'Getter'))
+        self.assertEqual(wrapped(None, [1, 2], 'a', 'b', key=3), [1, 2])
+        self.assertEqual(calls, [((None, [1, 2], 'a', 'b'), {'key': 3})])
+
+    def test0120stats(self):
+        '''
+        Test the aggregation of the instrumented calls.
+        '''
+        from trytond.modules.mmc.mmc_stats import Stats
+        stats = Stats()
+        stats.add('fast', 10, 0.5, 2)
+        stats.add('slow', 1, 2.0, 5)
+        stats.add('fast', 30, 1.0, 4)
+        slow, fast = stats.snapshot()
+        self.assertEqual((slow['name'], slow['calls'], slow['ms_per_call']),
+            ('slow', 1, 2000.0))
+        self.assertEqual((fast['name'], fast['calls'], fast['records'],
+                fast['records_per_call'], fast['max_seconds'],
+                fast['queries_per_call']),
+            ('fast', 2, 40, 20.0, 1.0, 3.0))
+        self.assertEqual(len(stats.format().splitlines()), 4)
+        stats.reset()
+        self.assertEqual(stats.snapshot(), [])
+
+
+class MmcTestCase(unittest.TestCase):
+    '''
+    Test the MMC module.
+    '''
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('mmc')
+        self.party = POOL.get('party.party')
+        self.patient = POOL.get('gnuhealth.patient')
+        self.pregnancy = POOL.get('gnuhealth.patient.pregnancy')
+        self.evaluation = POOL.get('gnuhealth.patient.prenatal.evaluation')
+        self.report = POOL.get('gnuhealth.patient.doh.prenatal',
+            type='report')
+        self.fact = POOL.get('mmc.prenatal.report.fact')
+
+    def test0005views(self):
+        '''
+        Test views.
+        '''
+        test_view('mmc')
+
+    def test0006depends(self):
+        '''
+        Test depends.
+        '''
+        test_depends()
+
+    # --------------------------------------------------------
+    # Create count patients, each with a pregnancy and a few
+    # prenatal evaluations within the month of start.
+    # --------------------------------------------------------
+    def create_pregnancies(self, count, start):
+        parties = self.party.create([{
+                    'name': 'Maria %d' % i,
+                    'lastname': 'Dela Cruz',
+                    'is_person': True,
+                    'is_patient': True,
+                    'addresses': [('create', [{
+                                    'street': '%d Purok 1' % i,
+                                    'barangay': 'Centro',
+                                    }])],
+                    } for i in range(count)])
+        patients = self.patient.create([{
+                    'name': party.id,
+                    'dob': start - datetime.timedelta(days=365 * 20 + i),
+                    'gravida': 1 + i % 4,
+                    'para': i % 4,
+                    'abortions': 0,
+                    'stillbirths': 0,
+                    'living': i % 4,
+                    } for i, party in enumerate(parties)])
+        pregnancies = self.pregnancy.create([{
+                    'name': patient.id,
+                    'gravida': 1 + i % 4,
+                    'lmp': start - datetime.timedelta(days=60 + 7 * i),
+                    'current_pregnancy': True,
+                    } for i, patient in enumerate(patients)])
+        vlist = []
+        for i, pregnancy in enumerate(pregnancies):
+            for visit in range(1 + i % 3):
+                vlist.append({
+                        'name': pregnancy.id,
+                        'evaluation_date': datetime.datetime.combine(
+                            start + datetime.timedelta(days=i % 9 + visit * 9),
+                            datetime.time(9, i % 60)),
+                        'systolic': 100 + i % 50,
+                        'diastolic': 60 + i % 40,
+                        'weight': Decimal(55),
+                        'fundal_height': 20,
+                        'fetus_heart_rate': 140,
+                        'examiner': 'test',
+                        })
+        self.evaluation.create(vlist)
+        return pregnancies
+
+    @unittest.skipIf(CONFIG['db_type'] == 'sqlite',
+        'SQLite databases are not shared with worker processes')
+    def test0010prenatal_report_parallel(self):
+        '''
+        Test that the prenatal report rows and document built in
+        parallel are the same as the ones built serially.
+        '''
+        start = datetime.date(2014, 3, 1)
+        data = {
+            'start_date': start,
+            'end_date': datetime.date(2014, 3, 31),
+            }
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            self.create_pregnancies(25, start)
+            # The workers only see committed data.
+            transaction.cursor.commit()
+
+            pregnancy_ids = self.report.get_pregnancy_ids(data)
+            self.assertEqual(len(pregnancy_ids), 25)
+            serial = list(self.report.iter_records(pregnancy_ids))
+
+            threshold = self.report.parallel_threshold
+            chunk_size = self.report.chunk_size
+            processes = CONFIG.get('mmc_report_processes')
+            self.report.parallel_threshold = 0
+            self.report.chunk_size = 4
+            CONFIG['mmc_report_processes'] = '3'
+            try:
+                parallel = self.report.get_records(pregnancy_ids)
+                with transaction.set_context(mmc_report_nocache=True):
+                    parallel_document = self.report.execute([], data)
+                    with transaction.set_context(mmc_report_serial=True):
+                        serial_document = self.report.execute([], data)
+            finally:
+                self.report.parallel_threshold = threshold
+                self.report.chunk_size = chunk_size
+                CONFIG['mmc_report_processes'] = processes
+            self.assertEqual(parallel, serial)
+            self.assertEqual(parallel_document[0], serial_document[0])
+            self.assertEqual(str(parallel_document[1]),
+                str(serial_document[1]))
+
+    def test0020benchmark_cohort(self):
+        '''
+        Test that the benchmark harness builds a small cohort and runs
+        every benchmark over it.
+        '''
+        bench_mmc = imp.load_source('bench_mmc', BENCH_MMC)
+        args = argparse.Namespace(scales='0', repeat=1, seed=1,
+            config=None, database=None, output=None)
+        benchmark = bench_mmc.Benchmark(args)
+        benchmark.setup()
+        scale = benchmark.patients + 20
+        args.scales = str(scale)
+        result = benchmark.run()
+
+        self.assertEqual(benchmark.patients, scale)
+        self.assertEqual(len(result['results']),
+            5 + len(benchmark.tree_models))
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertEqual(self.patient.search_count([]), scale)
+
+    def test0030archive(self):
+        '''
+        Test the archiving of the closed pregnancies and which searches
+        see the archived records.
+        '''
+        start = datetime.date(2014, 3, 1)
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            pregnancies = self.create_pregnancies(3, start)
+            ids = [p.id for p in pregnancies]
+            closed, opened = pregnancies[:2], pregnancies[2:]
+            self.pregnancy.write(closed, {
+                    'current_pregnancy': False,
+                    'pregnancy_end_date': datetime.datetime(2014, 4, 1, 8),
+                    })
+            self.assertEqual(self.pregnancy.archive_closed(days=30), 2)
+            self.assertEqual(self.pregnancy.archive_closed(days=30), 0)
+
+            def archived(Model, ids):
+                return sorted(r['id'] for r in Model.read(ids, ['archived'])
+                    if r['archived'])
+
+            closed_ids = sorted(p.id for p in closed)
+            evaluation_ids = [e.id for e in self.evaluation.search([
+                        ('name', 'in', ids),
+                        ])]
+            closed_evaluation_ids = sorted(e.id for e in
+                self.evaluation.search([('name', 'in', closed_ids)]))
+            self.assertEqual(archived(self.pregnancy, ids), closed_ids)
+            self.assertEqual(archived(self.evaluation, evaluation_ids),
+                closed_evaluation_ids)
+
+            # The default search leaves out the archived records.
+            found = [p.id for p in self.pregnancy.search([
+                        ('gravida', '>', 0)]) if p.id in ids]
+            self.assertEqual(found, [opened[0].id])
+            # The searches by parent, by id, on archived and with
+            # mmc_include_archived see them.
+            self.assertEqual(sorted(p.id for p in self.pregnancy.search([
+                            ('name', 'in', [p.name.id for p in closed]),
+                            ])), closed_ids)
+            self.assertEqual(sorted(p.id for p in self.pregnancy.search([
+                            ('id', 'in', closed_ids),
+                            ])), closed_ids)
+            self.assertEqual(sorted(p.id for p in self.pregnancy.search([
+                            ('archived', '=', True),
+                            ]) if p.id in ids), closed_ids)
+            with Transaction().set_context(mmc_include_archived=True):
+                found = [p.id for p in self.pregnancy.search([
+                            ('gravida', '>', 0)]) if p.id in ids]
+            self.assertEqual(sorted(found), sorted(ids))
+            self.assertEqual([e.id for e in self.evaluation.search([
+                            ('examiner', '=', 'test'),
+                            ]) if e.id in closed_evaluation_ids], [])
+
+            # A record created under an archived pregnancy is archived.
+            evaluation, = self.evaluation.create([{
+                        'name': closed[0].id,
+                        'evaluation_date': datetime.datetime(2014, 3, 20, 9),
+                        'examiner': 'test',
+                        }])
+            self.assertEqual(archived(self.evaluation, [evaluation.id]),
+                [evaluation.id])
+
+            # Bookkeeping writes keep a pregnancy archived, edits
+            # bring it back with its records.
+            self.pregnancy.write([closed[0]], {'current_pregnancy': False})
+            self.assertEqual(archived(self.pregnancy, ids), closed_ids)
+            self.pregnancy.write([closed[0]], {
+                    'apdd': datetime.date(2014, 3, 30),
+                    })
+            self.assertEqual(archived(self.pregnancy, ids), [closed[1].id])
+            self.assertEqual(archived(self.evaluation,
+                    [e.id for e in self.evaluation.search([
+                                ('name', '=', closed[0].id)])]), [])
+
+            self.pregnancy.set_archived([closed[1].id], False)
+            self.assertEqual(archived(self.pregnancy, ids), [])
+            self.assertEqual(archived(self.evaluation,
+                    closed_evaluation_ids), [])
+
+    def test0040report_facts(self):
+        '''
+        Test that the stored prenatal report facts give the same report
+        rows as the history computed from the current data.
+        '''
+        start = datetime.date(2014, 3, 1)
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            pregnancies = self.create_pregnancies(6, start)
+            ids = [p.id for p in pregnancies]
+            self.pregnancy.write(pregnancies[:2], {
+                    'doctor_consult_date': datetime.date(2014, 3, 5),
+                    'dentist_consult_date': datetime.date(2014, 3, 6),
+                    })
+            self.pregnancy.write(pregnancies[3:4], {
+                    'lmp': start - datetime.timedelta(days=200),
+                    })
+            evaluations = self.evaluation.search([('name', '=', ids[2])])
+            self.evaluation.write(evaluations[:1], {
+                    'evaluation_date': datetime.datetime(2014, 3, 28, 10),
+                    })
+            self.evaluation.delete(evaluations[1:])
+
+            def stored():
+                return dict((f['pregnancy'], self.fact.get_history(f))
+                    for f in self.fact.search_read([
+                            ('pregnancy', 'in', ids),
+                            ], fields_names=['pregnancy']
+                        + self.fact._history_fields))
+
+            self.assertEqual(stored(), self.fact.compute(ids))
+            self.assertEqual(self.fact.rebuild(check_only=True)[1], [])
+
+            # The fields the facts are not computed from leave them.
+            fact_ids = sorted(f.id for f in self.fact.search([
+                        ('pregnancy', 'in', ids)]))
+            self.pregnancy.write(pregnancies, {'where_deliver': 'MMC'})
+            self.assertEqual(sorted(f.id for f in self.fact.search([
+                            ('pregnancy', 'in', ids)])), fact_ids)
+
+            records = list(self.report.iter_records(ids))
+            self.fact.delete(self.fact.search([('pregnancy', 'in', ids)]))
+            self.assertEqual(list(self.report.iter_records(ids)), records)
+
+    def test0050data_stamp(self):
+        '''
+        Test that the data stamp of the rendered report cache changes
+        with the evaluations, even those the facts do not use.
+        '''
+        start = datetime.date(2014, 3, 1)
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as \
+                transaction:
+            pregnancies = self.create_pregnancies(3, start)
+            ids = [p.id for p in pregnancies]
+            stamp = self.report.get_data_stamp(ids)
+            self.assertEqual(self.report.get_data_stamp(ids), stamp)
+
+            # The write dates must differ from the ones of the stamp.
+            evaluation = self.evaluation.search([('name', '=', ids[0])])[0]
+            transaction.cursor.execute('UPDATE "' + self.evaluation._table
+                + '" SET examiner = %s, write_date = %s WHERE id = %s',
+                ('other', datetime.datetime.now()
+                    + datetime.timedelta(minutes=1), evaluation.id))
+            self.assertNotEqual(self.report.get_data_stamp(ids), stamp)
+
+    def test0060address_barangay(self):
+        '''
+        Test that the addresses follow the barangay of their free text.
+        '''
+        Barangay = POOL.get('mmc.barangay')
+        Address = POOL.get('party.address')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            centro, = Barangay.create([{
+                        'name': 'Centro',
+                        'aliases': 'Poblacion',
+                        }])
+            party, = self.party.create([{'name': 'Maria'}])
+            address, = Address.create([{
+                        'party': party.id,
+                        'barangay': 'poblacion ',
+                        }])
+            self.assertEqual(address.barangay_ref, centro)
+
+            for barangay, barangay_ref in [
+                    ('Elsewhere', None),
+                    ('CENTRO', centro),
+                    ('', None),
+                    ('Centro', centro),
+                    (None, None),
+                    ]:
+                Address.write([address], {'barangay': barangay})
+                self.assertEqual(Address(address.id).barangay_ref,
+                    barangay_ref, barangay)
+
+    def test0070doh_ids(self):
+        '''
+        Test that the patients created together get consecutive DOH ids
+        that do not clash with the ones typed in.
+        '''
+        with Transaction().start(DB_NAME, USER,
+                context=dict(CONTEXT, mmc_skip_duplicate_check=True)):
+            parties = self.party.create([{
+                        'name': 'Maria %d' % i,
+                        'lastname': 'Santos',
+                        'is_person': True,
+                        'is_patient': True,
+                        } for i in range(8)])
+
+            def numbers(patients):
+                return [int(p.doh_id.replace('-', '')) for p in patients]
+
+            patients = self.patient.create([{'name': party.id}
+                    for party in parties[:4]])
+            first = numbers(patients)
+            self.assertEqual(first, range(first[0], first[0] + 4))
+
+            # The next but one number is typed in for the second
+            # patient of the batch.
+            typed = str(first[-1] + 2).zfill(6)
+            typed = '%s-%s-%s' % (typed[:2], typed[2:4], typed[4:])
+            patients = self.patient.create([
+                    {'name': parties[4].id},
+                    {'name': parties[5].id, 'doh_id': typed},
+                    {'name': parties[6].id},
+                    {'name': parties[7].id},
+                    ])
+            self.assertEqual(patients[1].doh_id, typed)
+            self.assertEqual(numbers(patients), [first[-1] + i
+                    for i in (1, 2, 3, 4)])
+            self.assertEqual(len(set(p.doh_id for p in patients)), 4)
+
+    def test0080duplicate_clusters(self):
+        '''
+        Test that the batch scan groups the likely duplicate patients.
+        '''
+        dob = datetime.date(1990, 5, 1)
+        with Transaction().start(DB_NAME, USER,
+                context=dict(CONTEXT, mmc_skip_duplicate_check=True)):
+            parties = self.party.create([{
+                        'name': name,
+                        'lastname': lastname,
+                        'is_person': True,
+                        'is_patient': True,
+                        } for name, lastname in [
+                        ('Ma. Cristina', 'Villanueva'),
+                        ('Maria Kristina', 'Vilanueva'),
+                        ('Maria Cristina', 'Santos'),
+                        ('Maria Cristina', 'Villanueva'),
+                        ('Josefa', 'Reyes'),
+                        ]])
+            patients = self.patient.create([{
+                        'name': party.id,
+                        'dob': party_dob,
+                        } for party, party_dob in zip(parties,
+                        [dob, dob, dob, datetime.date(1985, 1, 1), dob])])
+            ids = [p.id for p in patients]
+            clusters = [sorted(r['id'] for r in cluster if r['id'] in ids)
+                for cluster in self.patient.find_duplicate_clusters()]
+            clusters = [c for c in clusters if c]
+            # Not the same name with another birth date.
+            self.assertEqual(clusters, [ids[:3]])
+
+    def test0090census_cache(self):
+        '''
+        Test that the cached census is cleared when a model it counts is
+        written.
+        '''
+        Reports = POOL.get('mmc.reports')
+        names = ['prenatal_today', 'trimester_1']
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as \
+                transaction:
+            today = POOL.get('ir.date').today()
+            reports = [Reports(1)]
+
+            def census():
+                result = Reports.get_census(reports, names)
+                return [result[name][1] for name in names]
+
+            before = census()
+            pregnancies = self.create_pregnancies(2, today)
+            self.assertEqual(census(), [before[0] + 1, before[1] + 2])
+
+            # A change made behind the back of the ORM is not seen
+            # until the next write.
+            transaction.cursor.execute('UPDATE "' + self.pregnancy._table
+                + '" SET current_pregnancy = %s WHERE id = %s',
+                (False, pregnancies[0].id))
+            self.assertEqual(census(), [before[0] + 1, before[1] + 2])
+            self.pregnancy.write([pregnancies[1]], {
+                    'current_pregnancy': False,
+                    })
+            self.assertEqual(census(), [before[0] + 1, before[1]])
+
+    def test0100worklist(self):
+        '''
+        Test the expected visits of a pregnancy as its evaluations are
+        recorded and changed.
+        '''
+        Visit = POOL.get('mmc.worklist.visit')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            today = POOL.get('ir.date').today()
+            start = today - datetime.timedelta(days=40)
+            pregnancy, = self.create_pregnancies(1, start)
+            first, = self.evaluation.search([('name', '=', pregnancy.id)])
+            self.evaluation.write([first], {
+                    'next_appt': start + datetime.timedelta(days=10),
+                    })
+            evaluations = self.evaluation.create([{
+                        'name': pregnancy.id,
+                        'evaluation_date': datetime.datetime.combine(
+                            start + datetime.timedelta(days=days),
+                            datetime.time(9)),
+                        'next_appt': next_appt,
+                        'examiner': 'test',
+                        } for days, next_appt in [
+                        (12, start + datetime.timedelta(days=25)),
+                        (30, today + datetime.timedelta(days=5)),
+                        ]])
+
+            def visits():
+                return [(v.expected_date, v.arrived, v.arrival_date,
+                        v.missed) for v in Visit.search([
+                            ('pregnancy', '=', pregnancy.id),
+                            ], order=[('expected_date', 'ASC')])]
+
+            self.assertEqual(visits(), [
+                    # Back two days late, within the grace days.
+                    (start + datetime.timedelta(days=10), True,
+                        start + datetime.timedelta(days=12), False),
+                    # Back after the grace days.
+                    (start + datetime.timedelta(days=25), False, None,
+                        True),
+                    (today + datetime.timedelta(days=5), False, None,
+                        False),
+                    ])
+
+            # A visit no longer scheduled leaves the worklist.
+            self.evaluation.write([evaluations[1]], {'next_appt': None})
+            self.assertEqual(len(visits()), 2)
+
+def suite():
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            MmcFunctionsTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(MmcTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())